@@ -0,0 +1,262 @@
+# encoding: utf-8
+
+"""
+@summary: run the benchmarks and write the results as json
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+from nglib.controller import add_books
+from nglib.controller import sync_books
+from nglib.model.bookdatabase import BookDatabase
+from nglib.model.bookdatabase import SORT_RELEVANCE
+from nglib.model.bookdatabase import SORT_TITLE
+from nglib.model.filescanner import FileScanner
+from nglib.model.stats import Stats
+from nglib.model.workers import default_workers
+from bench.synthlib import generate_library
+from bench.synthlib import query_corpus
+
+
+def run_benchmarks(files, depth=3, queries=200, workers=None, library=None,
+                   seed=0):
+    """
+    generate a synthetic library, run every benchmark on it and return
+    the results as a dict. times are in seconds, latencies of single
+    searches in milliseconds, memory in kilobytes.
+
+    files - number of files in the library
+    depth - number of directory levels of the library
+    queries - number of search terms to time
+    workers - number of metadata extraction processes, see add_books()
+    library - optional, directory of a library generated by an earlier
+              run with the same files, depth and seed. it is kept.
+    seed - seed for the titles and the search terms
+    """
+    tmpdir = tempfile.mkdtemp(prefix='nglib-bench-')
+    results = {'files': files, 'depth': depth, 'seed': seed,
+               'environment': _environment()}
+    try:
+        if library is None or not os.path.isdir(library):
+            library = library or os.path.join(tmpdir, 'library')
+            start = time.time()
+            info = generate_library(library, files, depth, seed=seed)
+            results['generate'] = _stage(start, dirs=info.dirs,
+                                         pdfs=info.pdfs, chms=info.chms,
+                                         bytes=info.bytes)
+
+        start = time.time()
+        scanner = FileScanner(library, stat=True)
+        for _ in scanner.scan():
+            pass
+        results['scan'] = _stage(start, found=scanner.total)
+
+        stats = Stats()
+        db = BookDatabase(os.path.join(tmpdir, 'bench.db'), stats=stats)
+        try:
+            start = time.time()
+            for _, added, _ in add_books(library, db, add_per_run=1000,
+                                         workers=workers):
+                pass
+            results['add_books'] = _stage(start, added=added,
+                                          per_second=_rate(added, start),
+                                          phases=stats.as_dict())
+
+            stats.reset()
+            start = time.time()
+            for progress in sync_books(library, db, sync_per_run=1000,
+                                       workers=workers):
+                pass
+            results['sync_unchanged'] = _stage(start, checked=progress.checked,
+                                               phases=stats.as_dict())
+
+            start = time.time()
+            books = db.get_all()
+            results['get_all'] = _stage(start, books=len(books))
+            del books
+
+            terms = query_corpus(queries, seed)
+            for sort in (SORT_TITLE, SORT_RELEVANCE):
+                results['search_' + sort] = _latencies(
+                    lambda term: db.book_list(term, sort=sort), terms)
+
+            results['fill_list'] = _fill_list(db, terms)
+        finally:
+            db.close()
+    finally:
+        shutil.rmtree(tmpdir)
+    results['peak_rss_kb'] = _peak_rss()
+    return results
+
+
+def _stage(start, **details):
+    """
+    return the result of a benchmark stage that started at start
+    """
+    details['seconds'] = round(time.time() - start, 4)
+    details['peak_rss_kb'] = _peak_rss()
+    return details
+
+
+def _latencies(search, terms):
+    """
+    run search for every term and return percentiles of the latencies
+    """
+    latencies = []
+    hits = 0
+    for term in terms:
+        start = time.time()
+        hits += len(search(term))
+        latencies.append((time.time() - start) * 1000)
+    return _percentiles(latencies, searches=len(terms), hits=hits)
+
+
+def _percentiles(latencies, **details):
+    """
+    return a dict with the median, the 90th and 99th percentile, the mean
+    and the maximum of a list of latencies in milliseconds
+    """
+    latencies = sorted(latencies)
+    if not latencies:
+        return details
+    def percentile(p):
+        # nearest rank
+        index = int(round(p / 100.0 * len(latencies) + 0.5)) - 1
+        return round(latencies[max(0, min(index, len(latencies) - 1))], 3)
+    details.update(p50_ms=percentile(50), p90_ms=percentile(90),
+                   p99_ms=percentile(99), max_ms=round(latencies[-1], 3),
+                   mean_ms=round(sum(latencies) / len(latencies), 3))
+    details['peak_rss_kb'] = _peak_rss()
+    return details
+
+
+class _IdleController(object):
+    """
+    stands in for the Controller of a ConsoleInterface that is only used
+    to render lists
+    """
+    def start_worker(self):
+        pass
+
+
+    def get_all_async(self):
+        pass
+
+
+def _fill_list(db, terms):
+    """
+    time showing all books and the results of every search term in the
+    book list of the console interface. stfl is needed for that, if it
+    isn't installed the benchmark is skipped.
+    """
+    try:
+        from nglib.view.consoleinterface import ConsoleInterface
+    except ImportError, e:
+        return {'skipped': str(e)}
+    ui = ConsoleInterface(_IdleController())
+    lists = [db.book_list()] + [db.book_list(term) for term in terms]
+    start = time.time()
+    ui._fill_list(lists[0])
+    result = _stage(start, books=len(lists[0].titles))
+    latencies = []
+    for books in lists[1:]:
+        start = time.time()
+        ui._fill_list(books)
+        latencies.append((time.time() - start) * 1000)
+    result['results'] = _percentiles(latencies, lists=len(latencies))
+    return result
+
+
+def _rate(count, start):
+    elapsed = time.time() - start
+    return elapsed and round(count / elapsed, 1) or None
+
+
+def _peak_rss():
+    """
+    return the peak resident set size of this process and of the largest
+    of its finished child processes (metadata extraction) in kilobytes
+    """
+    usage = [resource.getrusage(who).ru_maxrss for who in
+             (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    if sys.platform == 'darwin':
+        usage = [kb // 1024 for kb in usage] # reported in bytes
+    return {'self': usage[0], 'children': usage[1]}
+
+
+def _environment():
+    """
+    return what the results of a run depend on besides the code
+    """
+    return {'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'cpus': default_workers(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+if __name__=='__main__':
+    parser = OptionParser(usage='python -m bench.run [options]')
+    parser.add_option('-n', '--files', type='int', default=10000,
+                      help='number of files in the synthetic library '
+                           '(default: %default)')
+    parser.add_option('-d', '--depth', type='int', default=3,
+                      help='number of directory levels (default: %default)')
+    parser.add_option('-q', '--queries', type='int', default=200,
+                      help='number of search terms to time '
+                           '(default: %default)')
+    parser.add_option('-w', '--workers', type='int', default=None,
+                      help='number of metadata extraction processes')
+    parser.add_option('-l', '--library', default=None,
+                      help='generate the library in this directory and keep '
+                           'it, or use the one generated there before')
+    parser.add_option('-s', '--seed', type='int', default=0,
+                      help='seed for titles and search terms')
+    parser.add_option('-o', '--output', default=None,
+                      help='write the results to this file instead of stdout')
+    options, args = parser.parse_args()
+    results = run_benchmarks(options.files, options.depth, options.queries,
+                             options.workers, options.library, options.seed)
+    out = options.output and open(options.output, 'w') or sys.stdout
+    json.dump(results, out, indent=2, sort_keys=True)
+    out.write('\n')
+    if out is not sys.stdout:
+        out.close()
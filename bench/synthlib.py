@@ -0,0 +1,212 @@
+# encoding: utf-8
+
+"""
+@summary: generator for synthetic library trees used by the benchmarks
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import math
+import os
+import random
+import struct
+from collections import namedtuple
+
+
+WORDS = ('absolute', 'advanced', 'agile', 'algorithms', 'analysis', 'applied',
+         'architecture', 'art', 'basics', 'beginning', 'c', 'clean', 'cloud',
+         'code', 'compilers', 'complete', 'computer', 'concurrency', 'cooking',
+         'cryptography', 'data', 'database', 'debugging', 'design', 'distributed',
+         'effective', 'engineering', 'essential', 'expert', 'functional', 'game',
+         'geeks', 'guide', 'hacking', 'handbook', 'haskell', 'introduction',
+         'java', 'kernel', 'language', 'learning', 'linux', 'machine', 'modern',
+         'network', 'operating', 'patterns', 'performance', 'practical',
+         'practice', 'principles', 'programming', 'python', 'reference',
+         'refactoring', 'secrets', 'security', 'snow', 'software', 'structure',
+         'systems', 'testing', 'theory', 'unix', 'web', 'zen')
+
+FIRST_NAMES = ('ada', 'alan', 'barbara', 'brian', 'dennis', 'donald', 'edsger',
+               'grace', 'guido', 'john', 'ken', 'linus', 'margaret', 'neal',
+               'niklaus', 'peter', 'richard', 'william')
+
+LAST_NAMES = ('adams', 'gibson', 'hopper', 'kernighan', 'knuth', 'lamport',
+              'liskov', 'lovelace', 'mccarthy', 'pike', 'ritchie', 'stephenson',
+              'stroustrup', 'thompson', 'torvalds', 'turing', 'wirth')
+
+LibraryInfo = namedtuple('LibraryInfo', 'root files pdfs chms dirs bytes')
+
+
+def generate_library(root, files, depth=3, per_dir=100, chm_ratio=0.2,
+                     untitled_ratio=0.1, seed=0):
+    """
+    create a directory tree with pdf and chm files under root and return a
+    LibraryInfo with what was written. the files only have the headers,
+    cross-reference tables and metadata the readers of nglib look at, so a
+    big library is generated quickly and takes little space. titles and
+    authors are made of WORDS, FIRST_NAMES and LAST_NAMES. the same seed
+    always gives the same library.
+
+    root - directory to create the tree in, created if needed
+    files - number of files
+    depth - number of directory levels below root
+    per_dir - number of files per directory on the lowest level
+    chm_ratio - share of chm files
+    untitled_ratio - share of files without title and author
+    seed - seed for the random titles
+    """
+    rand = random.Random(seed)
+    leaves = max(1, int(math.ceil(files / float(per_dir))))
+    fanout = max(2, int(math.ceil(leaves ** (1.0 / max(depth, 1)))))
+    dirs = set()
+    pdfs = chms = size = 0
+    for i in range(files):
+        directory = _directory(root, i // per_dir, depth, fanout)
+        if directory not in dirs:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            dirs.add(directory)
+        title = ' '.join(rand.sample(WORDS, rand.randint(1, 5)))
+        author = '%s %s' % (rand.choice(FIRST_NAMES), rand.choice(LAST_NAMES))
+        if rand.random() < untitled_ratio:
+            title = author = ''
+        name = '%s_%d' % (title.replace(' ', '_') or 'scan', i)
+        if rand.random() < chm_ratio:
+            data = make_chm(title)
+            name += '.chm'
+            chms += 1
+        else:
+            data = make_pdf(title, author, rand.randint(1, 900))
+            name += '.pdf'
+            pdfs += 1
+        f = open(os.path.join(directory, name), 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        size += len(data)
+    return LibraryInfo(root, files, pdfs, chms, len(dirs), size)
+
+
+def query_corpus(count, seed=0):
+    """
+    return a list of search terms like the ones typed into nglib: words
+    and prefixes of words from titles and authors, several words, field
+    queries and terms that match nothing
+
+    count - number of search terms
+    seed - seed for choosing the terms
+    """
+    rand = random.Random(seed)
+    kinds = (lambda: rand.choice(WORDS),
+             lambda: rand.choice(WORDS)[:rand.randint(2, 4)],
+             lambda: ' '.join(rand.sample(WORDS, 2)),
+             lambda: rand.choice(LAST_NAMES),
+             lambda: 'author:%s' % rand.choice(LAST_NAMES),
+             lambda: '%s ext:chm' % rand.choice(WORDS),
+             lambda: '"%s"' % ' '.join(rand.sample(WORDS, 2)),
+             lambda: 'xyzzy%d' % rand.randint(0, 99))
+    return [rand.choice(kinds)() for _ in range(count)]
+
+
+def make_pdf(title, author, pages):
+    """
+    return the contents of a pdf file with an info dictionary and a page
+    tree that claims to have the given number of pages
+    """
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Kids [3 0 R] /Count %d >>' % pages,
+               '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >>']
+    trailer = '/Root 1 0 R'
+    if title or author:
+        objects.append('<< /Title (%s) /Author (%s) >>' % (title, author))
+        trailer += ' /Info 4 0 R'
+    out = '%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+    offsets = []
+    for num, obj in enumerate(objects):
+        offsets.append(len(out))
+        out += '%d 0 obj\n%s\nendobj\n' % (num + 1, obj)
+    xref = len(out)
+    out += 'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += ''.join('%010d 00000 n \n' % offset for offset in offsets)
+    out += 'trailer\n<< /Size %d %s >>\n' % (len(objects) + 1, trailer)
+    return out + 'startxref\n%d\n%%%%EOF\n' % xref
+
+
+def make_chm(title):
+    """
+    return the contents of a version 3 chm file with one directory chunk
+    and a #SYSTEM file that holds the title
+    """
+    system = struct.pack('<I', 3)
+    system += struct.pack('<HH', 2, 5) + 'a.htm'
+    if title:
+        system += struct.pack('<HH', 3, len(title) + 1) + title + '\0'
+    files = [('/', 0, 0, 0), ('/#ITBITS', 0, 0, 0),
+             ('/#SYSTEM', 0, 0, len(system)), ('/a.htm', 1, 0, 300)]
+    entries = ''.join(_encint(len(n)) + n + _encint(s) + _encint(o) +
+                      _encint(l) for n, s, o, l in files)
+    chunk_size = 0x1000
+    chunk = 'PMGL' + struct.pack('<IIii', chunk_size - 0x14 - len(entries),
+                                 0, -1, -1) + entries
+    chunk += '\0' * (chunk_size - len(chunk))
+    directory = 'ITSP' + struct.pack('<IIIIIIiIIiI', 1, 0x54, 10, chunk_size,
+                                     2, 1, -1, 0, 0, -1, 1)
+    directory += '\0' * (0x54 - len(directory))
+    header_length = 0x60
+    dir_length = len(directory) + len(chunk)
+    header = 'ITSF' + struct.pack('<IIII', 3, header_length, 1, 0)
+    header += '\0' * (0x38 - len(header))
+    header += struct.pack('<QQQQQ', 0, 0, header_length, dir_length,
+                          header_length + dir_length)
+    return header + directory + chunk + system
+
+
+def _encint(value):
+    """
+    encode an integer in the variable length format of chm directories
+    """
+    out = chr(value & 0x7f)
+    value >>= 7
+    while value:
+        out = chr(0x80 | (value & 0x7f)) + out
+        value >>= 7
+    return out
+
+
+def _directory(root, index, depth, fanout):
+    """
+    return the path of the directory with the given index on the lowest
+    level of a tree with depth levels and fanout subdirectories per level
+    """
+    parts = []
+    for _ in range(depth):
+        index, digit = divmod(index, fanout)
+        parts.append('d%02d' % digit)
+    return os.path.join(root, *reversed(parts))
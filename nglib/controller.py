@@ -33,22 +33,57 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 For more Information see http://netgarage.org
 """
 
+from __future__ import with_statement
 import os.path
+from collections import OrderedDict
+from collections import namedtuple
 from subprocess import Popen
 from subprocess import STDOUT
 
 #import simplejson
 from nglib.model.configurationstore import NgLibError
+from nglib.model.configurationstore import library_roots
+from nglib.model.bookdatabase import DEFAULT_BATCH_SIZE
+from nglib.model.bookdatabase import SORT_RELEVANCE
+from nglib.model.bookdatabase import SORT_TITLE
+from nglib.model.bookdatabase import BookDatabase
+from nglib.model.bookdatabase import BookList
+from nglib.model.filescanner import FileScanner
+from nglib.model.metadata import MetadataExtractor
+from nglib.model.metadatacache import MetadataCache
+from nglib.model.metadatacache import cache_file
+from nglib.model.shards import ShardedDatabase
+from nglib.model.shards import open_database
+from nglib.model.stats import NULL_STATS
+from nglib.worker import Worker
+
+
+def title_from_filename(filename, ext):
+    """
+    return a title generated from a filename by stripping the file
+    extension and replacing "." with spaces
 
+    filename - filename of the book, excluding path
+    ext - the file extension of filename
 
-def add_file(path, database):
     """
-    don't try to extract any metadata, just use the filename
-    (slightly prettyfied) as title and a blank string as author.
+    pos = filename.rfind(ext)
+    title = filename[:pos]
+    return title.replace('.', ' ').strip()
+
+
+def add_file(path, database, stat=None, update=False, metadata=None):
+    """
+    add a file using the metadata extracted from it. if there is no title,
+    use the filename (slightly prettyfied) as title, if there is no
+    author use a blank string.
     ignore all files with no pdf or chm extension.
 
     path - absolute path to a file
     database - BookDatabase object
+    stat - optional, result of os.stat() on the file
+    update - update an existing entry instead of adding a new one
+    metadata - optional, dict returned by extract_metadata()
 
     """
     filename = os.path.basename(path)
@@ -56,11 +91,18 @@ def add_file(path, database):
     if ext not in ('pdf', 'chm'):
         return False
 
-    pos = filename.rfind(ext)
-    title = filename[:pos]
-    title = title.replace('.', ' ').strip()
-    author = ''
-    database.add(path, title, author)
+    metadata = metadata or {}
+    title = metadata.get('title')
+    if title:
+        title = title.encode('utf8')
+    else:
+        title = title_from_filename(filename, ext)
+    author = metadata.get('author', u'').encode('utf8')
+    pages = metadata.get('pages', 0)
+    if update:
+        database.update(path, title, author, stat, pages)
+    else:
+        database.add(path, title, author, stat, pages)
     return True
 
 
@@ -72,46 +114,269 @@ def count_files(path, extensions=('pdf', 'chm')):
     extensions - iterable of file extensions to count
 
     """
-    count = 0
-    for _, _, files in os.walk(path):
-        for file in files:
-            ext = file.split('.')[-1].lower()
-            if ext in extensions:
-                count += 1
-    return count
+    scanner = FileScanner(path, extensions)
+    for _ in scanner.scan():
+        pass
+    return scanner.total
 
 
-def add_books(path, database, add_per_run=5):
+def add_books(path, database, add_per_run=5, batch_size=DEFAULT_BATCH_SIZE,
+              workers=None, cache=None, stats=None):
     """
     generator that adds all pdf and chm files in the directory tree
-    "path" to the database. yields numbers denoting how many files
-    have been added so far.
+    "path" to the database. the tree is walked only once, files are added
+    while it is being walked. metadata is extracted in worker processes.
+    yields tuples (added, subtotal, found) denoting how many files have
+    been added since the last and all previous calls, and how many have
+    been found so far.
 
     path - absolute path to the directory to walk
     database - BookDatabase object
     add_per_run - how many files should be added per call
+    batch_size - how many files should be added per transaction
+    workers - number of processes extracting metadata, see MetadataExtractor
+    cache - optional, MetadataCache for metadata extracted in earlier runs
+    stats - optional, Stats object for the time spent walking the tree
+            and extracting metadata and for the files seen and added.
+            defaults to the Stats of the database, which also times the
+            writes
 
     """
+    stats = _stats_of(database, stats)
+    return stats.timed(_add_books(path, database, add_per_run, batch_size,
+                                  workers, cache, stats), 'add_books')
+
+
+def _add_books(path, database, add_per_run, batch_size, workers, cache,
+               stats):
     subtotal = 0
     added = 0
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            if file.startswith('.'):
-                continue
-            ext = file.split('.')[-1].lower()
-            abspath = os.path.join(root, file)
+    scanner = FileScanner(path, stat=True)
+    extractor = MetadataExtractor(workers, cache=cache, stats=stats)
+    files = stats.timed(scanner.scan(), 'walk')
+    with database.batch(batch_size) as batch:
+        for abspath, stat, metadata in _extract(extractor, files, stats):
+            add_file(abspath, batch, stat, metadata=metadata)
+            added += 1
+
+            if added % add_per_run == 0:
+                subtotal += added
+                tmp = added
+                added = 0
+                yield tmp, subtotal, scanner.total
+
+    subtotal += added
+    stats.count('files_seen', scanner.total)
+    stats.count('files_added', subtotal)
+    yield added, subtotal, scanner.total
+
+
+SyncProgress = namedtuple('SyncProgress', 'found checked added removed changed')
+
+
+def library_available(path, database):
+    """
+    tell if a library directory can be synced with its database. it can't
+    if it doesn't exist or can't be listed, nor if it is empty while the
+    database has books: that is most likely the mount point of a drive
+    that isn't mounted, syncing it would remove all of its books.
+
+    path - absolute path to the library directory
+    database - BookDatabase object of the library
+    """
+    try:
+        if os.listdir(path):
+            return True
+    except OSError:
+        return False
+    return not database.get_all(limit=1)
+
+
+def sync_books(path, database, sync_per_run=50, batch_size=DEFAULT_BATCH_SIZE,
+               workers=None, cache=None, stats=None):
+    """
+    generator that brings the database in sync with the pdf and chm files
+    in the directory tree "path" without rebuilding it. files are compared
+    to the database by size, mtime and inode, only rows of files that were
+    added, removed or changed are touched, metadata is only extracted from
+    those. the tree is walked only once. books in directories that can't
+    be listed (e.g. after an i/o error) are kept.
+    yields SyncProgress tuples with running totals, the last one yielded
+    is the final result.
+
+    path - absolute path to the directory to walk
+    database - BookDatabase object
+    sync_per_run - after how many checked files progress should be yielded
+    batch_size - how many changes should be written per transaction
+    workers - number of processes extracting metadata, see MetadataExtractor
+    cache - optional, MetadataCache for metadata extracted in earlier runs
+    stats - optional, Stats object, see add_books()
+
+    """
+    stats = _stats_of(database, stats)
+    return stats.timed(_sync_tree(path, database, sync_per_run, batch_size,
+                                  workers, cache, stats), 'sync_books')
+
+
+def _sync_tree(path, database, sync_per_run, batch_size, workers, cache,
+               stats):
+    known = database.get_file_states()
+    scanner = FileScanner(path, stat=True)
+    extractor = MetadataExtractor(workers, cache=cache, stats=stats)
+    progress = None
+    with database.batch(batch_size) as batch:
+        for progress in _sync_books(scanner, extractor, known, batch,
+                                    sync_per_run, stats):
+            yield progress
+    if progress is not None:
+        stats.count('files_seen', progress.found)
+        stats.count('files_checked', progress.checked)
+        stats.count('files_skipped',
+                    progress.checked - progress.added - progress.changed)
+        stats.count('files_added', progress.added)
+        stats.count('files_changed', progress.changed)
+        stats.count('files_removed', progress.removed)
+
+
+def _stats_of(database, stats):
+    """
+    return stats, or the Stats object of the database if it is None
+    """
+    if stats is None:
+        stats = getattr(database, 'stats', NULL_STATS)
+    return stats
+
+
+def _extract(extractor, files, stats, wanted=None):
+    """
+    run files through extractor, see MetadataExtractor.extract(). the time
+    spent waiting for the metadata is added to the metadata timer of
+    stats, without the time spent in the walk timer meanwhile.
+    """
+    return stats.timed(extractor.extract(files, wanted), 'metadata',
+                       exclude='walk')
+
+
+def _diff_files(scanner, known, stats):
+    """
+    generator that yields (path, stat, state) for every file found by the
+    scanner. state is the (size, mtime, inode) tuple stored in the database,
+    None for new files, False for files that didn't change. files yielded
+    are removed from known.
+    """
+    for abspath, stat in stats.timed(scanner.scan(), 'walk'):
+        key = (os.path.dirname(abspath).decode('utf8'),
+               os.path.basename(abspath).decode('utf8'))
+        state = known.pop(key, None)
+        if state == (stat.st_size, stat.st_mtime, stat.st_ino):
+            state = False
+        yield abspath, stat, state
+
+
+def _sync_books(scanner, extractor, known, database, sync_per_run, stats):
+    checked = added = removed = changed = 0
+    entries = _extract(extractor, _diff_files(scanner, known, stats), stats,
+                       wanted=lambda entry: entry[2] is not False)
+    for abspath, stat, state, metadata in entries:
+        if state is None:
+            add_file(abspath, database, stat, metadata=metadata)
+            added += 1
+        elif state is not False:
+            add_file(abspath, database, stat, update=True, metadata=metadata)
+            changed += 1
+
+        checked += 1
+        if checked % sync_per_run == 0:
+            yield SyncProgress(scanner.total, checked, added, removed, changed)
+
+    # books in directories that couldn't be listed may still be there
+    failed = tuple(os.path.join(_unicode(path), u'') for path in scanner.failed)
+    for dirname, filename in known:
+        if os.path.join(dirname, u'').startswith(failed):
+            continue
+        database.remove(os.path.join(dirname, filename).encode('utf8'))
+        removed += 1
+
+    yield SyncProgress(scanner.total, checked, added, removed, changed)
+
+
+def _unicode(path):
+    if isinstance(path, unicode):
+        return path
+    return path.decode('utf8')
+
+
+DEFAULT_RESULT_CACHE_SIZE = 32
+
+CacheInfo = namedtuple('CacheInfo', 'hits misses size max_size')
+
+
+class LruCache(object):
+    """
+    a dict with a maximum size that drops the least recently used entries
+    """
 
-            if ext in ('pdf', 'chm'):
-                add_file(abspath, database)
-                added += 1
+    def __init__(self, max_size):
+        """
+        max_size - how many entries to keep
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
 
-                if added % add_per_run == 0:
-                    subtotal += added
-                    tmp = added
-                    added = 0
-                    yield tmp, subtotal
 
-    yield added, subtotal
+    def get(self, key, default=None):
+        """
+        return the value for key and mark it as recently used, or default
+        if key is not in the cache
+        """
+        try:
+            value = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries[key] = value
+        self.hits += 1
+        return value
+
+
+    def put(self, key, value):
+        """
+        store value for key, dropping the least recently used entry if the
+        cache is full
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = value
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+    def clear(self):
+        """
+        remove all entries, the hit counters are kept
+        """
+        self._entries.clear()
+
+
+    def hit_rate(self):
+        """
+        return the fraction of lookups that were hits
+        """
+        lookups = self.hits + self.misses
+        return lookups and float(self.hits) / lookups or 0.0
+
+
+    def info(self):
+        """
+        return a CacheInfo tuple
+        """
+        return CacheInfo(self.hits, self.misses, len(self._entries),
+                         self.max_size)
+
+
+    def __len__(self):
+        return len(self._entries)
 
 
 class Controller(object):
@@ -119,18 +384,30 @@ class Controller(object):
     This class provides functionality of the model to the view.
     """
 
-    def __init__(self, database, config):
+    def __init__(self, database, config,
+                 cache_size=DEFAULT_RESULT_CACHE_SIZE, stats=None):
         """
         create a controller
 
-        database - an instance of BookDatabase
+        database - an instance of BookDatabase, or a ShardedDatabase for a
+                   configuration with several library roots
         config - an instance of ConfigurationStore
+        cache_size - optional, how many search results and books to cache
+        stats - optional, Stats object that times searches and reloads.
+                defaults to the Stats of the database
         """
         self._db = database
+        self.stats = _stats_of(database, stats)
         self.config = config
         self._views = {}
-        self._pos2id = [] # map a position in the view to a
-                          # primary key in the book db
+        self._books = BookList() # the books shown in the view
+        self._term = None # search term of self._books if it has all matches
+        self._sort = SORT_TITLE # order of self._books if _term is set
+        self._results = LruCache(cache_size)
+        self._worker = None
+        self._listing = None # id of the latest search job of the worker
+        self._generation = None # database generation of the cached results
+        self._caches = {} # root name -> MetadataCache used for reloads
 
 
     def add_view(self, view, view_init=None):
@@ -143,26 +420,152 @@ class Controller(object):
         self._views[view] = view_init
 
 
-    def search(self, term):
+    def search(self, term, content=False, limit=None, fuzzy=False,
+               sort=SORT_TITLE):
         """
-        search for a term in the database
+        search for a term in the database and return the books found as a
+        BookList
 
         term - the term to search for
+        content - search the text of the books instead of title, author and
+                  filename. results are ordered by relevance, not by title
+        limit - optional, maximum number of books to return
+        fuzzy - tolerate typos in the term. results are ordered by the
+                number of typos, not by title
+        sort - SORT_TITLE or SORT_RELEVANCE, best matches first
+        """
+        key = ('search', term, content, limit, fuzzy, sort)
+        complete = True
+        with self.stats.timer('search'):
+            books = self._cached(key)
+            if books is None:
+                if content or fuzzy:
+                    books = BookList(self._db.search(term, content,
+                                                     limit=limit,
+                                                     fuzzy=fuzzy))
+                else:
+                    books = self._db.book_list(term, limit=limit, sort=sort)
+                complete = self._store(key, books)
+            else:
+                self.stats.count('search_cache_hits')
+        self.stats.count('searches')
+        self.stats.count('books_found', len(books))
+        self._books = books
+        if content or fuzzy or limit is not None or not complete:
+            self._term = None
+        else:
+            self._term = term
+            self._sort = sort
+        return books
+
+
+    def search_incremental(self, term, cancel=None, sort=SORT_TITLE):
+        """
+        search for a term while it is being typed. if the term extends the
+        previous (non-empty) search term in the same order and both are
+        plain words, the previous results are filtered in memory instead of
+        querying the database again. rankings are scored again in memory
+        (see BookDatabase.ranker()).
+        raises SearchCancelled if cancel() returns True during the query,
+        the previous results are kept in that case.
+
+        term - the term to search for
+        cancel - optional, callable that tells if the search is stale
+        sort - SORT_TITLE or SORT_RELEVANCE
+        """
+        key = ('search', term, False, None, False, sort)
+        complete = True
+        books = self._cached(key)
+        if books is None:
+            match = rank = None
+            if self._term and term.startswith(self._term) and \
+               sort == self._sort and self._db.matcher(self._term) is not None:
+                match = self._db.matcher(term)
+            if match is not None and sort == SORT_RELEVANCE:
+                rank = self._db.ranker(term)
+                if rank is None:
+                    match = None
+            if match is not None:
+                books = self._books.filter(match)
+                if rank is not None:
+                    books = books.ranked(rank)
+            else:
+                self._db.set_cancel_check(cancel)
+                try:
+                    books = self._db.book_list(term, sort=sort)
+                finally:
+                    self._db.set_cancel_check(None)
+            complete = self._store(key, books)
+        self._books = books
+        if complete:
+            self._term = term
+            self._sort = sort
+        else:
+            self._term = None
+        return books
+
+
+    def get_all(self, limit=None):
+        """
+        return a BookList of all books in the database, ordered by title
+
+        limit - optional, maximum number of books to return
+        """
+        key = ('all', limit)
+        books = self._cached(key)
+        if books is None:
+            books = self._db.book_list(limit=limit)
+            self._store(key, books)
+        self._books = books
+        self._term = None # narrowing all books would scan them in python
+        return books
+
+
+    def get_book(self, book_id):
+        """
+        return the Book with the given id
+
+        book_id - primary key of the book in the db
+        """
+        key = ('book', book_id)
+        book = self._cached(key)
+        if book is None:
+            book = self._db.get_by_id(book_id)
+            self._store(key, book)
+        return book
+
+
+    def cache_info(self):
+        """
+        return a CacheInfo tuple (hits, misses, size, max_size) for the
+        cache of search results and books
+        """
+        return self._results.info()
+
+
+    def _cached(self, key):
+        """
+        return the cached result for key or None. the cache is cleared
+        first if the database changed since the results were cached.
         """
-        results = self._db.search(term)
-        results.sort(key=lambda x: x.title)
-        self._pos2id = [x.bid for x in results]
-        return results
+        generation = self._db.generation()
+        if generation != self._generation:
+            self._results.clear()
+            self._generation = generation
+            self._term = None # self._books can't be narrowed down either
+        return self._results.get(key)
 
 
-    def get_all(self):
+    def _store(self, key, result):
         """
-        return all books in the database
+        cache the result of a database call and return True, unless shards
+        of a ShardedDatabase were left out of the call (see its missing
+        attribute). then the result is incomplete and False is returned.
         """
-        all_books = self._db.get_all()
-        all_books.sort(key=lambda x: x.title)
-        self._pos2id = [x.bid for x in all_books]
-        return all_books
+        if getattr(self._db, 'missing', None):
+            return False
+        self._results.put(key, result)
+        return True
 
 
     def open_book(self, pos):
@@ -172,7 +575,7 @@ class Controller(object):
         pos - position of the entry in the view
         """
         # FIXME add windows support, probably with os.startfile()
-        book = self._db.get_by_id(self._pos2id[int(pos)])
+        book = self._books[int(pos)]
         path = os.path.join(book.path, book.filename)
         try:
             cmd = getattr(self.config, book.filetype+'cmd')
@@ -187,7 +590,7 @@ class Controller(object):
         """
         show an ebook file in a file manager
         """
-        book = self._db.get_by_id(self._pos2id[int(pos)])
+        book = self._books[int(pos)]
 
         import platform
         if 'darwin' in platform.platform().lower():
@@ -213,11 +616,88 @@ class Controller(object):
                 init()
 
 
+    def start_worker(self):
+        """
+        start a Worker thread with its own database connection. the
+        *_async() methods queue jobs for it, poll_events() returns their
+        results.
+        """
+        config = self.config
+        self._worker = Worker(lambda: Controller(
+            open_database(library_roots(config)), config))
+        self._worker.start()
+
+
+    def search_async(self, term, sort=SORT_TITLE):
+        """
+        search for a term in the worker thread, the BookList found is
+        returned by poll_events(). returns the id of the job.
+
+        sort - SORT_TITLE or SORT_RELEVANCE
+        """
+        self._listing = self._worker.search(term, sort)
+        return self._listing
+
+
+    def get_all_async(self):
+        """
+        fetch all books in the worker thread, see search_async()
+        """
+        self._listing = self._worker.get_all()
+        return self._listing
+
+
+    def reload_library_async(self, rebuild=False):
+        """
+        reload the library in the worker thread. poll_events() returns its
+        progress. returns the id of the job.
+
+        rebuild - build a new database instead of updating it incrementally
+        """
+        return self._worker.reload(rebuild)
+
+
+    def cancel_async(self):
+        """
+        cancel the search and reload running in the worker thread
+        """
+        self._worker.cancel()
+
+
+    def poll_events(self):
+        """
+        return the WorkerEvents posted by the worker thread since the last
+        call. the BookList of the latest search becomes the list that
+        positions passed to open_book() and show_book() refer to, results
+        of older searches are dropped.
+        """
+        events = []
+        for event in self._worker.poll():
+            if event.kind == 'books':
+                if event.job != self._listing:
+                    continue
+                self._books = event.data
+            events.append(event)
+        return events
+
+
+    def close(self):
+        """
+        stop the worker thread and close the database
+        """
+        if self._worker is not None:
+            self._worker.stop(timeout=5)
+            self._worker = None
+        for cache in self._caches.values():
+            cache.close()
+        self._db.close()
+
+
     def shutdown(self):
         """
         shutdown the application
         """
-        self._db.close()
+        self.close()
         import sys
         sys.exit(0)
 
@@ -254,17 +734,71 @@ class Controller(object):
 
     def count_books(self):
         """
-        return the number of PDF and CHM files in the configured library directory
+        return the number of PDF and CHM files in the configured library
+        directories
         """
-        return count_files(self.config.dir)
+        return sum(count_files(root.dir)
+                   for root in library_roots(self.config))
 
 
-    def reload_library(self):
+    def reload_library(self, rebuild=False, root=None):
         """
-        (re)build a BookDatabase with all files from the configured library directory
+        bring the databases in sync with the files in the configured library
+        directories, one root after the other. roots that aren't available
+        (see library_available(), e.g. an unmounted drive) are skipped, so
+        their books aren't removed. returns a generator like sync_books() that yields the
+        running totals of all roots.
+
+        rebuild - build new databases instead of updating them
+                  incrementally. they replace the old ones when they are
+                  complete, see BookDatabase.start_rebuild(). their
+                  content index is empty, nglib-update --content has to
+                  be run again
+        root - optional, name of the only root to reload
         """
-        self._db.clear()
-        return add_books(self.config.dir, self._db)
+        roots = [r for r in library_roots(self.config)
+                 if root is None or r.name == root]
+        if not roots:
+            raise NgLibError('There is no library root called "%s".' % root)
+        self._term = None
+        for r in roots:
+            if r.name not in self._caches:
+                self._caches[r.name] = MetadataCache(cache_file(r.dbfile))
+        return self._sync_roots(roots, rebuild)
+
+
+    def _sync_roots(self, roots, rebuild):
+        done = SyncProgress(0, 0, 0, 0, 0) # totals of the finished roots
+        for root in roots:
+            if not os.path.isdir(root.dir):
+                continue
+            if isinstance(self._db, ShardedDatabase):
+                database = BookDatabase(root.dbfile, stats=self.stats)
+            else:
+                database = self._db
+            target = database
+            try:
+                if not library_available(root.dir, database):
+                    continue
+                if rebuild:
+                    target = database.start_rebuild()
+                progress = None
+                for progress in sync_books(root.dir, target,
+                                           cache=self._caches[root.name],
+                                           stats=self.stats):
+                    yield SyncProgress(*[a + b for a, b in
+                                         zip(done, progress)])
+                if progress is not None:
+                    done = SyncProgress(*[a + b for a, b in
+                                          zip(done, progress)])
+                if rebuild:
+                    database.finish_rebuild(target)
+                    target = database
+            finally:
+                if target is not database:
+                    database.abort_rebuild(target)
+                if database is not self._db:
+                    database.close()
 
 
 # there's nothing to see here, move along
@@ -33,16 +33,148 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 For more Information see http://netgarage.org
 """
 
+from __future__ import with_statement
+import heapq
+import math
 import os
+import re
 import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from contextlib import contextmanager
+
+from nglib.model.configurationstore import NgLibError
+from nglib.model.contentindex import content_terms
+from nglib.model.filehash import PARTIAL_SIZE
+from nglib.model.filehash import FileHasher
+from nglib.model.query import TEXT_FIELDS
+from nglib.model.query import compile_query
+from nglib.model.query import describe
+from nglib.model.query import is_simple
+from nglib.model.query import parse_query
+from nglib.model.query import text_terms
+from nglib.model.stats import NULL_STATS
+from nglib.model.trigramindex import TrigramIndex
+
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FUZZY_LIMIT = 20
+
+# seconds a connection waits for a lock held by another connection, and
+# how often a write that still finds the database locked is retried
+DEFAULT_BUSY_TIMEOUT = 5.0
+WRITE_RETRIES = 5
+
+# connections a BookDatabase opens at most, one per thread using it
+DEFAULT_POOL_SIZE = 4
+
+SORT_RELEVANCE = 'relevance'
+SORT_TITLE = 'title'
+SORT_ORDERS = (SORT_RELEVANCE, SORT_TITLE)
+
+# how much a hit in title, author and filename counts in rank_search()
+_FIELD_WEIGHTS = (3.0, 1.5, 1.0)
+# BM25 term frequency saturation and field length normalization
+_BM25_K1 = 1.2
+_BM25_B = 0.75
+# a word that only starts with a search word counts as this much of a hit
+_PREFIX_HIT = 0.5
+# score factors for titles that are / start with the words of the query
+_EXACT_BOOST = 2.0
+_START_BOOST = 1.5
+
+_INSERT_SQL = u"""insert into books (title, author, filename, path,
+                                     size, mtime, inode, pages, filetype)
+                  values (?, ?, ?, ?, ?, ?, ?, ?, ?)"""
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    # adding a file that is already there updates it, keeping its id
+    _INSERT_SQL += u"""
+                  on conflict (path, filename) do update set
+                  title = excluded.title, author = excluded.author,
+                  size = excluded.size, mtime = excluded.mtime,
+                  inode = excluded.inode, pages = excluded.pages"""
+else:
+    _INSERT_SQL = u"insert or replace" + _INSERT_SQL[len(u"insert"):]
+
+_BOOK_COLUMNS = (u"id, title, author, filename, path, size, mtime, inode, "
+                 u"pages, filetype")
+_UPDATE_SQL = u"""update books set title = ?, author = ?, size = ?,
+                  mtime = ?, inode = ?, pages = ?
+                  where path = ? and filename = ?"""
+_DELETE_SQL = u"delete from books where path = ? and filename = ?"
+_DELETE_DIR_SQL = u"""delete from books where path = ? or
+                      substr(path, 1, length(?)) = ?"""
+
+# tokenizers to try for the full-text index, best first. remove_diacritics 2
+# needs sqlite 3.27, older versions only know remove_diacritics 1 (default)
+_FTS_TOKENIZERS = ("unicode61 remove_diacritics 2", "unicode61")
+
+_FTS_TRIGGERS = (u"""create trigger books_fts_insert after insert on books
+                     begin
+                         insert into books_fts (rowid, title, author, filename)
+                         values (new.id, new.title, new.author,
+                                 new.filename);
+                     end""",
+                 u"""create trigger books_fts_delete after delete on books
+                     begin
+                         insert into books_fts (books_fts, rowid, title,
+                                                author, filename)
+                         values ('delete', old.id, old.title, old.author,
+                                 old.filename);
+                     end""",
+                 u"""create trigger books_fts_update
+                     after update of title, author, filename on books
+                     begin
+                         insert into books_fts (books_fts, rowid, title,
+                                                author, filename)
+                         values ('delete', old.id, old.title, old.author,
+                                 old.filename);
+                         insert into books_fts (rowid, title, author, filename)
+                         values (new.id, new.title, new.author,
+                                 new.filename);
+                     end""")
+
+# the content index: terms, postings (term -> books with term frequency,
+# clustered by term) and the books that have been indexed
+_CONTENT_TABLES = (u"""create table if not exists content_terms
+                       (id integer primary key, term text unique)""",
+                   u"""create table if not exists content_postings
+                       (term_id integer, book_id integer, tf integer,
+                        primary key (term_id, book_id)) without rowid""",
+                   u"""create index if not exists content_postings_book
+                       on content_postings (book_id)""",
+                   u"""create table if not exists content_books
+                       (book_id integer primary key, mtime real,
+                        length integer)""",
+                   u"""create trigger if not exists content_delete
+                       after delete on books
+                       begin
+                           delete from content_postings
+                           where book_id = old.id;
+                           delete from content_books where book_id = old.id;
+                       end""")
+
+_WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+class SearchCancelled(NgLibError):
+    """
+    raised when a search is aborted by the cancel check of a BookDatabase
+    """
+    pass
 
 
 class Book(object):
     """
     represents a book
     """
+    __slots__ = ('title', 'filename', 'path', 'author', 'pages', 'tags',
+                 '_filetype', 'bid', 'size')
+
     def __init__(self, title, filename, path, author='', pages=0,
-                 tags=[], filetype='pdf', bid=None):
+                 tags=(), filetype=None, bid=None, size=None):
         """
         title - title of the book
         filename - filename of the book, excluding path
@@ -50,8 +182,10 @@ class Book(object):
         author - optional, author of the book
         pages - optional, number of pages of the book
         tags - optional, tags describing the book
-        filetype - filetype of the book
+        filetype - optional, filetype of the book. derived from the
+                   filename extension if not given
         bid - optional, unique id
+        size - optional, size of the file in bytes
         """
         self.title = title
         self.filename = filename
@@ -59,21 +193,305 @@ class Book(object):
         self.author = author
         self.pages = pages
         self.tags = tags
-        self.filetype = filetype
+        self._filetype = filetype
         self.bid = bid
+        self.size = size
 
 
-    def __str__(self):
+    def _get_filetype(self):
+        if self._filetype is None:
+            return self.filename[self.filename.rfind('.')+1:]
+        return self._filetype
+
+
+    def _set_filetype(self, filetype):
+        self._filetype = filetype
+
+    filetype = property(_get_filetype, _set_filetype)
+
+
+    def __unicode__(self):
         return self.title
 
 
+    def __str__(self):
+        return self.title.encode('utf8')
+
+
+def _id_array():
+    """
+    return an empty array for 64 bit book ids. typecode 'q' is missing
+    before python 3.3, where 'l' is 64 bit on most unix platforms.
+    """
+    try:
+        return array('q')
+    except ValueError:
+        return array('l')
+
+
+class BookList(object):
+    """
+    a compact, read-only list of books. the fields are stored in columns
+    (ids and page counts in arrays, paths shared between books in the same
+    directory) and Book objects are only created when an item is accessed.
+    """
+    def __init__(self, books=()):
+        """
+        books - optional, iterable of Book objects to fill the list with
+        """
+        self.ids = _id_array()
+        self.titles = []
+        self.authors = []
+        self.filenames = []
+        self.pages = array('l')
+        self._paths = []
+        self._path_index = array('l')
+        self._path_ids = {}
+        for book in books:
+            self.append(book.bid, book.title, book.author, book.filename,
+                        book.path, book.pages)
+
+
+    def append(self, bid, title, author, filename, path, pages=0):
+        """
+        append a book to the list
+        """
+        index = self._path_ids.get(path)
+        if index is None:
+            index = self._path_ids[path] = len(self._paths)
+            self._paths.append(path)
+        self.ids.append(bid)
+        self.titles.append(title)
+        self.authors.append(author)
+        self.filenames.append(filename)
+        self.pages.append(pages or 0)
+        self._path_index.append(index)
+
+
+    def filter(self, match):
+        """
+        return a new BookList with the books for which match(title, author,
+        filename) returns True, in the same order
+        """
+        books = BookList()
+        for pos in xrange(len(self.ids)):
+            if match(self.titles[pos], self.authors[pos],
+                     self.filenames[pos]):
+                books.append(self.ids[pos], self.titles[pos],
+                             self.authors[pos], self.filenames[pos],
+                             self.path(pos), self.pages[pos])
+        return books
+
+
+    def ranked(self, score):
+        """
+        return a new BookList with the books ordered by score(title,
+        author, filename), highest first. ties are ordered by title and id
+        like BookDatabase.rank_search() does.
+        """
+        order = sorted(xrange(len(self.ids)), key=lambda pos:
+                       (-score(self.titles[pos], self.authors[pos],
+                               self.filenames[pos]),
+                        (self.titles[pos] or u'').lower(), self.ids[pos]))
+        books = BookList()
+        for pos in order:
+            books.append(self.ids[pos], self.titles[pos], self.authors[pos],
+                         self.filenames[pos], self.path(pos),
+                         self.pages[pos])
+        return books
+
+
+    def path(self, pos):
+        """
+        return the path of the book at position pos
+        """
+        return self._paths[self._path_index[pos]]
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def __getitem__(self, pos):
+        return Book(bid=self.ids[pos], title=self.titles[pos],
+                    author=self.authors[pos], filename=self.filenames[pos],
+                    path=self.path(pos), pages=self.pages[pos])
+
+
+    def __iter__(self):
+        for pos in xrange(len(self.ids)):
+            yield self[pos]
+
+
+def connect(path):
+    """
+    open a sqlite connection that can be closed from another thread, the
+    default factory of ConnectionPool
+    """
+    return sqlite3.connect(path, check_same_thread=False)
+
+
+class ConnectionPool(object):
+    """
+    gives every thread its own connection to a database file, at most
+    max_size at a time. a thread that needs a connection while all are
+    taken waits until another thread calls release().
+    """
+    def __init__(self, path, factory=connect, max_size=DEFAULT_POOL_SIZE,
+                 read_only=False, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        """
+        create a ConnectionPool, connections are opened when needed
+
+        path - path to the database file
+        factory - callable that takes path and returns a sqlite connection
+        max_size - maximum number of connections
+        read_only - make the connections refuse to write (query_only)
+        busy_timeout - seconds to wait for a lock before giving up
+        """
+        self.path = path
+        self.read_only = read_only
+        self.busy_timeout = busy_timeout
+        self._factory = factory
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._writers = set() # connections in a transaction, see writing()
+        self._closed = False
+
+
+    def get(self):
+        """
+        return the connection of the calling thread, opening it if needed
+        """
+        con = getattr(self._local, 'con', None)
+        if con is not None and con not in self._connections:
+            con = self._local.con = None # see close_all()
+        elif con is not None and \
+             self.inode() not in (None, self._local.inode):
+            self.release() # the file was replaced, see finish_rebuild()
+            con = None
+        if con is None:
+            if self._closed:
+                raise sqlite3.ProgrammingError('the pool is closed')
+            self._slots.acquire()
+            try:
+                con = self.connect()
+                if self.read_only:
+                    con.execute(u"pragma query_only = 1")
+            except:
+                self._slots.release()
+                raise
+            with self._lock:
+                self._connections.append(con)
+            self._local.con = con
+            self._local.inode = self.inode()
+        return con
+
+
+    def inode(self):
+        """
+        return the inode of the database file, None if it doesn't exist
+        """
+        try:
+            return os.stat(self.path).st_ino
+        except OSError:
+            return None
+
+
+    def connect(self):
+        """
+        open a writable connection that isn't part of the pool
+        """
+        con = self._factory(self.path)
+        con.execute(u"pragma busy_timeout = %d" % (self.busy_timeout * 1000))
+        con.execute(u"pragma synchronous = normal") # enough with WAL
+        return con
+
+
+    def release(self):
+        """
+        close the connection of the calling thread, so another thread can
+        have one
+        """
+        con = getattr(self._local, 'con', None)
+        if con is not None:
+            self._local.con = None
+            with self._lock:
+                if con not in self._connections:
+                    return # already closed by close_all()
+                self._connections.remove(con)
+            con.close()
+            self._slots.release()
+
+
+    @contextmanager
+    def writing(self):
+        """
+        context manager for a write transaction on the connection of the
+        calling thread, interrupt() leaves the connection alone meanwhile.
+        gives the connection.
+        """
+        con = self.get()
+        with self._lock:
+            self._writers.add(con)
+        try:
+            yield con
+        finally:
+            with self._lock:
+                self._writers.discard(con)
+
+
+    def interrupt(self):
+        """
+        abort the queries running on all connections that aren't writing
+        (see writing()), so a cancelled search doesn't abort a write of
+        another thread
+        """
+        with self._lock:
+            for con in self._connections:
+                if con not in self._writers:
+                    con.interrupt()
+
+
+    def close_all(self):
+        """
+        close the connections of all threads, each thread opens a new one
+        with its next query. a query or write running meanwhile fails.
+        """
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._writers.clear()
+        for con in connections:
+            con.close()
+            self._slots.release()
+
+
+    def close(self):
+        """
+        close all connections, the pool can't be used afterwards
+        """
+        with self._lock:
+            self._closed = True
+        self.close_all()
+        self._local = threading.local()
+
+
+    def __len__(self):
+        return len(self._connections)
+
+
 class BookDatabase(object):
     """
     thin wrapper around sqlite for adding, removing and searching
     pdf and chm files
     all strings assumed to be utf-8 encoded bytestrings
+    the database is in WAL mode, so searches aren't blocked by an update
+    that runs at the same time. an instance can be used from several
+    threads, each gets its own connection (see ConnectionPool).
     """
-    def __init__(self, path, db_backend_factory=sqlite3.connect):
+    def __init__(self, path, db_backend_factory=connect, read_only=False,
+                 pool_size=DEFAULT_POOL_SIZE, stats=None):
         """
         create a BookDatabase object
 
@@ -83,45 +501,106 @@ class BookDatabase(object):
         db_backend_factory - callable that takes path as an argument
                               and returns something that conforms to
                               the Python DBAPI
+        read_only - only search, writing raises an error. an outdated
+                    schema is still upgraded on open
+        pool_size - number of threads that can use the database at once
+        stats - optional, Stats object that times writes and searches
         """
         path = path.decode('utf8')
         self._dbfile = path
-        empty = not os.path.exists(path)
-        self._dbcon = db_backend_factory(path)
+        self._pool = ConnectionPool(path, db_backend_factory, pool_size,
+                                    read_only)
         self._dbopen = True
-        if empty:
-            self._create_db()
+        self._fts = False
+        self._generation = 0 # bumped by every change through this object
+        self._deferred = () # indexes and triggers created by finish_rebuild()
+        self._trigrams = None # (generation, TrigramIndex) for fuzzy_search()
+        if stats is None:
+            stats = NULL_STATS
+        self.stats = stats
+        self._create_db()
 
 
     def close(self):
         """
-        close the underlying sqlite connection
+        close the underlying sqlite connections
         does nothing if db is not open
         """
         if self._dbopen:
-            self._dbcon.close()
+            self._pool.close()
+            self._dbopen = False
+
+
+    def release(self):
+        """
+        close the connection of the calling thread, for threads that are
+        done with the database
+        """
+        self._pool.release()
+
+
+    @property
+    def _dbcon(self):
+        return self._pool.get()
 
 
-    def add(self, path, title, author):
+    def add(self, path, title, author, stat=None, pages=0):
         """
         add an ebook to the database
 
         path - absolute path to the file
         title - title of the book
         author - author of the book
+        stat - optional, result of os.stat() on the file. size, mtime and
+               inode are stored so later syncs can tell if the file changed
+        pages - optional, number of pages of the book
 
         """
-        path = path.decode('utf8')
-        title = title.decode('utf8')
-        author = author.decode('utf8')
-        cursor = self._dbcon.cursor()
-        filename = os.path.basename(path)
-        dirname = os.path.dirname(path)
-        t = (title, author, filename, dirname)
-        sql = u"insert into books values (?, ?, ?, ?)"
-        cursor.execute(sql, t)
-        self._dbcon.commit()
-        cursor.close()
+        self._write([(_INSERT_SQL,
+                      [_add_row(path, title, author, stat, pages)])])
+
+
+    def add_many(self, books, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        add many ebooks to the database, committing once per batch
+        instead of once per book. returns the number of books added.
+
+        books - iterable of (path, title, author[, stat[, pages]]) tuples,
+                see add()
+        batch_size - how many books to insert per transaction
+
+        """
+        count = 0
+        with self.batch(batch_size) as batch:
+            for book in books:
+                batch.add(*book)
+                count += 1
+        return count
+
+
+    def batch(self, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        return a BatchWriter for this database
+
+        batch_size - how many changes to collect per transaction
+        """
+        return BatchWriter(self, batch_size)
+
+
+    def update(self, path, title, author, stat=None, pages=0):
+        """
+        update title, author, pages and file state of a book that is
+        already in the database
+
+        path - absolute path to the file
+        title - title of the book
+        author - author of the book
+        stat - optional, result of os.stat() on the file
+        pages - optional, number of pages of the book
+
+        """
+        self._write([(_UPDATE_SQL,
+                      [_update_row(path, title, author, stat, pages)])])
 
 
     def remove(self, path):
@@ -131,55 +610,650 @@ class BookDatabase(object):
         path - absolute path to the file
 
         """
-        path = path.decode('utf8')
-        cursor = self._dbcon.cursor()
-        filename = os.path.basename(path)
-        dirname = os.path.dirname(path)
-        t = (dirname, filename)
-        sql = u"delete from books where path = ? and filename = ?"
-        cursor.execute(sql, t)
-        self._dbcon.commit()
-        cursor.close()
+        self._write([(_DELETE_SQL, [_remove_row(path)])])
+
+
+    def remove_directory(self, path):
+        """
+        remove all books in a directory and its subdirectories
+
+        path - absolute path to the directory
+
+        """
+        self._write([(_DELETE_DIR_SQL, [_remove_dir_row(path)])])
 
 
     def clear(self):
         """
         clear the entire database
         """
+        self._write([(u"delete from books", [()])])
+
+
+    def generation(self):
+        """
+        return a value that changes whenever books are added, changed or
+        removed, through this object or through any other connection to
+        the database file. used to tell if cached results are stale.
+        the counter of the changes table is bumped by triggers in the same
+        transaction as the change, so every connection sees the same value.
+        """
         cursor = self._dbcon.cursor()
-        cursor.execute(u"delete from books")
-        self._dbcon.commit()
+        cursor.execute(u"select counter from changes")
+        counter = cursor.fetchone()[0]
         cursor.close()
+        return (self._generation, self._pool.inode(), counter)
 
 
-    def search(self, term):
+    def start_rebuild(self):
         """
-        search the database for books containing the search term in the
-        filename, title or author column
+        return an empty BookDatabase in a shadow file next to this one, to
+        rebuild the library without touching the books that are searched
+        meanwhile. the indexes on books and the full-text index are left
+        out until finish_rebuild(), building them at once is faster than
+        updating them for every book. an old shadow file is replaced.
+        the content index and the file hashes of find_duplicates() start
+        empty as well, book ids change so they can't be carried over. see
+        has_content().
+        """
+        path = self._dbfile + u'.rebuild'
+        _remove_database(path)
+        shadow = BookDatabase(path.encode('utf8'), stats=self.stats)
+        cursor = shadow._dbcon.cursor()
+        cursor.execute(u"""select type, name, sql from sqlite_master
+                           where tbl_name = 'books' and sql is not null and
+                           (type = 'index' and name != 'books_path_filename'
+                            or name like 'books_fts_%')""")
+        shadow._deferred = cursor.fetchall()
+        for kind, name, _ in shadow._deferred:
+            cursor.execute(u"drop %s %s" % (kind, name))
+        shadow._dbcon.commit()
+        cursor.close()
+        return shadow
+
+
+    def finish_rebuild(self, shadow):
+        """
+        create the indexes of a shadow database returned by start_rebuild()
+        and let sqlite analyze it, then move it over this database. readers
+        (in this or other processes) open the new file with their next
+        query. shadow is closed.
+        """
+        cursor = shadow._dbcon.cursor()
+        for _, _, sql in shadow._deferred:
+            cursor.execute(sql)
+        if shadow._fts:
+            cursor.execute(u"""insert into books_fts (books_fts)
+                               values ('rebuild')""")
+        cursor.execute(u"analyze")
+        shadow._dbcon.commit()
+        cursor.close()
+        shadow.close() # the last connection moves the WAL into the file
+        for attempt in range(WRITE_RETRIES):
+            if self._replace_file(shadow._dbfile):
+                break
+            time.sleep(0.1 * 2 ** attempt)
+        else:
+            raise NgLibError('the database stayed busy, the rebuild in %s '
+                             'was not installed' % shadow._dbfile)
+        self._generation += 1
+
+
+    def _replace_file(self, path):
+        """
+        move the database file path over this one. the connections of the
+        pool are closed and the WAL file of this database is emptied first,
+        and writers are kept out while the file is replaced. no connection
+        to the old file is left to write to (or delete) the WAL file that
+        the new file uses next. return False if another connection got in
+        the way.
+        """
+        self._pool.close_all()
+        con = self._pool.connect()
+        con.isolation_level = None
+        try:
+            con.execute(u"pragma wal_checkpoint(truncate)")
+            con.execute(u"begin immediate")
+            try:
+                if os.path.exists(self._dbfile + u'-wal') and \
+                   os.path.getsize(self._dbfile + u'-wal'):
+                    return False # written after the checkpoint
+                os.rename(path, self._dbfile)
+                return True
+            finally:
+                con.execute(u"rollback")
+        except sqlite3.OperationalError, e:
+            if _is_busy(e):
+                return False
+            raise
+        finally:
+            con.close()
+
+
+    def abort_rebuild(self, shadow):
+        """
+        close and delete a shadow database returned by start_rebuild()
+        """
+        shadow.close()
+        _remove_database(shadow._dbfile)
+
+
+    def get_file_states(self):
+        """
+        return a dict mapping (path, filename) of every book in the database
+        to a (size, mtime, inode) tuple. the values are None for books that
+        were added without file state.
+        """
+        cursor = self._dbcon.cursor()
+        cursor.execute(u"select path, filename, size, mtime, inode from books")
+        states = {}
+        for row in cursor:
+            states[(row[0], row[1])] = row[2:]
+        cursor.close()
+        return states
+
+
+    def books_to_index(self):
+        """
+        return a list of (book id, absolute path, mtime) for all pdf files
+        whose content hasn't been indexed since they were added or changed
+        """
+        cursor = self._dbcon.cursor()
+        cursor.execute(u"""select b.id, b.path, b.filename, b.mtime
+                           from books b left join content_books c
+                           on c.book_id = b.id
+                           where (c.book_id is null or c.mtime is not b.mtime)
+                           and lower(b.filename) like '%.pdf'""")
+        result = [(row[0], os.path.join(row[1], row[2]), row[3])
+                  for row in cursor]
+        cursor.close()
+        return result
+
+
+    def has_content(self):
+        """
+        return True if the text of any book has been indexed
+        """
+        cursor = self._dbcon.cursor()
+        cursor.execute(u"select 1 from content_books limit 1")
+        found = cursor.fetchone() is not None
+        cursor.close()
+        return found
+
+
+    def add_content(self, contents):
+        """
+        add the terms found in books to the content index, replacing what
+        was indexed for them before. books that were changed or removed
+        since books_to_index() returned them are skipped.
+
+        contents - iterable of (book id, mtime, terms) tuples, where terms is
+                   a dict mapping unicode terms to their frequency
+        """
+        with self._pool.writing() as con:
+            cursor = con.cursor()
+            for bid, mtime, terms in contents:
+                cursor.execute(u"""delete from content_postings
+                                   where book_id = ?""", (bid,))
+                cursor.execute(u"""delete from content_books
+                                   where book_id = ?""", (bid,))
+                cursor.execute(u"""insert into content_books
+                                   select ?, ?, ? where exists
+                                   (select 1 from books where id = ?
+                                    and mtime is ?)""",
+                               (bid, mtime, sum(terms.values()), bid, mtime))
+                if not cursor.rowcount or not terms:
+                    continue
+                cursor.executemany(u"""insert or ignore into content_terms
+                                       (term) values (?)""",
+                                   [(t,) for t in terms])
+                ids = self._term_ids(cursor, terms)
+                cursor.executemany(u"""insert into content_postings
+                                       values (?, ?, ?)""",
+                                   [(ids[t], bid, tf)
+                                    for t, tf in terms.items()])
+            con.commit()
+            cursor.close()
+        self._generation += 1
+
+
+    def search_content(self, term, limit=None):
+        """
+        search the content index for books containing all words of the
+        search term, best matches first (ranked by tf-idf)
 
         term - the search term
+        limit - optional, maximum number of books to return
 
         """
-        term = u'%' + term.decode('utf8') + u'%'
+        words = set(content_terms(term.decode('utf8')))
+        if not words:
+            return []
         cursor = self._dbcon.cursor()
-        t = (term, term, term)
-        sql = u"""select rowid, * from books where (title like ?) or
-                  (author like ?) or (filename like ?)"""
-        cursor.execute(sql, t)
-        result = cursor.fetchall()
+        ids = self._term_ids(cursor, words)
+        if len(ids) < len(words):
+            cursor.close()
+            return []
+
+        cursor.execute(u"select count(*) from content_books")
+        total = cursor.fetchone()[0]
+        sql = u"""select term_id, book_id, tf from content_postings
+                  where term_id in (%s)""" % u', '.join(u'?' * len(ids))
+        cursor.execute(sql, ids.values())
+        postings = {}
+        docfreq = {}
+        for term_id, bid, tf in cursor:
+            postings.setdefault(bid, []).append((term_id, tf))
+            docfreq[term_id] = docfreq.get(term_id, 0) + 1
+
+        scores = []
+        for bid, hits in postings.items():
+            if len(hits) < len(ids):
+                continue
+            score = sum((1 + math.log(tf)) *
+                        math.log(1 + float(total) / docfreq[term_id])
+                        for term_id, tf in hits)
+            scores.append((-score, bid))
+        if limit is None:
+            scores.sort()
+        else:
+            scores = heapq.nsmallest(limit, scores)
         cursor.close()
-        return [self._book_from_query_result(x) for x in result]
+        return self._get_by_ids([bid for _, bid in scores])
+
 
+    def find_duplicates(self, workers=None, min_size=1):
+        """
+        return the groups of books whose files have the same content as
+        lists of Books (ordered by path), the biggest files first.
+        files are grouped by size first, then by a hash of their first and
+        last 64 KiB, and only files that still have a match are hashed
+        completely. the files are hashed in a pool of worker processes
+        (see FileHasher). hashes are stored with the size, mtime and inode
+        of the file, so later calls only hash new and changed files.
+
+        workers - number of hashing processes, defaults to the number of cpus
+        min_size - ignore files smaller than this many bytes
 
-    def get_all(self):
         """
-        return all books in the database
+        return find_duplicates([self], workers, min_size)
+
+
+    def _file_sizes(self, min_size):
+        """
+        return (size, number of books) for the sizes of the books that are
+        at least min_size bytes, see find_duplicates()
         """
         cursor = self._dbcon.cursor()
-        cursor.execute(u"select rowid,* from books")
-        result = cursor.fetchall()
+        cursor.execute(u"""select size, count(*) from books where size >= ?
+                           group by size""", (min_size,))
+        sizes = cursor.fetchall()
+        cursor.close()
+        return sizes
+
+
+    def _duplicate_candidates(self, min_size, sizes=None):
+        """
+        return a dict of book id -> [path, size, state, partial hash, full
+        hash] for the books that might have a copy, see find_duplicates().
+        stored hashes are only used if the file hasn't changed since.
+
+        min_size - ignore files smaller than this many bytes
+        sizes - optional, set of the sizes that have copies. by default
+                the sizes of more than one book in this database
+        """
+        cursor = self._dbcon.cursor()
+        if sizes is None:
+            where = u"""b.size in (select size from books where size >= ?
+                                   group by size having count(*) > 1)"""
+        else:
+            where = u"b.size >= ?"
+        cursor.execute(u"""select b.id, b.path, b.filename, b.size, b.mtime,
+                                  b.inode, h.size, h.mtime, h.inode,
+                                  h.partial, h.full
+                           from books b left join file_hashes h
+                           on h.book_id = b.id
+                           where %s""" % where, (min_size,))
+        files = {}
+        for row in cursor:
+            if sizes is not None and row[3] not in sizes:
+                continue
+            state = row[3:6]
+            hashes = tuple(row[6:9]) == tuple(state) and row[9:11] or \
+                     (None, None)
+            files[row[0]] = [os.path.join(row[1], row[2]).encode('utf8'),
+                             row[3], state] + list(hashes)
+        cursor.close()
+        return files
+
+
+    def search(self, term, content=False, after=None, limit=None,
+               fuzzy=False, sort=SORT_TITLE):
+        """
+        search the database for books matching the search term in the
+        filename, title or author column and return them as a list,
+        ordered by title. see iter_search().
+
+        term - the search term
+        content - search the content index instead, see search_content()
+        after - optional, only return books that come after this book
+        limit - optional, maximum number of books to return
+        fuzzy - tolerate typos, see fuzzy_search(). after is ignored
+        sort - SORT_TITLE or SORT_RELEVANCE (see rank_search(), after is
+               ignored)
+
+        """
+        with self.stats.timer('query'):
+            if content:
+                books = self.search_content(term, limit)
+            elif fuzzy:
+                books = self.fuzzy_search(term, limit or DEFAULT_FUZZY_LIMIT)
+            elif _check_sort(sort) == SORT_RELEVANCE:
+                books = self.rank_search(term, limit)
+            else:
+                books = list(self.iter_search(term, after, limit))
+        self.stats.count('rows_read', len(books))
+        return books
+
+
+    def iter_search(self, term, after=None, limit=None):
+        """
+        generate the books matching the search query, ordered by title
+        (ignoring case). see parse_query() for the syntax, a query of plain
+        words matches books that have all of them in the filename, title or
+        author column.
+        if sqlite has FTS5, words have to match the start of a word in the
+        column (case and diacritics are ignored) and text in double quotes
+        has to match as a phrase. otherwise words are matched as substrings.
+
+        term - the search term
+        after - optional, only return books that come after this book,
+                usually the last book of the previous page
+        limit - optional, maximum number of books to return
+
+        """
+        rows = self._iter_search_rows(term, after, limit)
+        return (self._book_from_query_result(row) for row in rows)
+
+
+    def book_list(self, term=None, after=None, limit=None, sort=SORT_TITLE):
+        """
+        return a BookList of all books or of the books matching the search
+        term, ordered by title. see iter_search() for the arguments.
+
+        sort - SORT_TITLE or SORT_RELEVANCE (see rank_search(), after is
+               ignored)
+        """
+        with self.stats.timer('query'):
+            if term is None:
+                rows = self._iter_rows(u"1", (), after, limit)
+            elif _check_sort(sort) == SORT_RELEVANCE:
+                rows = [row for _, row in self._scored_rows(term, limit)]
+            else:
+                rows = self._iter_search_rows(term, after, limit)
+            books = BookList()
+            for row in rows:
+                books.append(row[0], row[1], row[2], row[3], row[4], row[8])
+        self.stats.count('rows_read', len(books))
+        return books
+
+
+    def rank_search(self, term, limit=None, scores=False):
+        """
+        return the books matching the search query as a list, best matches
+        first. books are scored with BM25 over title, author and filename,
+        a hit in the title counts more than one in the author or filename
+        and a whole word more than one that only starts with a search word.
+        books whose title is or starts with the search words get a boost.
+        while the matches are scored only the best limit books are kept
+        (in a heap), so the cost of a search hardly depends on the limit.
+        queries without words (e.g. only ext:pdf) are ordered by title.
+
+        term - the search term
+        limit - optional, maximum number of books to return
+        scores - return (score, Book) tuples instead of Books, e.g. for
+                 merging rankings
+
+        """
+        ranked = self._scored_rows(term, limit)
+        if scores:
+            return [(score, self._book_from_query_result(row))
+                    for score, row in ranked]
+        return [self._book_from_query_result(row) for _, row in ranked]
+
+
+    def fuzzy_search(self, term, limit=DEFAULT_FUZZY_LIMIT,
+                     max_distance=None):
+        """
+        search for books whose title, author or filename contain words
+        similar to every word of the search term, closest matches first.
+        the words are looked up in a trigram index of all words in the
+        database, which is built on the first call and after changes.
+
+        term - the search term
+        limit - maximum number of books to return
+        max_distance - optional, maximum number of typos per word. by
+                       default 1 for words up to 4 letters, 2 for longer
+
+        """
+        words = _fold_words(term.decode('utf8'))
+        if not words:
+            return []
+        index = self._trigram_index()
+        alternatives = [] # for every word of the term: {similar word: typos}
+        for word in words:
+            distance = max_distance
+            if distance is None:
+                distance = len(word) <= 4 and 1 or 2
+            similar = index.similar(word, distance, limit=10)
+            if not similar:
+                return []
+            alternatives.append(dict((w, d) for d, w in similar))
+
+        if self._fts:
+            query = u' AND '.join(
+                u'(%s)' % u' OR '.join(u'"%s"' % w for w in group)
+                for group in alternatives)
+            where = u"""id in (select rowid from books_fts
+                              where books_fts match ?)"""
+            args = [query]
+        else:
+            clauses = []
+            args = []
+            for group in alternatives:
+                clauses.append(u'(%s)' % u' or '.join(
+                    [u"title like ? or author like ? or filename like ?"] *
+                    len(group)))
+                for w in group:
+                    args += [u'%' + w + u'%'] * 3
+            where = u' and '.join(clauses)
+
+        def typos(row):
+            found = set(_fold_words(u' '.join(c or u'' for c in row[1:4])))
+            total = 0
+            for group in alternatives:
+                matches = [d for w, d in group.items() if w in found]
+                if not matches:
+                    return None # only matched as a substring
+                total += min(matches)
+            return total
+
+        ranked = []
+        for row in self._iter_rows(where, args, None, None):
+            score = typos(row)
+            if score is not None:
+                ranked.append((score, (row[1] or u'').lower(), row[0], row))
+        return [self._book_from_query_result(x[-1])
+                for x in heapq.nsmallest(limit, ranked)]
+
+
+    def get_all(self, after=None, limit=None):
+        """
+        return all books in the database as a list, ordered by title.
+        see iter_all().
+        """
+        return list(self.iter_all(after, limit))
+
+
+    def iter_all(self, after=None, limit=None):
+        """
+        generate all books in the database, ordered by title (ignoring case)
+
+        after - optional, only return books that come after this book,
+                usually the last book of the previous page
+        limit - optional, maximum number of books to return
+
+        """
+        rows = self._iter_rows(u"1", (), after, limit)
+        return (self._book_from_query_result(row) for row in rows)
+
+
+    def matcher(self, term):
+        """
+        return a function that takes the title, author and filename of a
+        book and returns True if the book matches the search term the way
+        iter_search() would match it. used to narrow down results that are
+        already in memory. returns None if the term is more than a list of
+        words (see is_simple()).
+
+        term - the search term
+        """
+        term = term.decode('utf8')
+        if not is_simple(term):
+            return None
+        if self._fts:
+            return _fts_matcher(term)
+        return _like_matcher(term)
+
+
+    def ranker(self, term):
+        """
+        return a function that takes the title, author and filename of a
+        book and returns its relevance for the search term the way
+        rank_search() scores it. used with matcher() to narrow down and
+        re-rank results that are already in memory. returns None if the
+        term is more than a list of words or has nothing to rank by.
+
+        term - the search term
+        """
+        term = term.decode('utf8')
+        if not is_simple(term):
+            return None
+        score = self._scorer(text_terms(parse_query(term)))
+        if score is None:
+            return None
+        return lambda title, author, filename: \
+            score((None, title, author, filename))
+
+
+    def explain(self, term):
+        """
+        return a list of lines describing how a search query is run: the
+        parsed query, the SQL and the query plan chosen by sqlite
+
+        term - the search term
+        """
+        node = parse_query(term.decode('utf8'))
+        where, args = compile_query(node, self._fts)
+        sql = u"""select %s from books where %s
+                  order by title collate nocase, id""" % (_BOOK_COLUMNS,
+                                                         where)
+        lines = [u'query: %s' % describe(node),
+                 u'sql: %s' % u' '.join(sql.split()),
+                 u'arguments: %s' % u', '.join(repr(a) for a in args),
+                 u'plan:']
+        cursor = self._dbcon.cursor()
+        cursor.execute(u"explain query plan " + sql, args)
+        lines += [u'    %s' % row[-1] for row in cursor]
         cursor.close()
-        return [self._book_from_query_result(x) for x in result]
+        return lines
+
+
+    def set_cancel_check(self, check, interval=10000):
+        """
+        abort running queries of the calling thread when check() returns
+        True. searches that are aborted raise SearchCancelled.
+
+        check - callable without arguments, None removes the check
+        interval - number of sqlite instructions between calls of check()
+        """
+        if check is None:
+            self._dbcon.set_progress_handler(None, interval)
+        else:
+            self._dbcon.set_progress_handler(lambda: bool(check()), interval)
+
+
+    def interrupt(self):
+        """
+        abort the searches that are currently running, for use from
+        another thread. the searches raise SearchCancelled, writes aren't
+        interrupted.
+        """
+        self._pool.interrupt()
+
+
+    def _write(self, statements):
+        """
+        run statements in one transaction. if another connection holds the
+        write lock for longer than the busy timeout, the transaction is
+        retried a few times with growing pauses. the transaction is rolled
+        back on any error, so the connection doesn't keep the write lock.
+
+        statements - list of (sql, rows) for executemany()
+        """
+        with self._pool.writing() as con:
+            for attempt in range(WRITE_RETRIES):
+                cursor = con.cursor()
+                written = 0
+                try:
+                    with self.stats.timer('db_write'):
+                        for sql, rows in statements:
+                            cursor.executemany(sql, rows)
+                            written += max(cursor.rowcount, 0)
+                    with self.stats.timer('db_commit'):
+                        con.commit()
+                    self._generation += 1
+                    self.stats.count('rows_written', written)
+                    return
+                except Exception, e:
+                    con.rollback()
+                    if not isinstance(e, sqlite3.OperationalError) or \
+                       not _is_busy(e) or attempt == WRITE_RETRIES - 1:
+                        raise
+                    self.stats.count('write_retries')
+                finally:
+                    cursor.close()
+                time.sleep(0.1 * 2 ** attempt)
+
+
+    def _get_by_ids(self, bids):
+        """
+        return the Books with the given ids in the same order, ids that
+        aren't in the database are skipped
+        """
+        books = {}
+        cursor = self._dbcon.cursor()
+        for i in range(0, len(bids), 500):
+            chunk = bids[i:i+500]
+            sql = u"select %s from books where id in (%s)" % \
+                  (_BOOK_COLUMNS, u', '.join(u'?' * len(chunk)))
+            cursor.execute(sql, chunk)
+            for row in cursor:
+                books[row[0]] = self._book_from_query_result(row)
+        cursor.close()
+        return [books[bid] for bid in bids if bid in books]
+
+
+    def _store_hashes(self, rows):
+        """
+        store the hashes of files, see find_duplicates()
+
+        rows - list of (book id, size, mtime, inode, partial, full)
+        """
+        with self._pool.writing() as con:
+            con.executemany(u"""insert or replace into file_hashes
+                                values (?, ?, ?, ?, ?, ?)""", rows)
+            con.commit()
 
 
     def get_by_id(self, book_id):
@@ -188,29 +1262,654 @@ class BookDatabase(object):
 
         book_id - primary key of the book in the db
         """
-        if not isinstance(book_id, str):
-            book_id = str(book_id)
-
         cursor = self._dbcon.cursor()
-        sql = u"select rowid,* from books where rowid = %s" % book_id
-        cursor.execute(sql)
+        sql = u"select %s from books where id = ?" % _BOOK_COLUMNS
+        cursor.execute(sql, (int(book_id),))
         result = cursor.fetchall()
         cursor.close()
         return self._book_from_query_result(result[0])
 
 
     def _create_db(self):
+        """
+        create the database or bring an existing one up to the current
+        schema version. every migration runs in its own transaction.
+        """
+        con = self._pool.connect() # writable, also for read only pools
+        con.isolation_level = None # we handle transactions here
+        cursor = con.cursor()
+        try:
+            cursor.execute(u"pragma journal_mode = wal")
+            version = self._schema_version(cursor)
+            for version in range(version, SCHEMA_VERSION):
+                cursor.execute(u"begin immediate")
+                try:
+                    _MIGRATIONS[version](cursor)
+                    cursor.execute(u"update schema_version set version = ?",
+                                   (version + 1,))
+                    cursor.execute(u"commit")
+                except:
+                    cursor.execute(u"rollback")
+                    raise
+            self._fts = self._create_fts(cursor)
+        finally:
+            cursor.close()
+            con.close()
+
+
+    def _schema_version(self, cursor):
+        """
+        return the schema version of the database, creating the version
+        table if necessary. databases of nglib 0.2 have no version table
+        and are version 1.
+        """
+        cursor.execute(u"""select name from sqlite_master
+                           where type = 'table' and
+                           name in ('books', 'schema_version')""")
+        tables = [row[0] for row in cursor.fetchall()]
+        if 'schema_version' in tables:
+            cursor.execute(u"select version from schema_version")
+            return cursor.fetchone()[0]
+
+        version = 'books' in tables and 1 or 0
+        cursor.execute(u"create table schema_version (version integer)")
+        cursor.execute(u"insert into schema_version values (?)", (version,))
+        return version
+
+
+    def _create_fts(self, cursor):
+        """
+        create the full-text index for the books table and the triggers
+        that keep it in sync, unless it already exists.
+        return False if sqlite was built without FTS5.
+        """
+        cursor.execute(u"""select count(*) from sqlite_master
+                           where type = 'table' and name = 'books_fts'""")
+        if cursor.fetchone()[0]:
+            return True
+
+        for tokenizer in _FTS_TOKENIZERS:
+            try:
+                cursor.execute(u"""create virtual table books_fts using
+                                   fts5(title, author, filename,
+                                        content='books', content_rowid='id',
+                                        tokenize='%s')
+                               """ % tokenizer)
+                break
+            except sqlite3.OperationalError:
+                continue
+        else:
+            return False
+
+        for trigger in _FTS_TRIGGERS:
+            cursor.execute(trigger)
+        cursor.execute(u"insert into books_fts (books_fts) values ('rebuild')")
+        return True
+
+
+    def _term_ids(self, cursor, terms):
+        """
+        return a dict mapping terms to their ids in content_terms, terms
+        that aren't indexed are missing
+        """
+        terms = list(terms)
+        ids = {}
+        for i in range(0, len(terms), 500):
+            chunk = terms[i:i+500]
+            sql = u"select id, term from content_terms where term in (%s)" % \
+                  u', '.join(u'?' * len(chunk))
+            cursor.execute(sql, chunk)
+            for tid, term in cursor:
+                ids[term] = tid
+        return ids
+
+
+    def _trigram_index(self):
+        """
+        return a TrigramIndex of the words in title, author and filename of
+        all books, rebuilding it if the database changed
+        """
+        generation = self.generation()
+        if self._trigrams is None or self._trigrams[0] != generation:
+            index = TrigramIndex()
+            cursor = self._dbcon.cursor()
+            cursor.execute(u"select title, author, filename from books")
+            for row in cursor:
+                for column in row:
+                    for word in _fold_words(column or u''):
+                        index.add(word)
+            cursor.close()
+            self._trigrams = (generation, index)
+        return self._trigrams[1]
+
+
+    def _iter_search_rows(self, term, after, limit):
+        where, args = compile_query(parse_query(term.decode('utf8')),
+                                    self._fts)
+        return self._iter_rows(where, args, after, limit)
+
+
+    def _scored_rows(self, term, limit):
+        """
+        return (score, row) for the books matching the search query, best
+        matches first. see rank_search().
+        """
+        node = parse_query(term.decode('utf8'))
+        score = self._scorer(text_terms(node))
+        if score is None:
+            return [(0.0, row)
+                    for row in self._iter_search_rows(term, None, limit)]
+        where, args = compile_query(node, self._fts)
+        rows = self._iter_rows(where, args, None, None, ordered=False)
+        scored = ((-score(row), (row[1] or u'').lower(), row[0], row)
+                  for row in rows)
+        if limit is None:
+            ranked = sorted(scored)
+        else:
+            ranked = heapq.nsmallest(limit, scored)
+        return [(-x[0], x[-1]) for x in ranked]
+
+
+    def _scorer(self, terms):
+        """
+        return a function that returns the relevance of a book row for the
+        text terms of a query, None if there are no terms to rank by.
+        idf and average field lengths are taken from the whole database.
+        """
+        fields = range(len(_FIELD_WEIGHTS))
         cursor = self._dbcon.cursor()
-        cursor.execute(u"""create table books
-                           (title text, author text, filename text, path text)
-                       """)
-        self._dbcon.commit()
+        cursor.execute(u"""select count(*), avg(length(title)),
+                                  avg(length(author)), avg(length(filename))
+                           from books""")
+        row = cursor.fetchone()
+        total = row[0]
+        lengths = [max(length or 0.0, 1.0) for length in row[1:]]
+        weighted = [] # (words, prefix, fields, idf) for every term
+        for term in terms:
+            words = _fold_words(term.text)
+            if not words:
+                continue
+            where, args = compile_query(term, self._fts)
+            cursor.execute(u"select count(*) from books where %s" % where,
+                           args)
+            found = cursor.fetchone()[0]
+            idf = math.log(1 + (total - found + 0.5) / (found + 0.5))
+            columns = term.field is None and fields or \
+                      [TEXT_FIELDS.index(term.field)]
+            weighted.append((words, not term.phrase, columns, idf))
         cursor.close()
+        if not weighted:
+            return None
+        query = [w for words, _, _, _ in weighted for w in words]
+
+        def score(row):
+            texts = [row[1] or u'', row[2] or u'', row[3] or u'']
+            words = [_fold_words(text) for text in texts]
+            result = 0.0
+            for tokens, prefix, columns, idf in weighted:
+                for i in columns:
+                    tf = _phrase_hits(words[i], tokens, prefix)
+                    if not tf:
+                        continue
+                    norm = 1 - _BM25_B + _BM25_B * len(texts[i]) / lengths[i]
+                    result += idf * _FIELD_WEIGHTS[i] * tf * (_BM25_K1 + 1) \
+                              / (tf + _BM25_K1 * norm)
+            if words[0] == query:
+                result *= _EXACT_BOOST
+            elif _has_phrase(words[0][:len(query)], query, True):
+                result *= _START_BOOST
+            return result
+        return score
+
+
+    def _iter_rows(self, where, args, after, limit, ordered=True):
+        """
+        generate the rows of the books matching a where clause (in
+        _BOOK_COLUMNS order), ordered by title and id
+        so pages can be fetched with a (title, id) keyset instead of an
+        offset. rows are read from the cursor as they are consumed.
+        ordered - False to leave out the order by, after has to be None
+        """
+        args = list(args)
+        if after is not None:
+            where = u"""(%s) and title >= ? collate nocase and
+                        (title > ? collate nocase or id > ?)""" % where
+            args += [after.title, after.title, after.bid]
+        sql = u"select %s from books where %s" % (_BOOK_COLUMNS, where)
+        if ordered:
+            sql += u" order by title collate nocase, id"
+        sql += u" limit ?"
+        args.append(limit is None and -1 or limit)
+        cursor = self._dbcon.cursor()
+        try:
+            cursor.execute(sql, args)
+            for row in cursor:
+                yield row
+        except sqlite3.OperationalError, e:
+            if 'interrupted' in str(e):
+                raise SearchCancelled('search cancelled')
+            raise
+        finally:
+            cursor.close()
 
 
     def _book_from_query_result(self, result):
-        filename = result[3]
-        filetype = filename[filename.rfind('.')+1:]
         return Book(bid=result[0], title=result[1], author=result[2],
-                    filename=filename, filetype=filetype, path=result[4])
+                    filename=result[3], path=result[4], pages=result[8] or 0,
+                    filetype=result[9], size=result[5])
+
+
+class BatchWriter(object):
+    """
+    collects changes to a BookDatabase and writes them with executemany(),
+    committing once per batch instead of once per book.
+    use it as a context manager, pending changes are written when the
+    block is left and discarded if it is left with an error.
+    """
+    def __init__(self, database, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        create a BatchWriter
+
+        database - the BookDatabase to write to
+        batch_size - how many changes to collect per transaction
+        """
+        self._db = database
+        self.batch_size = batch_size
+        self._groups = [] # [sql, rows] in the order the changes were made
+        self._pending = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None or not issubclass(exc_type, Exception):
+            self.flush()
+        else:
+            self._groups = []
+            self._pending = 0
+            self._db._dbcon.rollback()
+        return False
+
+
+    def add(self, path, title, author, stat=None, pages=0):
+        """
+        add an ebook, see BookDatabase.add()
+        """
+        self._queue(_INSERT_SQL, _add_row(path, title, author, stat, pages))
+
+
+    def update(self, path, title, author, stat=None, pages=0):
+        """
+        update an ebook, see BookDatabase.update()
+        """
+        self._queue(_UPDATE_SQL,
+                    _update_row(path, title, author, stat, pages))
+
+
+    def remove(self, path):
+        """
+        remove an ebook, see BookDatabase.remove()
+        """
+        self._queue(_DELETE_SQL, _remove_row(path))
+
+
+    def remove_directory(self, path):
+        """
+        remove the books in a directory tree, see
+        BookDatabase.remove_directory()
+        """
+        self._queue(_DELETE_DIR_SQL, _remove_dir_row(path))
+
+
+    def flush(self):
+        """
+        write all pending changes in one transaction
+        """
+        if not self._pending:
+            return
+        self._db._write(self._groups)
+        self._groups = []
+        self._pending = 0
+
+
+    def _queue(self, sql, row):
+        if self._groups and self._groups[-1][0] is sql:
+            self._groups[-1][1].append(row)
+        else:
+            self._groups.append([sql, [row]])
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+
+def _migrate_1(cursor):
+    """
+    the books table of nglib 0.2
+    """
+    cursor.execute(u"""create table books
+                       (title text, author text, filename text, path text)""")
+
+
+def _migrate_2(cursor):
+    """
+    give books an integer primary key (the old rowid), columns for file
+    state and page count and a unique index on (path, filename). add the
+    content index. duplicate files are dropped.
+    """
+    cursor.execute(u"pragma table_info(books)")
+    existing = [row[1] for row in cursor.fetchall()]
+    columns = [u'title', u'author', u'filename', u'path', u'size', u'mtime',
+               u'inode', u'pages']
+    copied = [c in existing and c or u'null' for c in columns]
+
+    cursor.execute(u"drop table if exists books_fts") # rebuilt on open
+    cursor.execute(u"""create table books_new
+                       (id integer primary key, title text, author text,
+                        filename text, path text, size integer, mtime real,
+                        inode integer, pages integer)""")
+    cursor.execute(u"""create unique index books_path_filename
+                       on books_new (path, filename)""")
+    cursor.execute(u"insert or ignore into books_new select rowid, %s "
+                   u"from books order by rowid" % u', '.join(copied))
+    cursor.execute(u"drop table books")
+    cursor.execute(u"alter table books_new rename to books")
+
+    for sql in _CONTENT_TABLES:
+        cursor.execute(sql)
+    cursor.execute(u"""delete from content_postings
+                       where book_id not in (select id from books)""")
+    cursor.execute(u"""delete from content_books
+                       where book_id not in (select id from books)""")
+
+
+def _migrate_3(cursor):
+    """
+    index books by title for ordered, paginated results
+    """
+    cursor.execute(u"""create index books_title
+                       on books (title collate nocase, id)""")
+
+
+def _migrate_4(cursor):
+    """
+    add the lower case file extension as an indexed column for ext: queries
+    """
+    cursor.execute(u"alter table books add column filetype text")
+    cursor.execute(u"select id, filename from books")
+    rows = [(_filetype(filename or u''), bid) for bid, filename in cursor]
+    cursor.executemany(u"update books set filetype = ? where id = ?", rows)
+    cursor.execute(u"create index books_filetype on books (filetype)")
+
+
+def _migrate_5(cursor):
+    """
+    add the table of file hashes for finding duplicates and index books by
+    size, which is compared first
+    """
+    cursor.execute(u"""create table file_hashes
+                       (book_id integer primary key, size integer,
+                        mtime real, inode integer, partial text, full text)""")
+    cursor.execute(u"""create trigger file_hashes_delete after delete on books
+                       begin
+                           delete from file_hashes where book_id = old.id;
+                       end""")
+    cursor.execute(u"create index books_size on books (size)")
+
+
+def _migrate_6(cursor):
+    """
+    count the changes to books and the content index in a table of its
+    own, bumped by triggers, see generation()
+    """
+    cursor.execute(u"create table changes (counter integer)")
+    cursor.execute(u"insert into changes values (0)")
+    for table in (u'books', u'content_books'):
+        for event in (u'insert', u'update', u'delete'):
+            cursor.execute(u"""create trigger %s_changes_%s
+                               after %s on %s
+                               begin
+                                   update changes set counter = counter + 1;
+                               end""" % (table, event, event, table))
+
+
+# _MIGRATIONS[n] upgrades a database from schema version n to n + 1
+_MIGRATIONS = [_migrate_1, _migrate_2, _migrate_3, _migrate_4, _migrate_5,
+               _migrate_6]
+
+SCHEMA_VERSION = len(_MIGRATIONS)
+
+
+def _fts_matcher(term):
+    """
+    return a function that matches title, author and filename against the
+    words of the search term like the FTS5 query of compile_query() does
+    """
+    parts = []
+    for word in term.split():
+        tokens = _fold_words(word)
+        if tokens:
+            parts.append((tokens, True))
+
+    def match(title, author, filename):
+        columns = [_fold_words(c or u'') for c in (title, author, filename)]
+        for tokens, prefix in parts:
+            for words in columns:
+                if _has_phrase(words, tokens, prefix):
+                    break
+            else:
+                return False
+        return True
+    return match
+
+
+def _like_matcher(term):
+    """
+    return a function that matches title, author and filename against the
+    words of the search term like the LIKE query of compile_query() does
+    """
+    searches = []
+    for word in term.split():
+        if not _WORD_RE.search(word):
+            continue
+        pattern = u''.join(c == u'%' and u'.*' or c == u'_' and u'.' or
+                           re.escape(c) for c in word)
+        searches.append(re.compile(pattern, re.IGNORECASE | re.DOTALL).search)
+
+    def match(title, author, filename):
+        for search in searches:
+            if not (search(title or u'') or search(author or u'') or
+                    search(filename or u'')):
+                return False
+        return True
+    return match
+
+
+def _fold_words(text):
+    """
+    split text into lower case words without diacritics, the way the
+    unicode61 tokenizer does
+    """
+    text = text.lower()
+    try:
+        text.encode('ascii')
+    except UnicodeError:
+        text = unicodedata.normalize('NFKD', text)
+        text = u''.join(c for c in text if not unicodedata.combining(c))
+    return _WORD_RE.findall(text)
+
+
+def _has_phrase(words, tokens, prefix):
+    """
+    return True if tokens appear in words in a row. if prefix is True the
+    last token only has to match the start of a word.
+    """
+    last = len(tokens) - 1
+    for i in range(len(words) - last):
+        if words[i:i+last] != tokens[:last]:
+            continue
+        if words[i+last] == tokens[last] or \
+           (prefix and words[i+last].startswith(tokens[last])):
+            return True
+    return False
+
+
+def _phrase_hits(words, tokens, prefix):
+    """
+    return how often tokens appear in words in a row, counting a match
+    whose last word only starts with the last token as _PREFIX_HIT. see
+    _has_phrase().
+    """
+    hits = 0.0
+    last = len(tokens) - 1
+    for i in range(len(words) - last):
+        if words[i:i+last] != tokens[:last]:
+            continue
+        if words[i+last] == tokens[last]:
+            hits += 1
+        elif prefix and words[i+last].startswith(tokens[last]):
+            hits += _PREFIX_HIT
+    return hits
+
+
+def find_duplicates(databases, workers=None, min_size=1):
+    """
+    return the groups of books whose files have the same content in
+    several databases, e.g. those of all library roots, so that a file can
+    have its copy in another root. see BookDatabase.find_duplicates(), the
+    hashes are stored in the database of every file.
+
+    databases - list of BookDatabase objects, not read only
+    workers - number of hashing processes, defaults to the number of cpus
+    min_size - ignore files smaller than this many bytes
+    """
+    sizes = None
+    if len(databases) > 1:
+        counts = {}
+        for db in databases:
+            for size, count in db._file_sizes(min_size):
+                counts[size] = counts.get(size, 0) + count
+        sizes = set(size for size, count in counts.items() if count > 1)
+    files = {} # (database, book id) -> [path, size, state, partial, full]
+    for i, db in enumerate(databases):
+        for bid, entry in db._duplicate_candidates(min_size, sizes).items():
+            files[(i, bid)] = entry
+
+    hasher = FileHasher(workers)
+    _hash_files(databases, hasher, files, files.keys(), 3)
+    partial = _same_hash(files, files.keys(), 3)
+    # for small files the partial hash already covers the whole file
+    for key in partial:
+        if files[key][1] <= 2 * PARTIAL_SIZE:
+            files[key][4] = files[key][3]
+    _hash_files(databases, hasher, files, partial, 4)
+
+    groups = {}
+    for key in _same_hash(files, partial, 4):
+        groups.setdefault((files[key][1], files[key][4]), []).append(key)
+    result = []
+    for (size, _), keys in sorted(groups.items(), reverse=True):
+        books = []
+        for i, db in enumerate(databases):
+            books += db._get_by_ids([bid for d, bid in keys if d == i])
+        result.append(sorted(books, key=lambda b: (b.path, b.filename)))
+    return result
+
+
+def _hash_files(databases, hasher, files, keys, column):
+    """
+    compute the partial (column 3) or full (column 4) hashes of the files
+    that don't have one yet and store them in the database of the file.
+    see find_duplicates() for the files dict.
+    """
+    full = column == 4
+    jobs = [(key, files[key][0], files[key][1], full)
+            for key in keys if files[key][column] is None]
+    if not jobs:
+        return
+    rows = [[] for _ in databases]
+    for key, digest in hasher.hash(jobs):
+        if digest is None:
+            continue
+        files[key][column] = digest
+        size, mtime, inode = files[key][2]
+        rows[key[0]].append((key[1], size, mtime, inode, files[key][3],
+                             files[key][4]))
+    for db, hashes in zip(databases, rows):
+        if hashes:
+            db._store_hashes(hashes)
+
+
+def _same_hash(files, bids, column):
+    """
+    return the keys of the files that share their hash in column with
+    another file of the same size. see find_duplicates() for files.
+    """
+    groups = {}
+    for bid in bids:
+        size, digest = files[bid][1], files[bid][column]
+        if digest is not None:
+            groups.setdefault((size, digest), []).append(bid)
+    return [bid for group in groups.values() if len(group) > 1
+            for bid in group]
+
+
+def _remove_database(path):
+    """
+    delete a database file and its WAL files, if they exist
+    """
+    for suffix in (u'', u'-wal', u'-shm'):
+        try:
+            os.unlink(path + suffix)
+        except OSError:
+            pass
+
+
+def _is_busy(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+def _check_sort(sort):
+    if sort not in SORT_ORDERS:
+        raise NgLibError('unknown sort order "%s", use one of %s' %
+                         (sort, ', '.join(SORT_ORDERS)))
+    return sort
+
+
+def _split_path(path):
+    path = path.decode('utf8')
+    return os.path.dirname(path), os.path.basename(path)
+
+
+def _file_state(stat):
+    if stat is None:
+        return (None, None, None)
+    return (stat.st_size, stat.st_mtime, stat.st_ino)
+
+
+def _add_row(path, title, author, stat, pages):
+    dirname, filename = _split_path(path)
+    return ((title.decode('utf8'), author.decode('utf8'), filename, dirname)
+            + _file_state(stat) + (pages, _filetype(filename)))
+
+
+def _filetype(filename):
+    return filename[filename.rfind(u'.')+1:].lower()
+
+
+def _update_row(path, title, author, stat, pages):
+    dirname, filename = _split_path(path)
+    return ((title.decode('utf8'), author.decode('utf8')) + _file_state(stat)
+            + (pages, dirname, filename))
+
+
+def _remove_row(path):
+    return _split_path(path)
+
 
+def _remove_dir_row(path):
+    path = path.decode('utf8').rstrip(os.sep)
+    prefix = path + os.sep
+    return (path, prefix, prefix)
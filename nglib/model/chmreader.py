@@ -0,0 +1,207 @@
+# encoding: utf-8
+
+"""
+@summary: reads the title of chm files from their headers
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import mmap
+import os
+import struct
+
+from nglib.model.configurationstore import NgLibError
+
+
+class ChmError(NgLibError):
+    pass
+
+
+_SYSTEM_FILE = '/#SYSTEM'
+_SYSTEM_TITLE = 3 # code of the title record in #SYSTEM
+
+
+def read_chm_metadata(path):
+    """
+    return a dict with the title of a chm file. the file is memory-mapped,
+    only the headers, the directory listing and the #SYSTEM file are read.
+    #SYSTEM is stored uncompressed, so nothing has to be decompressed.
+    the 'title' key is only present if a title was found.
+
+    path - absolute path to the chm file
+    """
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            raise ChmError('empty file')
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return ChmReader(buf).metadata()
+        finally:
+            buf.close()
+    finally:
+        f.close()
+
+
+class ChmReader(object):
+    """
+    reads files from the uncompressed content section of a chm archive
+    """
+    def __init__(self, buf):
+        """
+        parse the ITSF and ITSP headers
+
+        buf - string or mmap with the contents of a chm file
+        """
+        self._buf = buf
+        if buf[:4] != 'ITSF':
+            raise ChmError('not a chm file')
+        version = self._dword(4)
+        dir_offset, dir_length = self._qword(0x48), self._qword(0x50)
+        if version >= 3:
+            self._content_offset = self._qword(0x58)
+        else:
+            self._content_offset = dir_offset + dir_length
+
+        if buf[dir_offset:dir_offset+4] != 'ITSP':
+            raise ChmError('directory not found')
+        header_length = self._dword(dir_offset + 0x08)
+        self._chunk_size = self._dword(dir_offset + 0x10)
+        self._first_chunk = self._dword(dir_offset + 0x20, signed=True)
+        self._chunk_count = self._dword(dir_offset + 0x2c)
+        self._chunks_offset = dir_offset + header_length
+        if self._chunk_size < 0x14:
+            raise ChmError('invalid chunk size')
+
+
+    def metadata(self):
+        """
+        return a dict with the title, see read_chm_metadata()
+        """
+        result = {}
+        title = self.title()
+        if title:
+            result['title'] = title
+        return result
+
+
+    def title(self):
+        """
+        return the title stored in the #SYSTEM file, None if there is none
+        """
+        data = self.read_file(_SYSTEM_FILE)
+        pos = 4 # skip the version
+        while pos + 4 <= len(data):
+            code, length = struct.unpack('<HH', data[pos:pos+4])
+            pos += 4
+            if code == _SYSTEM_TITLE:
+                return _text(data[pos:pos+length])
+            pos += length
+        return None
+
+
+    def read_file(self, name):
+        """
+        return the contents of a file in content section 0
+
+        name - name of the file in the archive, e.g. /#SYSTEM
+        """
+        section, offset, length = self._find(name)
+        if section != 0:
+            raise ChmError('%s is compressed' % name)
+        start = self._content_offset + offset
+        if start + length > len(self._buf):
+            raise ChmError('%s is truncated' % name)
+        return self._buf[start:start+length]
+
+
+    def _find(self, name):
+        """
+        return (section, offset, length) of a file by walking the chain of
+        PMGL listing chunks
+        """
+        chunk = self._first_chunk
+        seen = set()
+        while 0 <= chunk < self._chunk_count and chunk not in seen:
+            seen.add(chunk)
+            start = self._chunks_offset + chunk * self._chunk_size
+            data = self._buf[start:start+self._chunk_size]
+            if data[:4] != 'PMGL':
+                raise ChmError('invalid listing chunk %d' % chunk)
+            free, _, _, chunk = struct.unpack('<IIii', data[4:20])
+            end = self._chunk_size - free
+            pos = 0x14
+            while pos < end:
+                length, pos = _encint(data, pos)
+                entry = data[pos:pos+length]
+                pos += length
+                section, pos = _encint(data, pos)
+                offset, pos = _encint(data, pos)
+                size, pos = _encint(data, pos)
+                if entry == name:
+                    return section, offset, size
+        raise ChmError('%s not found' % name)
+
+
+    def _dword(self, pos, signed=False):
+        return struct.unpack(signed and '<i' or '<I', self._buf[pos:pos+4])[0]
+
+
+    def _qword(self, pos):
+        return struct.unpack('<Q', self._buf[pos:pos+8])[0]
+
+
+def _encint(data, pos):
+    """
+    decode a variable length integer, return it and the position after it
+    """
+    value = 0
+    while True:
+        c = data[pos:pos+1]
+        if not c:
+            raise ChmError('truncated integer')
+        byte = ord(c)
+        pos += 1
+        value = (value << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            return value, pos
+
+
+def _text(data):
+    """
+    decode a string from #SYSTEM. they are in the codepage of the help
+    file's locale, which is not worth mapping, so try utf-8 and cp1252.
+    """
+    data = data.split('\x00')[0]
+    try:
+        text = data.decode('utf8')
+    except UnicodeDecodeError:
+        text = data.decode('cp1252', 'replace')
+    return u' '.join(text.split()) or None
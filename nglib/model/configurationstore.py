@@ -35,6 +35,18 @@ For more Information see http://netgarage.org
 
 from __future__ import with_statement
 import os
+import re
+from collections import OrderedDict
+from collections import namedtuple
+
+
+# name of the library root configured with dir and dbfile
+DEFAULT_ROOT = 'main'
+
+# a directory tree of books and the database it is indexed in
+LibraryRoot = namedtuple('LibraryRoot', 'name dir dbfile')
+
+_ROOT_NAME_RE = re.compile(r'^[A-Za-z0-9_-]+$')
 
 
 class NgLibError(Exception):
@@ -59,6 +71,7 @@ class ConfigurationStore(object):
         self.config_values = ['dir', 'dbfile', 'pdfcmd', 'chmcmd', 'showcmd']
         for value in self.config_values:
             setattr(self, value, None)
+        self.roots = OrderedDict() # more library roots, name -> directory
 
 
     def load(self, check_complete=True):
@@ -84,6 +97,8 @@ class ConfigurationStore(object):
         with open(self._config_file, 'w') as f:
             for val in self.config_values:
                 f.write('%s = %s\n' % (val, getattr(self, val)))
+            for name, path in self.roots.items():
+                f.write('root.%s = %s\n' % (name, path))
 
 
     def _parse_config(self, config_data, check_complete=True):
@@ -102,6 +117,10 @@ class ConfigurationStore(object):
             key = line[:splitat].strip()
             value = line[splitat+1:].strip()
 
+            if key.startswith('root.'):
+                self._add_root(key[5:], value)
+                continue
+
             if not key or key not in self.config_values:
                 continue
 
@@ -111,6 +130,21 @@ class ConfigurationStore(object):
             raise NgLibError('config is not complete')
 
 
+    def _add_root(self, name, path):
+        """
+        add a library root from a "root.<name> = <path>" line
+        """
+        if not _ROOT_NAME_RE.match(name) or name == DEFAULT_ROOT:
+            raise NgLibError('invalid name for a library root: "%s"' % name)
+        # books-<name>.db must not be the metadata cache of another root,
+        # see cache_file()
+        lower = name.lower()
+        if lower == 'metadata' or lower.endswith('-metadata'):
+            raise NgLibError('a library root can\'t be called "metadata" '
+                             'or end in "-metadata": "%s"' % name)
+        self.roots[name] = path
+
+
     def is_complete(self):
         """
         Return true if no config values are None.
@@ -121,3 +155,18 @@ class ConfigurationStore(object):
         return True
 
 
+def library_roots(config):
+    """
+    return the library roots of a configuration as a list of LibraryRoots.
+    the first is dir and dbfile, named DEFAULT_ROOT, every "root.<name>"
+    line adds one that is indexed in a database of its own next to dbfile
+    (books.db, books-<name>.db, ...), so it can be updated separately.
+
+    config - ConfigurationStore or an object with dir and dbfile
+    """
+    roots = [LibraryRoot(DEFAULT_ROOT, config.dir, config.dbfile)]
+    base, ext = os.path.splitext(config.dbfile)
+    for name, path in getattr(config, 'roots', {}).items():
+        roots.append(LibraryRoot(name, path,
+                                 '%s-%s%s' % (base, name, ext or '.db')))
+    return roots
@@ -0,0 +1,136 @@
+# encoding: utf-8
+
+"""
+@summary: full-text index of the contents of ebook files
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import re
+import unicodedata
+
+from nglib.model.pdfreader import read_pdf_text
+from nglib.model.workers import default_workers
+from nglib.model.workers import pool_map
+
+
+DEFAULT_MAX_PAGES = 200
+DEFAULT_MAX_TERMS = 50000
+
+_WORD_RE = re.compile(r'[^\W_]+', re.UNICODE)
+
+
+def content_terms(text):
+    """
+    generator that splits text into index terms: lower case words without
+    diacritics, between 2 and 32 characters long, numbers are skipped.
+
+    text - unicode string
+    """
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    for word in _WORD_RE.findall(text):
+        if 2 <= len(word) <= 32 and not word.isdigit():
+            yield word
+
+
+def index_book(args):
+    """
+    return (book id, mtime, terms) for a book, where terms is a dict
+    mapping terms to the number of times they occur in the book. books
+    that can't be read have no terms. meant to run in a worker process.
+
+    args - tuple (book id, mtime, path, max pages, max terms)
+    """
+    bid, mtime, path, max_pages, max_terms = args
+    terms = {}
+    try:
+        for text in read_pdf_text(path, max_pages):
+            for term in content_terms(text):
+                if term in terms:
+                    terms[term] += 1
+                elif len(terms) < max_terms:
+                    terms[term] = 1
+    except Exception:
+        pass # index what was read so far
+    return bid, mtime, terms
+
+
+class ContentIndexer(object):
+    """
+    builds the inverted index of book contents in a BookDatabase. only
+    books that were added or changed since they were last indexed are
+    read, in a pool of worker processes.
+    """
+    def __init__(self, database, workers=None, max_pages=DEFAULT_MAX_PAGES,
+                 max_terms=DEFAULT_MAX_TERMS, batch_size=50):
+        """
+        create a ContentIndexer
+
+        database - BookDatabase object
+        workers - number of worker processes, defaults to the number of
+                  cpus. with 1 or less everything is done in-process
+        max_pages - number of pages to read per book
+        max_terms - number of distinct terms to index per book
+        batch_size - how many books to write per transaction
+        """
+        self._db = database
+        self.workers = default_workers(workers)
+        self.max_pages = max_pages
+        self.max_terms = max_terms
+        self.batch_size = batch_size
+
+
+    def index(self):
+        """
+        generator that indexes all books that need it. yields tuples
+        (indexed, total) with the number of books indexed so far and the
+        number of books that need indexing.
+        """
+        books = self._db.books_to_index()
+        total = len(books)
+        jobs = [(bid, mtime, path.encode('utf8'), self.max_pages,
+                 self.max_terms) for bid, path, mtime in books]
+        results = pool_map(index_book, jobs, self.workers)
+
+        indexed = 0
+        batch = []
+        try:
+            for result in results:
+                batch.append(result)
+                indexed += 1
+                if len(batch) == self.batch_size:
+                    self._db.add_content(batch)
+                    batch = []
+                    yield indexed, total
+            self._db.add_content(batch)
+            yield indexed, total
+        finally:
+            results.close()
@@ -0,0 +1,108 @@
+# encoding: utf-8
+
+"""
+@summary: hashing of book files for finding duplicates
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import hashlib
+import mmap
+import os
+
+from nglib.model.workers import default_workers
+from nglib.model.workers import pool_map
+
+
+# bytes hashed at the start and at the end of a file for the partial hash
+PARTIAL_SIZE = 64 * 1024
+
+# bytes hashed at once for the full hash
+CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(args):
+    """
+    return (book id, hex digest) of a file. the partial hash covers the
+    first and last PARTIAL_SIZE bytes, so it is the same as the full hash
+    for files up to twice that size. the digest is None if the file can't
+    be read or its size changed. meant to run in a worker process.
+
+    args - tuple (book id, absolute path, expected size, full)
+    """
+    bid, path, size, full = args
+    digest = hashlib.sha1()
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return bid, None
+    try:
+        if os.fstat(f.fileno()).st_size != size:
+            return bid, None
+        if size:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if full or size <= 2 * PARTIAL_SIZE:
+                    for pos in xrange(0, size, CHUNK_SIZE):
+                        digest.update(buf[pos:pos+CHUNK_SIZE])
+                else:
+                    digest.update(buf[:PARTIAL_SIZE])
+                    digest.update(buf[-PARTIAL_SIZE:])
+            finally:
+                buf.close()
+    except (EnvironmentError, ValueError):
+        return bid, None
+    finally:
+        f.close()
+    return bid, digest.hexdigest()
+
+
+class FileHasher(object):
+    """
+    runs hash_file() over a list of files in a pool of worker processes
+    """
+    def __init__(self, workers=None):
+        """
+        create a FileHasher
+
+        workers - number of worker processes, defaults to the number of
+                  cpus. with 1 or less everything is done in-process
+        """
+        self.workers = default_workers(workers)
+
+
+    def hash(self, jobs):
+        """
+        generator that yields (book id, hex digest) for every job, in no
+        particular order. see hash_file() for the jobs and results.
+
+        jobs - list of (book id, absolute path, size, full) tuples
+        """
+        return pool_map(hash_file, jobs, self.workers)
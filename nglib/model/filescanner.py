@@ -0,0 +1,162 @@
+# encoding: utf-8
+
+"""
+@summary: single pass, multi-threaded search for ebook files
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import os
+from collections import deque
+from multiprocessing.pool import ThreadPool
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None # fall back to listdir() and a stat per entry
+
+
+class FileScanner(object):
+    """
+    walks a directory tree once and yields all files with certain
+    extensions. directories are listed by a pool of threads, which helps
+    a lot on network filesystems. if scandir is available the file type
+    reported by readdir() is used instead of doing a stat per entry.
+    """
+    def __init__(self, root, extensions=('pdf', 'chm'), stat=False,
+                 workers=8):
+        """
+        create a FileScanner
+
+        root - root of the directory tree
+        extensions - iterable of file extensions to look for
+        stat - also stat() every file found (in the worker threads)
+        workers - number of threads listing directories
+        """
+        self.root = root
+        self.extensions = extensions
+        self.stat = stat
+        self.workers = workers
+        self.total = 0 # files found so far
+        self.failed = [] # directories that couldn't be listed
+
+
+    def scan(self):
+        """
+        generator that yields a (path, stat) tuple for every file found.
+        stat is the result of os.stat() on the file or None if the
+        scanner was created with stat=False. files starting with a dot and
+        symlinks to directories are skipped, so are directories that
+        can't be read. those are put into failed, their files may still
+        exist.
+        """
+        self.total = 0
+        self.failed = []
+        pool = ThreadPool(self.workers)
+        pending = deque([pool.apply_async(self._list_dir, (self.root,))])
+        try:
+            while pending:
+                dirs, files = pending.popleft().get()
+                for path in dirs:
+                    pending.append(pool.apply_async(self._list_dir, (path,)))
+                self.total += len(files)
+                for entry in files:
+                    yield entry
+        finally:
+            if pending:
+                pool.terminate()
+            else:
+                pool.close()
+            pool.join()
+
+
+    def _list_dir(self, path):
+        """
+        return a list of subdirectories and a list of (path, stat) tuples
+        for the matching files in a directory
+        """
+        try:
+            if scandir is not None:
+                dirs, files = self._scandir(path)
+            else:
+                dirs, files = self._listdir(path)
+        except OSError:
+            self.failed.append(path)
+            return [], []
+
+        if not self.stat:
+            return dirs, [(f, None) for f in files]
+
+        entries = []
+        for f in files:
+            try:
+                entries.append((f, os.stat(f)))
+            except OSError:
+                continue # vanished or a dangling symlink
+        return dirs, entries
+
+
+    def _scandir(self, path):
+        dirs = []
+        files = []
+        for entry in scandir(path):
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        dirs.append(entry.path)
+                    continue
+            except OSError:
+                continue
+            if self._wanted(entry.name):
+                files.append(entry.path)
+        return dirs, files
+
+
+    def _listdir(self, path):
+        dirs = []
+        files = []
+        for name in os.listdir(path):
+            abspath = os.path.join(path, name)
+            if os.path.isdir(abspath):
+                if not os.path.islink(abspath):
+                    dirs.append(abspath)
+                continue
+            if self._wanted(name):
+                files.append(abspath)
+        return dirs, files
+
+
+    def _wanted(self, name):
+        if name.startswith('.'):
+            return False
+        return name.split('.')[-1].lower() in self.extensions
@@ -0,0 +1,179 @@
+# encoding: utf-8
+
+"""
+@summary: minimal ctypes binding for the linux inotify api
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+
+from nglib.model.configurationstore import NgLibError
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0x00080000
+
+_EVENT_HEADER = struct.Struct('iIII') # wd, mask, cookie, len
+
+
+class InotifyError(NgLibError):
+    pass
+
+
+class WatchLimitError(InotifyError):
+    """
+    raised when no more watches can be added, see
+    /proc/sys/fs/inotify/max_user_watches
+    """
+    pass
+
+
+_libc = None
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(name, use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError):
+            raise InotifyError('inotify is not available on this system')
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        _libc = libc
+    return _libc
+
+
+class Inotify(object):
+    """
+    an inotify instance. raises InotifyError if inotify is not available.
+    """
+    def __init__(self):
+        self._libc = _load_libc()
+        self._fd = self._libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self._fd < 0:
+            _raise('inotify_init1')
+
+
+    def fileno(self):
+        return self._fd
+
+
+    def add_watch(self, path, mask):
+        """
+        watch path for the events in mask, return the watch descriptor.
+        raises WatchLimitError if the limit of watches is reached.
+
+        path - bytestring
+        mask - IN_* flags
+        """
+        wd = self._libc.inotify_add_watch(self._fd, path, mask)
+        if wd < 0:
+            _raise('inotify_add_watch', path)
+        return wd
+
+
+    def rm_watch(self, wd):
+        """
+        stop watching, errors are ignored (the watch might be gone already)
+        """
+        self._libc.inotify_rm_watch(self._fd, wd)
+
+
+    def read(self, timeout=None):
+        """
+        wait for events and return a list of (wd, mask, cookie, name) tuples.
+        name is the bytestring name of the file in the watched directory the
+        event is about or an empty string. returns an empty list if there
+        was no event within timeout.
+
+        timeout - optional, seconds to wait, None waits forever
+        """
+        try:
+            ready = select.select([self._fd], [], [], timeout)[0]
+        except select.error, e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        if not ready:
+            return []
+        try:
+            buf = os.read(self._fd, 65536)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return []
+            raise
+        events = []
+        pos = 0
+        while pos + _EVENT_HEADER.size <= len(buf):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(buf, pos)
+            pos += _EVENT_HEADER.size
+            name = buf[pos:pos+length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
+
+
+def _raise(function, path=None):
+    code = ctypes.get_errno()
+    if code == errno.ENOSPC:
+        raise WatchLimitError('%s: inotify watch limit reached' % function)
+    if path is None:
+        raise InotifyError('%s: %s' % (function, os.strerror(code)))
+    raise InotifyError('%s(%s): %s' % (function, path, os.strerror(code)))
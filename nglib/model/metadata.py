@@ -0,0 +1,206 @@
+# encoding: utf-8
+
+"""
+@summary: extracts metadata from ebook files, in parallel
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+from collections import deque
+from multiprocessing import Pool
+
+from nglib.model.chmreader import read_chm_metadata
+from nglib.model.pdfreader import read_pdf_metadata
+from nglib.model.stats import NULL_STATS
+from nglib.model.workers import default_workers
+
+
+# maps file extensions to functions that take the path to a file and
+# return a dict with the keys 'title', 'author' and 'pages'
+EXTRACTORS = {'pdf': read_pdf_metadata,
+              'chm': read_chm_metadata}
+
+
+def extract_metadata(path):
+    """
+    return a dict with the metadata found in an ebook file. keys are
+    'title' and 'author' (unicode strings) and 'pages' (int), all of them
+    optional. files that can't be parsed yield an empty dict.
+
+    path - absolute path to the file
+    """
+    reader = EXTRACTORS.get(path.split('.')[-1].lower())
+    if reader is None:
+        return {}
+    try:
+        return reader(path)
+    except Exception:
+        return {} # broken or unsupported file, use the filename instead
+
+
+class MetadataExtractor(object):
+    """
+    runs extract_metadata() over a stream of files in a pool of worker
+    processes. files are sent to the workers in chunks, several chunks
+    are kept in flight so the workers don't wait for the caller.
+    if a MetadataCache is given, files found in it aren't parsed again.
+    the pool is only started for the first chunk that has at least as many
+    files to parse as there are workers, smaller chunks are parsed
+    in-process.
+    """
+    def __init__(self, workers=None, chunk_size=64, cache=None, stats=None):
+        """
+        create a MetadataExtractor
+
+        workers - number of worker processes, defaults to the number of
+                  cpus. with 1 or less everything is done in-process
+        chunk_size - number of files sent to a worker at once
+        cache - optional, a MetadataCache
+        stats - optional, Stats object that counts the files parsed and
+                found in the cache. metadata_file_bytes adds up the sizes
+                of the parsed files (if the entries have a stat). that is
+                not what is read: the readers map the files and only touch
+                the few pages they need.
+        """
+        self.workers = default_workers(workers)
+        self.chunk_size = chunk_size
+        self.cache = cache
+        if stats is None:
+            stats = NULL_STATS
+        self.stats = stats
+
+
+    def extract(self, entries, wanted=None):
+        """
+        generator that yields every entry with the extracted metadata
+        appended, in the order the entries came in.
+
+        entries - iterable of tuples, the first item of each is a path. if
+                  a cache is used the second has to be the file's os.stat()
+        wanted - optional predicate on an entry, entries for which it
+                 returns false get None instead of metadata
+        """
+        pool = None
+        in_flight = deque()
+        try:
+            for chunk in _chunks(entries, self.chunk_size):
+                metadata, paths = self._lookup(chunk, wanted)
+                if self.workers <= 1 or len(paths) < self.workers:
+                    result = _Result([extract_metadata(p) for p in paths])
+                else:
+                    if pool is None:
+                        pool = Pool(self.workers)
+                    result = pool.map_async(extract_metadata, paths)
+                in_flight.append((chunk, metadata, result))
+                if len(in_flight) > max(self.workers, 0):
+                    for entry in self._collect(*in_flight.popleft()):
+                        yield entry
+            while in_flight:
+                for entry in self._collect(*in_flight.popleft()):
+                    yield entry
+        finally:
+            if pool is not None:
+                if in_flight:
+                    pool.terminate()
+                else:
+                    pool.close()
+                pool.join()
+            if self.cache is not None:
+                self.cache.flush()
+
+
+    def _lookup(self, chunk, wanted):
+        """
+        look up a chunk of entries in the cache. return (metadata, paths),
+        where metadata has None for unwanted entries and _PENDING for the
+        entries whose metadata has to be extracted from the files in paths.
+        """
+        metadata = []
+        paths = []
+        for entry in chunk:
+            if wanted is not None and not wanted(entry):
+                metadata.append(None)
+                continue
+            cached = None
+            if self.cache is not None:
+                cached = self.cache.get(entry[1])
+            if cached is None:
+                metadata.append(_PENDING)
+                paths.append(entry[0])
+                if self.stats.enabled and len(entry) > 1:
+                    self.stats.count('metadata_file_bytes',
+                                     getattr(entry[1], 'st_size', 0))
+            else:
+                metadata.append(cached)
+        self.stats.count('metadata_parsed', len(paths))
+        if self.cache is not None:
+            self.stats.count('metadata_cached', len(chunk) - len(paths) -
+                             metadata.count(None))
+        return metadata, paths
+
+
+    def _collect(self, chunk, metadata, result):
+        """
+        generator that yields the entries of a chunk with their metadata
+        once the workers are done with it
+        """
+        extracted = iter(result.get())
+        for entry, value in zip(chunk, metadata):
+            if value is _PENDING:
+                value = extracted.next()
+                if self.cache is not None:
+                    self.cache.put(entry[1], value)
+            yield entry + (value,)
+
+
+_PENDING = object()
+
+
+class _Result(object):
+    """
+    stands in for the AsyncResult of a pool when extracting in-process
+    """
+    def __init__(self, value):
+        self._value = value
+
+
+    def get(self):
+        return self._value
+
+
+def _chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,180 @@
+# encoding: utf-8
+
+"""
+@summary: persistent cache for metadata extracted from ebook files
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import os
+import sqlite3
+import time
+
+
+DEFAULT_MAX_ENTRIES = 500000
+
+
+def cache_file(dbfile):
+    """
+    return the path of the metadata cache that belongs to a book database
+
+    dbfile - path to the BookDatabase file
+    """
+    return os.path.splitext(dbfile)[0] + '-metadata.db'
+
+
+class MetadataCache(object):
+    """
+    remembers the metadata extracted from files, keyed by device, inode,
+    size and mtime, so unchanged files don't have to be parsed again when
+    the library is rebuilt. it lives in its own sqlite file, which survives
+    clearing or deleting the book database.
+    entries that weren't used for the longest time are evicted when there
+    are more than max_entries.
+    """
+    def __init__(self, path, max_entries=DEFAULT_MAX_ENTRIES,
+                 batch_size=1000):
+        """
+        open or create a MetadataCache
+
+        path - path to the sqlite file
+        max_entries - maximum number of files to remember
+        batch_size - how many changes to collect per transaction
+        """
+        self.max_entries = max_entries
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        self._stamp = time.time()
+        self._puts = {} # key -> metadata not written yet
+        self._touched = []
+        self._dbcon = sqlite3.connect(path)
+        self._dbcon.execute(u"""create table if not exists metadata
+                                (dev integer, inode integer, size integer,
+                                 mtime real, title text, author text,
+                                 pages integer, last_used real,
+                                 primary key (dev, inode, size, mtime))""")
+        self._dbcon.execute(u"""create index if not exists metadata_last_used
+                                on metadata (last_used)""")
+        self._dbcon.commit()
+
+
+    def get(self, stat):
+        """
+        return the metadata dict stored for a file, None if it isn't cached
+
+        stat - result of os.stat() on the file
+        """
+        key = _key(stat)
+        if key in self._puts:
+            self.hits += 1
+            return dict(self._puts[key])
+
+        row = self._dbcon.execute(u"""select title, author, pages
+                                      from metadata where dev = ? and
+                                      inode = ? and size = ? and mtime = ?""",
+                                  key).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._touched.append((self._stamp,) + key)
+        self._maybe_flush()
+        metadata = {}
+        for name, value in zip(('title', 'author', 'pages'), row):
+            if value:
+                metadata[name] = value
+        return metadata
+
+
+    def put(self, stat, metadata):
+        """
+        remember the metadata of a file
+
+        stat - result of os.stat() on the file
+        metadata - dict as returned by extract_metadata()
+        """
+        self._puts[_key(stat)] = metadata
+        self._maybe_flush()
+
+
+    def hit_rate(self):
+        """
+        return the fraction of lookups that were hits
+        """
+        lookups = self.hits + self.misses
+        return lookups and float(self.hits) / lookups or 0.0
+
+
+    def flush(self):
+        """
+        write pending changes and evict old entries
+        """
+        if self._puts:
+            rows = [key + (metadata.get('title'), metadata.get('author'),
+                           metadata.get('pages'), self._stamp)
+                    for key, metadata in self._puts.items()]
+            self._dbcon.executemany(u"""insert or replace into metadata
+                                        values (?, ?, ?, ?, ?, ?, ?, ?)""",
+                                    rows)
+        if self._touched:
+            self._dbcon.executemany(u"""update metadata set last_used = ?
+                                        where dev = ? and inode = ? and
+                                        size = ? and mtime = ?""",
+                                    self._touched)
+        if self._puts:
+            count = self._dbcon.execute(u"select count(*) from metadata")
+            excess = count.fetchone()[0] - self.max_entries
+            if excess > 0:
+                self._dbcon.execute(u"""delete from metadata where rowid in
+                                        (select rowid from metadata
+                                         order by last_used limit ?)""",
+                                    (excess,))
+        self._dbcon.commit()
+        self._puts = {}
+        self._touched = []
+
+
+    def close(self):
+        """
+        flush pending changes and close the cache
+        """
+        self.flush()
+        self._dbcon.close()
+
+
+    def _maybe_flush(self):
+        if len(self._puts) + len(self._touched) >= self.batch_size:
+            self.flush()
+
+
+def _key(stat):
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime)
@@ -0,0 +1,839 @@
+# encoding: utf-8
+
+"""
+@summary: reads metadata from pdf files without parsing the whole file
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import mmap
+import os
+import re
+import zlib
+from collections import namedtuple
+
+from nglib.model.configurationstore import NgLibError
+
+
+class PdfError(NgLibError):
+    pass
+
+
+class Name(str):
+    """
+    a pdf name object, e.g. /Title (without the slash)
+    """
+    pass
+
+
+Ref = namedtuple('Ref', 'num gen')
+
+_WS = '\x00\t\n\x0c\r '
+_WS_RE = re.compile(r'(?:[\x00\t\n\x0c\r ]|%[^\r\n]*)*')
+_NUMBER_RE = re.compile(r'[+-]?(?:\d+\.?\d*|\.\d+)')
+_REF_RE = re.compile(r'[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R'
+                     r'(?![^\x00\t\n\x0c\r ()<>\[\]{}/%])')
+_NAME_RE = re.compile(r'/([^\x00\t\n\x0c\r ()<>\[\]{}/%]*)')
+_NAME_ESCAPE_RE = re.compile(r'#([0-9A-Fa-f]{2})')
+_KEYWORD_RE = re.compile(r'[A-Za-z]+')
+_HEX_RE = re.compile(r'<([0-9A-Fa-f\x00\t\n\x0c\r ]*)>')
+_STRING_SPECIAL_RE = re.compile(r'[()\\]')
+_OBJ_RE = re.compile(r'[\x00\t\n\x0c\r ]*(\d+)[\x00\t\n\x0c\r ]+(\d+)'
+                     r'[\x00\t\n\x0c\r ]+obj')
+_XREF_SUBSECTION_RE = re.compile(r'(\d+)[ ]+(\d+)[ ]*(?:\r\n|\r|\n)')
+_STARTXREF_RE = re.compile(r'startxref[\x00\t\n\x0c\r ]+(\d+)')
+_STREAM_RE = re.compile(r'[\x00\t\n\x0c\r ]*stream(?:\r\n|\n|\r)')
+
+_ESCAPES = {'n': '\n', 'r': '\r', 't': '\t', 'b': '\b', 'f': '\f'}
+_KEYWORDS = {'true': True, 'false': False, 'null': None}
+
+# a content stream token: a name, a number, an operator or a delimiter.
+# strings are handled separately because they can contain anything
+_CONTENT_TOKEN_RE = re.compile(r'/[^\x00\t\n\x0c\r ()<>\[\]{}/%]*'
+                               r'|[+-]?(?:\d+\.?\d*|\.\d+)'
+                               r'|[A-Za-z\'"*][A-Za-z0-9\'"*]*'
+                               r'|<<|>>|[\[\]{}]')
+_INLINE_IMAGE_END_RE = re.compile(r'[\x00\t\n\x0c\r ]EI(?=[\x00\t\n\x0c\r ]|$)')
+_CMAP_CODESPACE_RE = re.compile(r'begincodespacerange(.*?)endcodespacerange',
+                                re.S)
+_CMAP_BFCHAR_RE = re.compile(r'beginbfchar(.*?)endbfchar', re.S)
+_CMAP_BFRANGE_RE = re.compile(r'beginbfrange(.*?)endbfrange', re.S)
+_CMAP_HEX_RE = re.compile(r'<([0-9A-Fa-f]*)>')
+_CMAP_RANGE_RE = re.compile(r'<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]+)>\s*'
+                            r'(<[0-9A-Fa-f]*>|\[[^\]]*\])')
+
+_CONTROL_CHARS = ''.join(chr(i) for i in range(32))
+
+# text operators that move to a new line or position
+_TEXT_BREAKS = ('Td', 'TD', 'T*', 'Tm', 'ET', "'", '"')
+
+# stop decompressing a page's content after this many bytes
+MAX_PAGE_CONTENT = 4 * 1024 * 1024
+
+# titles some tools write into every document they produce
+_USELESS_TITLES = (u'untitled', u'unknown', u'title', u'no title')
+
+
+def read_pdf_metadata(path):
+    """
+    return a dict with the title, author and number of pages of a pdf file.
+    the file is memory-mapped and only the trailer, the cross-reference
+    sections and the few objects needed are parsed, never the whole file.
+    keys are only present if the value was found.
+
+    path - absolute path to the pdf file
+    """
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            raise PdfError('empty file')
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return PdfReader(buf).metadata()
+        finally:
+            buf.close()
+    finally:
+        f.close()
+
+
+def read_pdf_text(path, max_pages=None):
+    """
+    generator that yields the text of a pdf file, one unicode string per
+    page. the file is memory-mapped and only one page's content is held in
+    memory at a time. text is decoded through the ToUnicode maps of the
+    fonts where available, otherwise the bytes are taken as cp1252.
+
+    path - absolute path to the pdf file
+    max_pages - optional, stop after this many pages
+    """
+    f = open(path, 'rb')
+    try:
+        if not os.fstat(f.fileno()).st_size:
+            raise PdfError('empty file')
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            reader = PdfReader(buf)
+            if 'Encrypt' in reader.trailer:
+                raise PdfError('encrypted file')
+            fonts = {}
+            for num, page in enumerate(reader.pages()):
+                if max_pages is not None and num >= max_pages:
+                    break
+                try:
+                    yield reader.page_text(page, fonts)
+                except (PdfError, zlib.error, ValueError, IndexError):
+                    continue # skip unreadable pages
+        finally:
+            buf.close()
+    finally:
+        f.close()
+
+
+class Stream(object):
+    """
+    a pdf stream object. the data is only read when decode() is called.
+    """
+    def __init__(self, dictionary, buf, start):
+        self.dict = dictionary
+        self._buf = buf
+        self._start = start
+
+
+    def raw(self, reader):
+        """
+        return the undecoded stream data
+
+        reader - PdfReader used for resolving an indirect /Length
+        """
+        length = reader.resolve(self.dict.get('Length'))
+        if isinstance(length, int) and length >= 0:
+            end = self._start + length
+            if self._buf[end:end+20].lstrip(_WS).startswith('endstream'):
+                return self._buf[self._start:end]
+        end = self._buf.find('endstream', self._start)
+        if end < 0:
+            raise PdfError('unterminated stream')
+        return self._buf[self._start:end].rstrip('\r\n')
+
+
+    def decode(self, reader, limit=0):
+        """
+        return the stream data with all filters applied
+
+        reader - PdfReader used for resolving indirect objects
+        limit - optional, maximum number of bytes to decompress
+        """
+        data = self.raw(reader)
+        filters = reader.resolve(self.dict.get('Filter'))
+        params = reader.resolve(self.dict.get('DecodeParms'))
+        if filters is None:
+            return data
+        if not isinstance(filters, list):
+            filters = [filters]
+            params = [params]
+        elif not isinstance(params, list):
+            params = [params] * len(filters)
+        for name, param in zip(filters, params):
+            if name not in ('FlateDecode', 'Fl'):
+                raise PdfError('unsupported filter %s' % name)
+            data = zlib.decompressobj().decompress(data, limit)
+            param = reader.resolve(param)
+            if isinstance(param, dict):
+                data = _unpredict(data, param)
+        return data
+
+
+class PdfReader(object):
+    """
+    minimal pdf parser, just enough to find objects by number and read
+    the document information dictionary and the page tree.
+    """
+    def __init__(self, buf):
+        """
+        create a PdfReader
+
+        buf - string or mmap with the contents of a pdf file
+        """
+        if buf.find('%PDF-', 0, 1024) < 0:
+            raise PdfError('not a pdf file')
+        self._buf = buf
+        self._objects = {}
+        self._sections = []
+        self.trailer = {}
+        self._load_xref()
+
+
+    def metadata(self):
+        """
+        return a dict with title, author and pages, see read_pdf_metadata()
+        """
+        result = {}
+        if 'Encrypt' not in self.trailer:
+            try:
+                info = self.resolve(self.trailer.get('Info'))
+                if isinstance(info, dict):
+                    for key in ('Title', 'Author'):
+                        value = _text(self.resolve(info.get(key)))
+                        if value:
+                            result[key.lower()] = value
+            except (PdfError, zlib.error, ValueError, IndexError):
+                pass
+        try:
+            pages = self.page_count()
+            if pages:
+                result['pages'] = pages
+        except (PdfError, zlib.error, ValueError, IndexError):
+            pass
+        return result
+
+
+    def page_count(self):
+        """
+        return the number of pages from the root of the page tree
+        """
+        root = self.resolve(self.trailer.get('Root'))
+        if not isinstance(root, dict):
+            raise PdfError('no document catalog')
+        pages = self.resolve(root.get('Pages'))
+        if isinstance(pages, Stream) or not isinstance(pages, dict):
+            raise PdfError('no page tree')
+        count = self.resolve(pages.get('Count'))
+        if not isinstance(count, int) or count < 0:
+            raise PdfError('invalid page count')
+        return count
+
+
+    def pages(self):
+        """
+        generator that yields the page dictionaries in document order.
+        resources inherited from the page tree are copied into each page.
+        """
+        root = self.resolve(self.trailer.get('Root'))
+        if not isinstance(root, dict):
+            raise PdfError('no document catalog')
+        stack = [(root.get('Pages'), None)]
+        seen = set()
+        while stack:
+            ref, resources = stack.pop()
+            if isinstance(ref, Ref):
+                if ref.num in seen:
+                    continue
+                seen.add(ref.num)
+            node = self.resolve(ref)
+            if not isinstance(node, dict):
+                continue
+            resources = node.get('Resources', resources)
+            kids = self.resolve(node.get('Kids'))
+            if isinstance(kids, list):
+                for kid in reversed(kids):
+                    stack.append((kid, resources))
+            elif node.get('Type') != 'Pages':
+                page = dict(node)
+                page['Resources'] = resources
+                yield page
+
+
+    def page_text(self, page, fonts=None):
+        """
+        return the text shown on a page as unicode string
+
+        page - page dictionary as yielded by pages()
+        fonts - optional, dict used to cache decoded fonts between pages
+        """
+        if fonts is None:
+            fonts = {}
+        contents = self.resolve(page.get('Contents'))
+        if not isinstance(contents, list):
+            contents = [contents]
+        data = []
+        size = 0
+        for part in contents:
+            part = self.resolve(part)
+            if isinstance(part, Stream) and size < MAX_PAGE_CONTENT:
+                data.append(part.decode(self, MAX_PAGE_CONTENT - size))
+                size += len(data[-1])
+        resources = self.resolve(page.get('Resources'))
+        font_dict = {}
+        if isinstance(resources, dict):
+            font_dict = self.resolve(resources.get('Font')) or {}
+        return self._content_text(' '.join(data), font_dict, fonts)
+
+
+    def _content_text(self, data, font_dict, fonts):
+        """
+        pick the strings shown by text operators out of a content stream
+        """
+        text = []
+        operands = []
+        font = None
+        pos = 0
+        size = len(data)
+        while pos < size:
+            pos = _WS_RE.match(data, pos).end()
+            c = data[pos:pos+1]
+            if not c:
+                break
+            if c == '(':
+                value, pos = _parse_string(data, pos + 1)
+                operands.append(value)
+                continue
+            if c == '<' and data[pos+1:pos+2] != '<':
+                m = _HEX_RE.match(data, pos)
+                if not m:
+                    break
+                digits = ''.join(m.group(1).split())
+                if len(digits) % 2:
+                    digits += '0'
+                operands.append(digits.decode('hex'))
+                pos = m.end()
+                continue
+            m = _CONTENT_TOKEN_RE.match(data, pos)
+            if not m:
+                pos += 1
+                continue
+            token = m.group(0)
+            pos = m.end()
+            if token == '[':
+                operands.append('[')
+            elif token == ']':
+                if '[' in operands:
+                    start = len(operands) - operands[::-1].index('[') - 1
+                    array = operands[start+1:]
+                    del operands[start:]
+                    operands.append(array)
+            elif token[0] == '/':
+                operands.append(Name(token[1:]))
+            elif _NUMBER_RE.match(token):
+                operands.append(float(token))
+            elif token in ('<<', '>>', '{', '}'):
+                continue
+            else:
+                if token == 'Tf' and len(operands) >= 2:
+                    font = self._font(operands[-2], font_dict, fonts)
+                elif token in ('Tj', "'", '"') and operands:
+                    if isinstance(operands[-1], str):
+                        text.append(_decode_shown(operands[-1], font))
+                elif token == 'TJ' and operands:
+                    if isinstance(operands[-1], list):
+                        for item in operands[-1]:
+                            if isinstance(item, str):
+                                text.append(_decode_shown(item, font))
+                            elif item < -150: # wide enough for a space
+                                text.append(u' ')
+                elif token == 'ID':
+                    m = _INLINE_IMAGE_END_RE.search(data, pos)
+                    pos = m and m.end() or size
+                if token in _TEXT_BREAKS:
+                    text.append(u' ')
+                operands = []
+        return u''.join(text)
+
+
+    def _font(self, name, font_dict, fonts):
+        """
+        return the ToUnicode map of a font resource, None if it has none
+        """
+        ref = font_dict.get(name) if isinstance(font_dict, dict) else None
+        key = isinstance(ref, Ref) and ref.num or (name, id(font_dict))
+        if key not in fonts:
+            fonts[key] = None
+            font = self.resolve(ref)
+            if isinstance(font, dict):
+                cmap = self.resolve(font.get('ToUnicode'))
+                if isinstance(cmap, Stream):
+                    try:
+                        fonts[key] = _parse_cmap(cmap.decode(self))
+                    except (PdfError, zlib.error, ValueError):
+                        pass
+        return fonts[key]
+
+
+    def resolve(self, obj):
+        """
+        return the object an indirect reference points to, other objects
+        are returned unchanged
+        """
+        depth = 0
+        while isinstance(obj, Ref):
+            obj = self.get_object(obj.num)
+            depth += 1
+            if depth > 32:
+                raise PdfError('reference loop')
+        return obj
+
+
+    def get_object(self, num):
+        """
+        return the object with the given number, None if it doesn't exist
+        """
+        if num in self._objects:
+            return self._objects[num]
+        self._objects[num] = None # guards against loops
+        entry = self._lookup(num)
+        obj = None
+        if entry is not None:
+            if entry[0] == 1:
+                obj = self._read_object(entry[1])
+            else:
+                obj = self._read_compressed(entry[1], entry[2])
+        self._objects[num] = obj
+        return obj
+
+
+    def parse(self, buf, pos):
+        """
+        parse the object at pos, return the object and the position after it
+
+        buf - string or mmap to read from
+        pos - offset of the object
+        """
+        pos = _WS_RE.match(buf, pos).end()
+        c = buf[pos:pos+1]
+        if not c:
+            raise PdfError('unexpected end of data')
+
+        if c == '<':
+            if buf[pos+1:pos+2] == '<':
+                return self._parse_dict(buf, pos + 2)
+            m = _HEX_RE.match(buf, pos)
+            if not m:
+                raise PdfError('invalid hex string at %d' % pos)
+            digits = ''.join(m.group(1).split())
+            if len(digits) % 2:
+                digits += '0'
+            return digits.decode('hex'), m.end()
+        if c == '(':
+            return _parse_string(buf, pos + 1)
+        if c == '[':
+            result = []
+            pos += 1
+            while True:
+                pos = _WS_RE.match(buf, pos).end()
+                c = buf[pos:pos+1]
+                if c == ']':
+                    return result, pos + 1
+                if not c:
+                    raise PdfError('unterminated array')
+                obj, pos = self.parse(buf, pos)
+                result.append(obj)
+        if c == '/':
+            m = _NAME_RE.match(buf, pos)
+            name = _NAME_ESCAPE_RE.sub(lambda x: chr(int(x.group(1), 16)),
+                                       m.group(1))
+            return Name(name), m.end()
+
+        m = _NUMBER_RE.match(buf, pos)
+        if m:
+            text = m.group(0)
+            if '.' in text:
+                return float(text), m.end()
+            ref = _REF_RE.match(buf, m.end())
+            if ref:
+                return Ref(int(text), int(ref.group(1))), ref.end()
+            return int(text), m.end()
+
+        m = _KEYWORD_RE.match(buf, pos)
+        if m and m.group(0) in _KEYWORDS:
+            return _KEYWORDS[m.group(0)], m.end()
+        raise PdfError('unexpected token at %d' % pos)
+
+
+    def _parse_dict(self, buf, pos):
+        result = {}
+        while True:
+            pos = _WS_RE.match(buf, pos).end()
+            if buf[pos:pos+2] == '>>':
+                return result, pos + 2
+            key, pos = self.parse(buf, pos)
+            if not isinstance(key, Name):
+                raise PdfError('invalid dictionary key at %d' % pos)
+            value, pos = self.parse(buf, pos)
+            result[key] = value
+
+
+    def _read_object(self, offset):
+        """
+        parse the indirect object at a file offset
+        """
+        m = _OBJ_RE.match(self._buf, offset)
+        if not m:
+            raise PdfError('no object at offset %d' % offset)
+        obj, pos = self.parse(self._buf, m.end())
+        if isinstance(obj, dict):
+            m = _STREAM_RE.match(self._buf, pos)
+            if m:
+                return Stream(obj, self._buf, m.end())
+        return obj
+
+
+    def _read_compressed(self, stream_num, index):
+        """
+        parse an object stored in an object stream
+        """
+        stream = self.get_object(stream_num)
+        if not isinstance(stream, Stream):
+            raise PdfError('object stream %d not found' % stream_num)
+        data = stream.decode(self)
+        first = self.resolve(stream.dict.get('First'))
+        pos = 0
+        for _ in range(index + 1):
+            num, pos = self.parse(data, pos)
+            offset, pos = self.parse(data, pos)
+        obj, _ = self.parse(data, first + offset)
+        return obj
+
+
+    def _load_xref(self):
+        """
+        find the cross-reference sections by following startxref and the
+        /Prev chain. sections are stored newest first.
+        """
+        buf = self._buf
+        size = len(buf)
+        start = buf.rfind('startxref', max(0, size - 4096))
+        m = start >= 0 and _STARTXREF_RE.match(buf, start)
+        if not m:
+            raise PdfError('startxref not found')
+
+        offsets = [int(m.group(1))]
+        seen = set()
+        while offsets:
+            offset = offsets.pop(0)
+            if offset in seen or offset >= size:
+                continue
+            seen.add(offset)
+            pos = _WS_RE.match(buf, offset).end()
+            if buf[pos:pos+4] == 'xref':
+                trailer = self._load_xref_table(pos + 4)
+                if isinstance(trailer.get('XRefStm'), int):
+                    offsets.append(trailer['XRefStm'])
+            else:
+                trailer = self._load_xref_stream(offset)
+            for key, value in trailer.items():
+                self.trailer.setdefault(key, value)
+            if isinstance(trailer.get('Prev'), int):
+                offsets.append(trailer['Prev'])
+
+
+    def _load_xref_table(self, pos):
+        """
+        remember where the subsections of a classic xref table are, without
+        parsing the entries. return the trailer dictionary.
+        """
+        buf = self._buf
+        subsections = []
+        while True:
+            pos = _WS_RE.match(buf, pos).end()
+            m = _XREF_SUBSECTION_RE.match(buf, pos)
+            if not m:
+                break
+            first, count = int(m.group(1)), int(m.group(2))
+            pos = m.end()
+            # entries should be 20 bytes, some writers use 19
+            width = 20
+            if buf[pos+18:pos+20].strip(' \r\n'):
+                width = 19
+            subsections.append((first, count, pos, width))
+            pos += count * width
+
+        if buf[pos:pos+7] != 'trailer':
+            raise PdfError('trailer not found')
+        trailer, _ = self.parse(buf, pos + 7)
+        if not isinstance(trailer, dict):
+            raise PdfError('invalid trailer')
+        self._sections.append(('table', subsections))
+        return trailer
+
+
+    def _load_xref_stream(self, offset):
+        """
+        decode a cross-reference stream, return its dictionary
+        """
+        stream = self._read_object(offset)
+        if not isinstance(stream, Stream) or stream.dict.get('Type') != 'XRef':
+            raise PdfError('no xref at offset %d' % offset)
+        widths = stream.dict.get('W')
+        index = stream.dict.get('Index') or [0, stream.dict.get('Size')]
+        if not isinstance(widths, list) or len(widths) != 3:
+            raise PdfError('invalid xref stream')
+        data = stream.decode(self)
+        subsections = []
+        row = 0
+        for i in range(0, len(index) - 1, 2):
+            subsections.append((index[i], index[i+1], row))
+            row += index[i+1]
+        self._sections.append(('stream', (data, widths, subsections)))
+        return stream.dict
+
+
+    def _lookup(self, num):
+        """
+        return (1, offset, 0) or (2, object stream number, index) for an
+        object number, None if it is free or unknown
+        """
+        buf = self._buf
+        for kind, section in self._sections:
+            if kind == 'table':
+                for first, count, pos, width in section:
+                    if first <= num < first + count:
+                        pos += (num - first) * width
+                        entry = buf[pos:pos+18].split()
+                        if len(entry) != 3 or entry[2] != 'n':
+                            return None
+                        return (1, int(entry[0]), 0)
+            else:
+                data, widths, subsections = section
+                rowsize = sum(widths)
+                for first, count, row in subsections:
+                    if first <= num < first + count:
+                        pos = (row + num - first) * rowsize
+                        fields = []
+                        for width in widths:
+                            fields.append(_int(data[pos:pos+width]))
+                            pos += width
+                        if not widths[0]:
+                            fields[0] = 1
+                        if fields[0] not in (1, 2):
+                            return None
+                        return tuple(fields)
+        return None
+
+
+def _parse_string(buf, pos):
+    """
+    parse a literal string, pos points behind the opening parenthesis
+    """
+    parts = []
+    depth = 1
+    while True:
+        m = _STRING_SPECIAL_RE.search(buf, pos)
+        if not m:
+            raise PdfError('unterminated string')
+        parts.append(buf[pos:m.start()])
+        c = m.group(0)
+        pos = m.end()
+        if c == '(':
+            depth += 1
+            parts.append(c)
+        elif c == ')':
+            depth -= 1
+            if not depth:
+                return ''.join(parts), pos
+            parts.append(c)
+        else:
+            c = buf[pos:pos+1]
+            pos += 1
+            if c in _ESCAPES:
+                parts.append(_ESCAPES[c])
+            elif c in '01234567' and c:
+                digits = c
+                while len(digits) < 3 and buf[pos:pos+1] in '01234567' \
+                        and buf[pos:pos+1]:
+                    digits += buf[pos:pos+1]
+                    pos += 1
+                parts.append(chr(int(digits, 8) & 0xff))
+            elif c == '\r':
+                if buf[pos:pos+1] == '\n':
+                    pos += 1
+            elif c != '\n':
+                parts.append(c)
+
+
+def _parse_cmap(data):
+    """
+    parse a ToUnicode cmap, return (code length, single codes, ranges).
+    single codes map byte strings to unicode, ranges are tuples
+    (first, last, destination) where destination is the unicode string
+    of the first code or a list with one string per code.
+    """
+    length = 1
+    m = _CMAP_CODESPACE_RE.search(data)
+    if m:
+        codes = _CMAP_HEX_RE.findall(m.group(1))
+        if codes:
+            length = max(1, len(codes[0]) // 2)
+
+    single = {}
+    for m in _CMAP_BFCHAR_RE.finditer(data):
+        codes = _CMAP_HEX_RE.findall(m.group(1))
+        for i in range(0, len(codes) - 1, 2):
+            single[codes[i].decode('hex')] = _utf16(codes[i+1])
+
+    ranges = []
+    for m in _CMAP_BFRANGE_RE.finditer(data):
+        for first, last, dest in _CMAP_RANGE_RE.findall(m.group(1)):
+            if dest.startswith('['):
+                dest = [_utf16(x) for x in _CMAP_HEX_RE.findall(dest)]
+            else:
+                dest = _utf16(dest[1:-1])
+            ranges.append((int(first, 16), int(last, 16), dest))
+    return length, single, ranges
+
+
+def _utf16(digits):
+    if len(digits) % 2:
+        digits += '0'
+    return digits.decode('hex').decode('utf-16-be', 'replace')
+
+
+def _decode_shown(value, cmap):
+    """
+    decode a string shown by a text operator, using the font's ToUnicode
+    cmap if there is one
+    """
+    if cmap is None:
+        printable = value.translate(None, _CONTROL_CHARS)
+        if len(printable) * 3 < len(value) * 2:
+            return u'' # most likely glyph ids of a font without a cmap
+        return printable.decode('cp1252', 'replace')
+    length, single, ranges = cmap
+    text = []
+    for i in range(0, len(value), length):
+        code = value[i:i+length]
+        if code in single:
+            text.append(single[code])
+            continue
+        num = _int(code)
+        for first, last, dest in ranges:
+            if first <= num <= last:
+                if isinstance(dest, list):
+                    if num - first < len(dest):
+                        text.append(dest[num - first])
+                elif dest:
+                    text.append(dest[:-1] + unichr(ord(dest[-1]) + num - first))
+                break
+    return u''.join(text)
+
+
+def _unpredict(data, params):
+    """
+    undo a png predictor (the only kind found in practice)
+    """
+    predictor = params.get('Predictor', 1)
+    if predictor < 10:
+        if predictor != 1:
+            raise PdfError('unsupported predictor %s' % predictor)
+        return data
+    columns = params.get('Columns', 1) * params.get('Colors', 1) * \
+              params.get('BitsPerComponent', 8) // 8
+    bpp = max(1, params.get('Colors', 1) *
+                 params.get('BitsPerComponent', 8) // 8)
+    rows = []
+    prev = [0] * columns
+    for i in range(0, len(data) - 1, columns + 1):
+        kind = ord(data[i])
+        row = [ord(c) for c in data[i+1:i+1+columns]]
+        for j in range(len(row)):
+            left = row[j-bpp] if j >= bpp else 0
+            up = prev[j]
+            if kind == 1:
+                row[j] = (row[j] + left) & 0xff
+            elif kind == 2:
+                row[j] = (row[j] + up) & 0xff
+            elif kind == 3:
+                row[j] = (row[j] + (left + up) // 2) & 0xff
+            elif kind == 4:
+                upleft = prev[j-bpp] if j >= bpp else 0
+                p = left + up - upleft
+                pa, pb, pc = abs(p - left), abs(p - up), abs(p - upleft)
+                if pa <= pb and pa <= pc:
+                    row[j] = (row[j] + left) & 0xff
+                elif pb <= pc:
+                    row[j] = (row[j] + up) & 0xff
+                else:
+                    row[j] = (row[j] + upleft) & 0xff
+        rows.append(''.join(chr(c) for c in row))
+        prev = row
+    return ''.join(rows)
+
+
+def _int(data):
+    value = 0
+    for c in data:
+        value = (value << 8) | ord(c)
+    return value
+
+
+def _text(value):
+    """
+    decode a pdf text string, return None for anything else
+    """
+    if not isinstance(value, str) or isinstance(value, Name):
+        return None
+    if value.startswith('\xfe\xff'):
+        text = value[2:].decode('utf-16-be', 'replace')
+    elif value.startswith('\xef\xbb\xbf'):
+        text = value[3:].decode('utf8', 'replace')
+    else:
+        text = value.decode('latin-1') # close enough to PDFDocEncoding
+    text = u' '.join(text.replace(u'\x00', u'').split())
+    if text.lower() in _USELESS_TITLES:
+        return None
+    return text
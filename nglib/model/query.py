@@ -0,0 +1,332 @@
+# encoding: utf-8
+
+"""
+@summary: parser and planner for the search query syntax
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import re
+from collections import namedtuple
+
+from nglib.model.configurationstore import NgLibError
+
+
+# text - the word or phrase, field - None for bare terms, phrase - True if
+# the text was in double quotes (no prefix matching)
+Term = namedtuple('Term', 'field text phrase')
+And = namedtuple('And', 'children')
+Or = namedtuple('Or', 'children')
+Not = namedtuple('Not', 'child')
+
+TEXT_FIELDS = ('title', 'author', 'filename')
+FIELDS = TEXT_FIELDS + ('ext', 'path', 'pages')
+
+_TOKEN_RE = re.compile(r'''\s*(?:(-?\()|(\))|(-)?(?:([A-Za-z]+):(?=\S))?
+                           (?:"([^"]*)"?|([^\s()]+)))''', re.UNICODE | re.VERBOSE)
+_WORD_RE = re.compile(r'[^\W_]', re.UNICODE)
+_PAGES_RE = re.compile(r'^(?:(>=|<=|>|<|=)?(\d+)|(\d+)\.\.(\d+))$')
+_COMPARISONS = {'>': '>', '<': '<', '>=': '>=', '<=': '<=', '=': '=',
+                None: '='}
+
+
+class QueryError(NgLibError):
+    pass
+
+
+def parse_query(text):
+    """
+    parse a search query into a tree of Term, And, Or and Not nodes.
+    returns None for an empty query.
+
+    words are matched against title, author and filename, text in double
+    quotes as a phrase. field:value limits a word or phrase to a field:
+    title, author, filename, ext (file extension), path (absolute paths
+    match a directory and its subdirectories, others any part of the
+    path) and pages (pages:>500, pages:<=100, pages:100..200). a leading
+    - excludes, OR (in capitals) is lower precedence than the implicit AND
+    between terms and parentheses group.
+
+    text - unicode query
+    """
+    tokens = _tokenize(text)
+    node, pos = _parse_or(tokens, 0)
+    if pos < len(tokens):
+        raise QueryError('unexpected ")"')
+    return node
+
+
+def is_simple(text):
+    """
+    return True if the query is nothing but words that all have to match
+    (no fields, phrases, exclusions, OR or parentheses), so it matches
+    fewer books when a word gets longer or one is added
+
+    text - unicode query
+    """
+    try:
+        tokens = _tokenize(text)
+    except QueryError:
+        return False
+    for token in tokens:
+        if not isinstance(token, Term) or token.field or token.phrase:
+            return False
+    return True
+
+
+def compile_query(node, fts):
+    """
+    compile a query tree into a where clause and its arguments. text
+    matching uses the books_fts table if fts is True, LIKE otherwise.
+    filters on ext and path are written so they can use the indexes on
+    books.filetype and books.path.
+    """
+    if node is None:
+        return u"1", []
+    if fts:
+        query = _fts(node)
+        if query is not None:
+            return _FTS_MATCH, [query]
+    return _compile(node, fts)
+
+
+def text_terms(node):
+    """
+    return the terms of a query tree that match title, author or filename
+    and aren't excluded, the terms a match can be ranked by
+    """
+    if node is None or isinstance(node, Not):
+        return []
+    if isinstance(node, Term):
+        return node.field in (None,) + TEXT_FIELDS and [node] or []
+    terms = []
+    for child in node.children:
+        terms += text_terms(child)
+    return terms
+
+
+def describe(node):
+    """
+    return the query tree as a string, for explaining a query
+    """
+    if node is None:
+        return u'(everything)'
+    if isinstance(node, Term):
+        text = node.phrase and u'"%s"' % node.text or node.text
+        return node.field and u'%s:%s' % (node.field, text) or text
+    if isinstance(node, Not):
+        return u'NOT %s' % describe(node.child)
+    joiner = isinstance(node, And) and u' AND ' or u' OR '
+    return u'(%s)' % joiner.join(describe(c) for c in node.children)
+
+
+_FTS_MATCH = u"id in (select rowid from books_fts where books_fts match ?)"
+
+
+def _tokenize(text):
+    tokens = []
+    pos = 0
+    text = text.strip()
+    while pos < len(text):
+        match = _TOKEN_RE.match(text, pos)
+        if match is None or match.end() == pos:
+            raise QueryError('can\'t parse "%s"' % text[pos:])
+        pos = match.end()
+        lparen, rparen, neg, field, phrase, word = match.groups()
+        if lparen:
+            tokens.append(lparen)
+        elif rparen:
+            tokens.append(rparen)
+        elif not neg and not field and word in ('OR', 'AND'):
+            tokens.append(word)
+        else:
+            if field is not None and field.lower() not in FIELDS:
+                word = u'%s:%s' % (field, phrase is None and word or phrase)
+                field = phrase = None
+            text_ = phrase is None and word or phrase
+            term = Term(field and field.lower(), text_, phrase is not None)
+            tokens.append(neg and Not(term) or term)
+    return tokens
+
+
+def _parse_or(tokens, pos):
+    children = []
+    while True:
+        node, pos = _parse_and(tokens, pos)
+        if node is not None:
+            children.append(node)
+        if pos < len(tokens) and tokens[pos] == 'OR':
+            pos += 1
+            continue
+        break
+    if not children:
+        return None, pos
+    return len(children) == 1 and children[0] or Or(children), pos
+
+
+def _parse_and(tokens, pos):
+    children = []
+    while pos < len(tokens) and tokens[pos] not in ('OR', ')'):
+        token = tokens[pos]
+        pos += 1
+        if token == 'AND':
+            continue
+        if token in ('(', '-('):
+            node, pos = _parse_or(tokens, pos)
+            if pos >= len(tokens) or tokens[pos] != ')':
+                raise QueryError('missing ")"')
+            pos += 1
+            if node is not None and token == '-(':
+                node = Not(node)
+        else:
+            node = token
+            _check(node)
+        if node is not None and not _matches_all(node):
+            children.append(node)
+    if not children:
+        return None, pos
+    return len(children) == 1 and children[0] or And(children), pos
+
+
+def _check(node):
+    term = isinstance(node, Not) and node.child or node
+    if term.field == 'pages' and not _PAGES_RE.match(term.text):
+        raise QueryError('pages needs a number like 100, >500 or 100..200, '
+                         'not "%s"' % term.text)
+
+
+def _matches_all(node):
+    """
+    words without letters or digits are ignored like before
+    """
+    term = isinstance(node, Not) and node.child or node
+    return (isinstance(term, Term) and term.field in (None,) + TEXT_FIELDS
+            and not _WORD_RE.search(term.text))
+
+
+def _fts_term(term):
+    """
+    return the FTS5 query for a text term, None for other fields
+    """
+    if term.field not in (None,) + TEXT_FIELDS:
+        return None
+    query = u'"%s"' % term.text.replace(u'"', u'""')
+    if not term.phrase:
+        query += u'*'
+    if term.field is not None:
+        query = u'%s : %s' % (term.field, query)
+    return query
+
+
+def _fts(node):
+    """
+    return an FTS5 query equivalent to node or None if it has parts FTS
+    can't answer
+    """
+    if isinstance(node, Term):
+        return _fts_term(node)
+    if isinstance(node, Not):
+        return None # NOT is binary in FTS5, see _compile()
+    parts = [_fts(child) for child in node.children]
+    if None in parts:
+        return None
+    joiner = isinstance(node, And) and u' AND ' or u' OR '
+    return u'(%s)' % joiner.join(parts)
+
+
+def _compile(node, fts):
+    if isinstance(node, Term):
+        return _compile_term(node, fts)
+    if isinstance(node, Not):
+        sql, args = _compile(node.child, fts)
+        return u'not (%s)' % sql, args
+    if isinstance(node, Or):
+        clauses, args = [], []
+        for child in node.children:
+            sql, child_args = compile_query(child, fts)
+            clauses.append(sql)
+            args += child_args
+        return u'(%s)' % u' or '.join(clauses), args
+
+    # And: all text terms go into one FTS query, excluded text terms are
+    # removed from it with NOT, the rest are combined in SQL
+    clauses, args = [], []
+    positive, negative = [], []
+    for child in node.children:
+        query = fts and _fts(child)
+        if query:
+            positive.append(query)
+            continue
+        if fts and isinstance(child, Not):
+            query = _fts(child.child)
+            if query:
+                negative.append(query)
+                continue
+        sql, child_args = _compile(child, fts)
+        clauses.append(sql)
+        args += child_args
+    if positive:
+        query = u' AND '.join(positive)
+        for excluded in negative:
+            query = u'(%s) NOT %s' % (query, excluded)
+        clauses.insert(0, _FTS_MATCH)
+        args.insert(0, query)
+    else:
+        for excluded in negative:
+            clauses.append(u'not (%s)' % _FTS_MATCH)
+            args.append(excluded)
+    return u'(%s)' % u' and '.join(clauses), args
+
+
+def _compile_term(term, fts):
+    field, text = term.field, term.text
+    if field == 'ext':
+        return u"filetype = ?", [text.lstrip(u'.').lower()]
+    if field == 'path':
+        if text.startswith(u'/'):
+            # a range instead of a prefix function so the index is used
+            path = text.rstrip(u'/') or u'/'
+            return (u"(path = ? or (path >= ? and path < ?))",
+                    [path, path.rstrip(u'/') + u'/',
+                     path.rstrip(u'/') + u'0']) # '0' follows '/'
+        return u"path like ?", [u'%' + text + u'%']
+    if field == 'pages':
+        match = _PAGES_RE.match(text)
+        op, number, low, high = match.groups()
+        if low is not None:
+            return u"pages between ? and ?", [int(low), int(high)]
+        return u"pages %s ?" % _COMPARISONS[op], [int(number)]
+    if fts:
+        return _FTS_MATCH, [_fts_term(term)]
+    like = u'%' + text + u'%'
+    if field is not None:
+        return u"%s like ?" % field, [like]
+    return (u"(title like ? or author like ? or filename like ?)",
+            [like, like, like])
@@ -0,0 +1,388 @@
+# encoding: utf-8
+
+"""
+@summary: searching several library databases as one
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import heapq
+import threading
+import time
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+
+from nglib.model.bookdatabase import DEFAULT_FUZZY_LIMIT
+from nglib.model.bookdatabase import SORT_RELEVANCE
+from nglib.model.bookdatabase import SORT_TITLE
+from nglib.model.bookdatabase import Book
+from nglib.model.bookdatabase import BookDatabase
+from nglib.model.bookdatabase import BookList
+from nglib.model.configurationstore import NgLibError
+from nglib.model.stats import NULL_STATS
+
+
+# seconds a search waits for a shard before leaving its books out
+DEFAULT_SHARD_TIMEOUT = 5.0
+
+# book ids of a ShardedDatabase keep the shard in their lowest bits
+SHARD_BITS = 8
+MAX_SHARDS = 1 << SHARD_BITS
+
+_ASCII_LOWER = dict((i, i + 32) for i in range(ord('A'), ord('Z') + 1))
+
+
+def composite_id(bid, shard):
+    """
+    return the id of a book in a ShardedDatabase
+
+    bid - id of the book in its shard
+    shard - position of the shard
+    """
+    return bid << SHARD_BITS | shard
+
+
+def split_id(book_id):
+    """
+    return (id in the shard, position of the shard) for the id of a book in
+    a ShardedDatabase
+    """
+    return book_id >> SHARD_BITS, book_id & (MAX_SHARDS - 1)
+
+
+def open_database(roots, timeout=DEFAULT_SHARD_TIMEOUT, read_only=False,
+                  stats=None):
+    """
+    return a BookDatabase for a single library root, a ShardedDatabase for
+    several
+
+    roots - list of LibraryRoots, see library_roots()
+    timeout - see ShardedDatabase
+    read_only - open a single root read only, see BookDatabase. the
+                shards of a ShardedDatabase are always read only
+    stats - optional, Stats object shared by the databases
+    """
+    if len(roots) == 1:
+        return BookDatabase(roots[0].dbfile, read_only=read_only, stats=stats)
+    return ShardedDatabase(roots, timeout, stats)
+
+
+class ShardedDatabase(object):
+    """
+    searches the databases of several library roots as one BookDatabase.
+    every shard has a thread of its own that owns its connection, a search
+    is sent to all of them at once and the sorted or ranked results are
+    merged. a shard that doesn't answer within the timeout is left out
+    (its name is in missing afterwards) and its search is cancelled, so a
+    slow root doesn't hold up the others.
+    book ids are composite, see composite_id(). the shards are only read,
+    a root is updated through a BookDatabase of its own (see
+    library_roots()).
+    """
+    def __init__(self, roots, timeout=DEFAULT_SHARD_TIMEOUT, stats=None):
+        """
+        create a ShardedDatabase and open the database of every root
+
+        roots - list of LibraryRoots
+        timeout - seconds to wait for a shard
+        stats - optional, Stats object shared by the shards
+        """
+        if len(roots) > MAX_SHARDS:
+            raise NgLibError('at most %d library roots are supported' %
+                             MAX_SHARDS)
+        self.roots = list(roots)
+        self.timeout = timeout
+        self.missing = [] # names of the roots left out of the last call
+        self._cancel_check = None
+        if stats is None:
+            stats = NULL_STATS
+        self.stats = stats
+        self._threads = [ThreadPool(1) for _ in self.roots]
+        self._dbs = [thread.apply(BookDatabase, (root.dbfile,),
+                                  dict(read_only=True, pool_size=1,
+                                       stats=stats))
+                     for thread, root in zip(self._threads, self.roots)]
+
+
+    def close(self):
+        """
+        close the databases and end the shard threads
+        """
+        for thread, db in zip(self._threads, self._dbs):
+            thread.apply_async(db.close)
+            thread.close()
+        for thread in self._threads:
+            thread.join()
+
+
+    def search(self, term, content=False, after=None, limit=None,
+               fuzzy=False, sort=SORT_TITLE):
+        """
+        search all shards, see BookDatabase.search(). books ordered by
+        title or relevance are merged in that order. fuzzy and content
+        searches are scored differently per shard, their results are
+        interleaved, best of every shard first.
+        """
+        if content or fuzzy:
+            if fuzzy:
+                limit = limit or DEFAULT_FUZZY_LIMIT
+            results = self._fan_out('search', term, content, None, limit,
+                                    fuzzy)
+            return _interleave(results, limit)
+        if sort == SORT_RELEVANCE:
+            results = self._fan_out('rank_search', term, limit, True)
+            ranked = _merge(results, limit, lambda item:
+                            (-item[0], item[1].title.lower(), item[1].bid))
+            return [book for _, book in ranked]
+        return self._merge_titles('search', term, False, after, limit)
+
+
+    def iter_search(self, term, after=None, limit=None):
+        """
+        generate the books matching the search query, see
+        BookDatabase.iter_search()
+        """
+        return iter(self.search(term, after=after, limit=limit))
+
+
+    def rank_search(self, term, limit=None):
+        """
+        return the books matching the search query, best matches first.
+        every shard ranks its books by its own statistics.
+        """
+        return self.search(term, limit=limit, sort=SORT_RELEVANCE)
+
+
+    def book_list(self, term=None, after=None, limit=None, sort=SORT_TITLE):
+        """
+        return a BookList of all books or of the books matching the search
+        term, see BookDatabase.book_list()
+        """
+        if term is None:
+            return BookList(self.get_all(after, limit))
+        return BookList(self.search(term, after=after, limit=limit,
+                                    sort=sort))
+
+
+    def fuzzy_search(self, term, limit=DEFAULT_FUZZY_LIMIT):
+        return self.search(term, limit=limit, fuzzy=True)
+
+
+    def get_all(self, after=None, limit=None):
+        """
+        return all books ordered by title, see BookDatabase.get_all()
+        """
+        return self._merge_titles('get_all', after, limit)
+
+
+    def iter_all(self, after=None, limit=None):
+        return iter(self.get_all(after, limit))
+
+
+    def get_by_id(self, book_id):
+        """
+        return the Book with the given composite id, None if its shard
+        doesn't answer
+        """
+        bid, shard = split_id(book_id)
+        if shard >= len(self._dbs):
+            return None
+        book = self._call([shard], 'get_by_id', bid)[0]
+        if book is not None:
+            book.bid = book_id
+        return book
+
+
+    def matcher(self, term):
+        """
+        see BookDatabase.matcher(), all shards use the same sqlite
+        """
+        return self._dbs[0].matcher(term)
+
+
+    def ranker(self, term):
+        """
+        see BookDatabase.ranker(). every shard scores its books by its own
+        statistics, so a merged ranking can't be redone in memory: returns
+        None
+        """
+        return None
+
+
+    def explain(self, term):
+        """
+        see BookDatabase.explain(), the plan is the same for every shard
+        """
+        return self._call([0], 'explain', term)[0]
+
+
+    def generation(self):
+        """
+        return a value that changes whenever one of the shards changed
+        """
+        return tuple(self._fan_out('generation'))
+
+
+    def set_cancel_check(self, check, interval=10000):
+        """
+        see BookDatabase.set_cancel_check(), the check is called from the
+        shard threads
+        """
+        self._cancel_check = check and (check, interval)
+
+
+    def interrupt(self):
+        """
+        abort the queries running in the shards
+        """
+        for db in self._dbs:
+            db.interrupt()
+
+
+    def _merge_titles(self, method, *args):
+        """
+        call a method that returns books ordered by title on all shards and
+        merge the results, see _fan_out(). after (args[-2]) and limit
+        (args[-1]) are passed on.
+        """
+        args = list(args)
+        after, limit = args[-2:]
+        calls = []
+        for shard in range(len(self._dbs)):
+            calls.append(args[:-2] + [_shard_after(after, shard), limit])
+        results = self._call(range(len(self._dbs)), method, calls=calls)
+        return _merge(results, limit, lambda book:
+                      (_nocase(book.title), book.bid))
+
+
+    def _fan_out(self, method, *args):
+        return self._call(range(len(self._dbs)), method, *args)
+
+
+    def _call(self, shards, method, *args, **kwargs):
+        """
+        call a BookDatabase method in the threads of the shards at the same
+        time and return their results, books get composite ids. shards
+        that don't answer in time get None.
+
+        calls - optional, a list of arguments per shard instead of args
+        """
+        calls = kwargs.get('calls') or [args] * len(shards)
+        stop = threading.Event()
+        deadline = time.time() + self.timeout
+        jobs = []
+        for shard, call in zip(shards, calls):
+            jobs.append(self._threads[shard].apply_async(
+                _run, (self._dbs[shard], shard, method, call,
+                       self._cancel_check, stop)))
+        results = []
+        self.missing = []
+        try:
+            for shard, job in zip(shards, jobs):
+                try:
+                    results.append(job.get(max(deadline - time.time(), 0)))
+                except TimeoutError:
+                    self.missing.append(self.roots[shard].name)
+                    results.append(None)
+        finally:
+            stop.set() # cancels the queries of shards that are too slow
+        return results
+
+
+def _run(db, shard, method, args, cancel_check, stop):
+    """
+    run a BookDatabase method in the thread of a shard. the query is
+    cancelled if stop is set or cancel_check (check, interval) says so.
+    """
+    check, interval = cancel_check or (None, 10000)
+    cancelled = lambda: stop.is_set() or (check is not None and check())
+    db.set_cancel_check(cancelled, interval)
+    try:
+        result = getattr(db, method)(*args)
+    except Exception:
+        if stop.is_set():
+            return None # nobody is waiting for it anymore
+        raise
+    finally:
+        db.set_cancel_check(None)
+    # books, (score, book) tuples or a single book
+    for item in isinstance(result, list) and result or [result]:
+        book = isinstance(item, tuple) and item[1] or item
+        if isinstance(book, Book):
+            book.bid = composite_id(book.bid, shard)
+    return result
+
+
+def _merge(results, limit, key):
+    """
+    merge lists that are sorted by key into one list with at most limit
+    items (a k-way merge over a heap). None results are skipped.
+    """
+    merged = heapq.merge(*[((key(item), item) for item in result)
+                           for result in results if result is not None])
+    items = []
+    for _, item in merged:
+        if limit is not None and len(items) == limit:
+            break
+        items.append(item)
+    return items
+
+
+def _interleave(results, limit):
+    """
+    take the best book of every shard in turn
+    """
+    books = []
+    results = [r for r in results if r]
+    for i in range(max([len(r) for r in results] or [0])):
+        books += [r[i] for r in results if i < len(r)]
+    return limit is None and books or books[:limit]
+
+
+def _shard_after(after, shard):
+    """
+    return the Book to pass as after to a shard, so that its books come
+    after the book with the composite id after.bid in the merged order
+    """
+    if after is None:
+        return None
+    bid, after_shard = split_id(after.bid)
+    if shard > after_shard:
+        bid -= 1 # same local id sorts after the book in a later shard
+    return Book(after.title, after.filename, after.path, bid=bid)
+
+
+def _nocase(title):
+    """
+    fold a title the way sqlite's nocase collation does (ascii only), so
+    the order of the shards' results is kept when merging
+    """
+    return (title or u'').translate(_ASCII_LOWER)
+
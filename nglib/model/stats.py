@@ -0,0 +1,296 @@
+# encoding: utf-8
+
+"""
+@summary: timers and counters for finding out where reloads and searches spend their time
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+from __future__ import with_statement
+import ctypes
+import ctypes.util
+import json
+import sys
+import threading
+import time
+
+
+# (counter, timers) pairs reported as the counter per second of the timers
+RATES = (('rows_written', ('db_write', 'db_commit')),
+         ('rows_read', ('query',)),
+         ('files_seen', ('walk',)),
+         ('metadata_parsed', ('metadata',)),
+         ('files_added', ('add_books',)),
+         ('files_checked', ('sync_books',)))
+
+_CLOCK_MONOTONIC = 1 # on linux
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _monotonic_clock():
+    """
+    return a function that reads a monotonic clock in seconds, so timers
+    aren't thrown off when the system time is set. clock_gettime() is
+    called through ctypes on linux, elsewhere time.time() is used.
+    """
+    if not sys.platform.startswith('linux'):
+        return time.time
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+    except (OSError, AttributeError):
+        return time.time
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+    def clock():
+        ts = _Timespec()
+        if clock_gettime(_CLOCK_MONOTONIC, ctypes.byref(ts)):
+            return time.time()
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return clock
+
+clock = _monotonic_clock()
+
+
+class Stats(object):
+    """
+    collects timers and counters while the library is reloaded or
+    searched. timers add up the seconds spent in a phase and count how
+    often it was entered, counters add up things like files seen or rows
+    written. a Stats object can be shared by threads.
+    functions that take one use NULL_STATS by default, which does nothing,
+    so the instrumentation costs next to nothing unless it is wanted.
+    """
+    enabled = True
+
+    def __init__(self, callback=None):
+        """
+        create an empty Stats object
+
+        callback - optional, called with (kind, name, value) for every
+                   change. kind is 'time' (value is seconds) or 'count'
+        """
+        self.timers = {} # name -> [seconds, calls]
+        self.counters = {}
+        self.callback = callback
+        self._lock = threading.Lock()
+
+
+    def count(self, name, value=1):
+        """
+        add value to a counter
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+        if self.callback is not None:
+            self.callback('count', name, value)
+
+
+    def add_time(self, name, seconds, calls=1):
+        """
+        add seconds to a timer
+        """
+        with self._lock:
+            timer = self.timers.setdefault(name, [0.0, 0])
+            timer[0] += seconds
+            timer[1] += calls
+        if self.callback is not None:
+            self.callback('time', name, seconds)
+
+
+    def timer(self, name):
+        """
+        return a context manager that adds the time spent in it to a timer
+        """
+        return _Timer(self, name)
+
+
+    def timed(self, iterable, name, exclude=None):
+        """
+        generator that yields the items of iterable and adds the time spent
+        waiting for them to a timer. the timer counts one call per
+        iteration, not per item.
+
+        exclude - optional, name of another timer. time added to it while
+                  waiting (by a nested timed() iterable) isn't counted
+        """
+        items = iter(iterable)
+        calls = 0
+        try:
+            while True:
+                nested = exclude and self.seconds(exclude)
+                start = clock()
+                try:
+                    item = items.next()
+                except StopIteration:
+                    item = _DONE
+                elapsed = clock() - start
+                if exclude:
+                    elapsed -= self.seconds(exclude) - nested
+                calls += 1
+                self.add_time(name, elapsed, calls == 1 and 1 or 0)
+                if item is _DONE:
+                    return
+                yield item
+        finally:
+            if hasattr(items, 'close'):
+                items.close() # a generator stopped early cleans up now
+
+
+    def seconds(self, name):
+        """
+        return the seconds added to a timer so far
+        """
+        return self.timers.get(name, (0.0, 0))[0]
+
+
+    def rate(self, counter, timers):
+        """
+        return a counter per second of the given timers, None if no time
+        was spent in them
+        """
+        seconds = sum(self.seconds(t) for t in timers)
+        if seconds <= 0 or counter not in self.counters:
+            return None
+        return self.counters[counter] / seconds
+
+
+    def as_dict(self):
+        """
+        return the timers, counters and RATES as a dict that can be dumped
+        as json
+        """
+        with self._lock:
+            result = {'timers': dict((name, {'seconds': round(t[0], 6),
+                                             'calls': t[1]})
+                                     for name, t in self.timers.items()),
+                      'counters': dict(self.counters)}
+        rates = {}
+        for counter, timers in RATES:
+            rate = self.rate(counter, timers)
+            if rate is not None:
+                rates[counter + '_per_second'] = round(rate, 1)
+        result['rates'] = rates
+        return result
+
+
+    def dump(self, out):
+        """
+        write as_dict() as json to a file object
+        """
+        json.dump(self.as_dict(), out, indent=2, sort_keys=True)
+        out.write('\n')
+
+
+    def report(self):
+        """
+        return a list of lines describing the timers, counters and rates
+        """
+        stats = self.as_dict()
+        lines = ['%-28s %10.3fs %8d calls' % (name, timer['seconds'],
+                                               timer['calls'])
+                 for name, timer in sorted(stats['timers'].items())]
+        lines += ['%-28s %10d' % item for item in
+                  sorted(stats['counters'].items())]
+        lines += ['%-28s %10.1f' % item for item in
+                  sorted(stats['rates'].items())]
+        return lines
+
+
+    def reset(self):
+        """
+        forget all timers and counters
+        """
+        with self._lock:
+            self.timers.clear()
+            self.counters.clear()
+
+
+class NullStats(Stats):
+    """
+    a Stats object that ignores everything, see NULL_STATS
+    """
+    enabled = False
+
+    def __init__(self):
+        Stats.__init__(self)
+
+
+    def count(self, name, value=1):
+        pass
+
+
+    def add_time(self, name, seconds, calls=1):
+        pass
+
+
+    def timer(self, name):
+        return _NULL_TIMER
+
+
+    def timed(self, iterable, name, exclude=None):
+        return iterable
+
+
+class _Timer(object):
+    """
+    context manager returned by Stats.timer()
+    """
+    def __init__(self, stats, name):
+        self._stats = stats
+        self._name = name
+
+
+    def __enter__(self):
+        self._start = clock()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stats.add_time(self._name, clock() - self._start)
+        return False
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+_DONE = object()
+
+NULL_STATS = NullStats()
@@ -0,0 +1,142 @@
+# encoding: utf-8
+
+"""
+@summary: trigram index for finding words similar to misspelled ones
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+from array import array
+
+
+class TrigramIndex(object):
+    """
+    an in-memory index of words by their trigrams (the word is padded with
+    $ at both ends, so "gibson" has the trigrams $gi gib ibs bso son on$).
+    similar() finds the words within an edit distance of a misspelled word
+    by looking only at the words that share enough trigrams with it, so a
+    lookup doesn't get slower with every word added.
+    """
+    def __init__(self, words=()):
+        """
+        words - optional, iterable of unicode words to add
+        """
+        self._words = []
+        self._ids = {}
+        self._postings = {} # trigram -> array of word ids
+        for word in words:
+            self.add(word)
+
+
+    def add(self, word):
+        """
+        add a word, adding it again does nothing
+        """
+        if word in self._ids:
+            return
+        wid = self._ids[word] = len(self._words)
+        self._words.append(word)
+        for gram in set(trigrams(word)):
+            postings = self._postings.get(gram)
+            if postings is None:
+                postings = self._postings[gram] = array('l')
+            postings.append(wid)
+
+
+    def similar(self, word, max_distance, limit=None):
+        """
+        return a list of (edit distance, word) tuples for the indexed words
+        within max_distance edits of word, closest first
+
+        word - unicode word
+        max_distance - maximum number of insertions, deletions and
+                       substitutions
+        limit - optional, maximum number of words to return
+        """
+        grams = set(trigrams(word))
+        counts = {}
+        for gram in grams:
+            for wid in self._postings.get(gram, ()):
+                counts[wid] = counts.get(wid, 0) + 1
+
+        # every edit destroys at most three trigrams
+        needed = max(len(grams) - 3 * max_distance, 1)
+        result = []
+        for wid, count in counts.iteritems():
+            if count < needed:
+                continue
+            candidate = self._words[wid]
+            if abs(len(candidate) - len(word)) > max_distance:
+                continue
+            distance = edit_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                result.append((distance, candidate))
+        result.sort()
+        if limit is not None:
+            result = result[:limit]
+        return result
+
+
+    def __len__(self):
+        return len(self._words)
+
+
+    def __contains__(self, word):
+        return word in self._ids
+
+
+def trigrams(word):
+    """
+    return the trigrams of a word padded with $
+    """
+    word = u'$%s$' % word
+    return [word[i:i+3] for i in range(len(word) - 2)]
+
+
+def edit_distance(a, b, limit=None):
+    """
+    return the levenshtein distance between a and b. if limit is given, the
+    computation stops as soon as the distance is known to be larger and
+    limit + 1 is returned.
+    """
+    if limit is None:
+        limit = max(len(a), len(b))
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = range(len(b) + 1)
+    for i, ca in enumerate(a):
+        current = [i + 1]
+        for j, cb in enumerate(b):
+            current.append(min(previous[j + 1] + 1, current[j] + 1,
+                               previous[j] + (ca != cb)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return min(previous[-1], limit + 1)
@@ -0,0 +1,77 @@
+# encoding: utf-8
+
+"""
+@summary: helpers for running jobs in a pool of worker processes
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+from multiprocessing import Pool
+from multiprocessing import cpu_count
+
+
+def default_workers(workers=None):
+    """
+    return workers, or the number of cpus if it is None (1 if that can't
+    be told)
+    """
+    if workers is None:
+        try:
+            workers = cpu_count()
+        except NotImplementedError:
+            workers = 1
+    return workers
+
+
+def pool_map(function, jobs, workers, chunk_size=4):
+    """
+    generator that yields function(job) for every job, in no particular
+    order. the jobs are run in a pool of worker processes if there is more
+    than one worker and more than one job, otherwise in-process. the pool
+    is terminated when the generator is closed or exhausted.
+
+    function - picklable function that takes one job
+    jobs - list of picklable jobs
+    workers - number of worker processes
+    chunk_size - number of jobs sent to a worker at once
+    """
+    pool = None
+    if workers > 1 and len(jobs) > 1:
+        pool = Pool(workers)
+        results = pool.imap_unordered(function, jobs, chunk_size)
+    else:
+        results = (function(job) for job in jobs)
+    try:
+        for result in results:
+            yield result
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,542 @@
+# encoding: utf-8
+
+"""
+@summary: unit tests for the controller module
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+import errno
+import os
+import shutil
+import time
+import unittest
+from collections import namedtuple
+from tempfile import mkdtemp
+from tempfile import mkstemp
+from os.path import join as pjoin
+
+from nglib.controller import Controller
+from nglib.controller import LruCache
+from nglib.controller import add_books
+from nglib.controller import sync_books
+from nglib.model.bookdatabase import BookDatabase
+from nglib.model.bookdatabase import SORT_RELEVANCE
+from nglib.model.bookdatabase import SearchCancelled
+from nglib.model.configurationstore import ConfigurationStore
+from nglib.model.configurationstore import NgLibError
+from nglib.model.configurationstore import library_roots
+from nglib.model.filescanner import FileScanner
+from nglib.model.inotify import WatchLimitError
+from nglib.model.metadatacache import cache_file
+from nglib.model.shards import open_database
+from nglib.model.stats import Stats
+from nglib.tests.modeltests import PDF_OBJECTS
+from nglib.tests.modeltests import make_chm
+from nglib.tests.modeltests import make_pdf
+from nglib.watcher import LibraryWatcher
+
+Config = namedtuple('Config', 'dir dbfile')
+
+
+class SyncBooksTest(unittest.TestCase):
+    """
+    test incremental library updates
+    """
+
+    def setUp(self):
+        self.libdir = mkdtemp()
+        os.mkdir(pjoin(self.libdir, 'papers'))
+        fd, self.tmpfile = mkstemp('.db')
+        os.close(fd)
+        os.unlink(self.tmpfile)
+        self.db = BookDatabase(self.tmpfile)
+
+
+    def tearDown(self):
+        self.db.close()
+        os.unlink(self.tmpfile)
+        shutil.rmtree(self.libdir)
+
+
+    def touch(self, *names):
+        path = pjoin(self.libdir, *names)
+        f = open(path, 'w')
+        f.write(path)
+        f.close()
+        return path
+
+
+    def sync(self):
+        return list(sync_books(self.libdir, self.db))[-1]
+
+
+    def testSync(self):
+        self.touch('neuromancer.pdf')
+        self.touch('papers', 'snow.crash.chm')
+        self.touch('papers', 'notes.txt')
+        self.touch('.hidden.pdf')
+        self.assertEqual(self.sync(), (2, 2, 2, 0, 0))
+        self.assertEqual(self.sync(), (2, 2, 0, 0, 0))
+
+        os.unlink(pjoin(self.libdir, 'neuromancer.pdf'))
+        self.touch('count_zero.pdf')
+        f = open(pjoin(self.libdir, 'papers', 'snow.crash.chm'), 'a')
+        f.write('more data')
+        f.close()
+        self.assertEqual(self.sync(), (2, 2, 1, 1, 1))
+
+        titles = sorted(book.title for book in self.db.get_all())
+        self.assertEqual(titles, [u'count_zero', u'snow crash'])
+
+
+    def testUnreadableDirectory(self):
+        self.touch('neuromancer.pdf')
+        self.touch('papers', 'snow.crash.chm')
+        self.assertEqual(self.sync(), (2, 2, 2, 0, 0))
+        papers = pjoin(self.libdir, 'papers')
+        def failing(list_dir):
+            def wrapper(scanner, path):
+                if path == papers:
+                    raise OSError(errno.EIO, 'input/output error')
+                return list_dir(scanner, path)
+            return wrapper
+        scandir, listdir = FileScanner._scandir, FileScanner._listdir
+        FileScanner._scandir = failing(scandir)
+        FileScanner._listdir = failing(listdir)
+        try:
+            self.assertEqual(self.sync(), (1, 1, 0, 0, 0))
+        finally:
+            FileScanner._scandir, FileScanner._listdir = scandir, listdir
+        self.assertEqual(len(self.db.get_all()), 2)
+        shutil.rmtree(papers)
+        self.assertEqual(self.sync(), (1, 1, 0, 1, 0))
+
+
+    def testAddBooks(self):
+        for i in range(7):
+            self.touch('papers', 'paper%d.pdf' % i)
+        progress = list(add_books(self.libdir, self.db, add_per_run=5))
+        self.assertEqual(progress[-1], (2, 7, 7))
+        self.assertEqual(len(self.db.get_all()), 7)
+        self.assertEqual(self.sync(), (7, 7, 0, 0, 0))
+
+
+    def testAddBooksMetadata(self):
+        f = open(pjoin(self.libdir, 'n.pdf'), 'wb')
+        f.write(make_pdf(PDF_OBJECTS, '/Root 1 0 R /Info 2 0 R'))
+        f.close()
+        f = open(pjoin(self.libdir, 'papers', 's.chm'), 'wb')
+        f.write(make_chm('Snow Crash'))
+        f.close()
+        list(add_books(self.libdir, self.db, workers=2))
+        books = sorted((b.title, b.author, b.pages) for b in self.db.get_all())
+        self.assertEqual(books, [(u'Neuromancer (1984)', u'Gibson', 271),
+                                 (u'Snow Crash', u'', 0)])
+
+
+    def testStats(self):
+        for i in range(3):
+            self.touch('papers', 'paper%d.pdf' % i)
+        stats = Stats()
+        self.db.stats = stats
+        list(add_books(self.libdir, self.db, workers=1))
+        self.assertEqual(stats.counters['files_seen'], 3)
+        self.assertEqual(stats.counters['files_added'], 3)
+        self.assertEqual(stats.counters['metadata_parsed'], 3)
+        self.assertEqual(stats.counters['rows_written'], 3)
+        self.assertTrue(stats.counters['metadata_file_bytes'] > 0)
+        for name in ('walk', 'metadata', 'db_write', 'db_commit',
+                     'add_books'):
+            self.assertEqual(stats.timers[name][1], 1)
+        self.assertTrue(stats.seconds('metadata') <=
+                        stats.seconds('add_books'))
+
+        stats.reset()
+        self.touch('papers', 'paper3.pdf')
+        list(sync_books(self.libdir, self.db, workers=1))
+        self.assertEqual((stats.counters['files_checked'],
+                          stats.counters['files_skipped'],
+                          stats.counters['files_added'],
+                          stats.counters['metadata_parsed']), (4, 3, 1, 1))
+        self.assertTrue('files_checked_per_second' in stats.as_dict()['rates'])
+
+        ctrl = Controller(self.db, None)
+        ctrl.search('paper')
+        ctrl.search('paper')
+        self.assertEqual((stats.counters['searches'],
+                          stats.counters['search_cache_hits'],
+                          stats.counters['books_found'],
+                          stats.counters['rows_read']), (2, 1, 8, 4))
+        self.assertEqual(stats.timers['query'][1], 1)
+
+
+
+class ControllerTest(unittest.TestCase):
+    """
+    test searching through the controller
+    """
+
+    def setUp(self):
+        fd, self.tmpfile = mkstemp('.db')
+        os.close(fd)
+        os.unlink(self.tmpfile)
+        self.db = BookDatabase(self.tmpfile)
+        for title in ('snow crash', 'snowblind', 'the diamond age'):
+            self.db.add('/books/%s.pdf' % title, title, 'neal stephenson')
+        self.ctrl = Controller(self.db, None)
+
+
+    def tearDown(self):
+        self.db.close()
+        os.unlink(self.tmpfile)
+
+
+    def testSearchIncremental(self):
+        self.assertEqual(len(self.ctrl.get_all()), 3)
+        self.assertEqual(self.ctrl.search_incremental('s').titles,
+                         [u'snow crash', u'snowblind', u'the diamond age'])
+        calls = []
+        book_list = self.db.book_list
+        def counting_book_list(*args, **kwargs):
+            calls.append(args)
+            return book_list(*args, **kwargs)
+        self.db.book_list = counting_book_list
+        self.assertEqual(self.ctrl.search_incremental('snow').titles,
+                         [u'snow crash', u'snowblind'])
+        self.assertEqual(self.ctrl.search_incremental('snow c').titles,
+                         [u'snow crash'])
+        self.assertEqual(calls, []) # narrowed down without a query
+
+        self.db.set_cancel_check = lambda check: \
+            BookDatabase.set_cancel_check(self.db, check, 1)
+        self.assertRaises(SearchCancelled, self.ctrl.search_incremental,
+                          'diamond', lambda: True)
+        self.assertEqual(self.ctrl.search_incremental('diamond').titles,
+                         [u'the diamond age'])
+        self.assertEqual(self.ctrl.search_incremental('dia').titles,
+                         [u'the diamond age'])
+
+
+    def testSearchIncrementalByRelevance(self):
+        # the console interface ranks by relevance unless told otherwise
+        self.db.add('/books/crash.pdf', 'crash', 'j. g. ballard')
+        self.db.add('/books/blind.pdf', 'blind snow', 'nobody')
+        terms = []
+        book_list = self.db.book_list
+        def counting_book_list(term=None, **kwargs):
+            terms.append(term)
+            return book_list(term, **kwargs)
+        self.db.book_list = counting_book_list
+        for term in ('s', 'sn', 'snow', 'snow c', 'snow cr'):
+            books = self.ctrl.search_incremental(term, sort=SORT_RELEVANCE)
+            self.assertEqual(books.titles, [b.title for b in
+                                            self.db.rank_search(term)])
+        self.assertEqual(books.titles, [u'snow crash'])
+        self.assertEqual(terms, ['s'])
+        # results ranked by relevance aren't narrowed down by title
+        self.assertEqual(self.ctrl.search_incremental('snow cra').titles,
+                         [u'snow crash'])
+        self.assertEqual(terms, ['s', 'snow cra'])
+
+
+    def testSearchAfterGetAll(self):
+        self.ctrl.get_all()
+        terms = []
+        book_list = self.db.book_list
+        def counting_book_list(term=None, **kwargs):
+            terms.append(term)
+            return book_list(term, **kwargs)
+        self.db.book_list = counting_book_list
+        # the first letter is an indexed query, not a filter of all books
+        self.assertEqual(self.ctrl.search_incremental('s').titles,
+                         [u'snow crash', u'snowblind', u'the diamond age'])
+        self.assertEqual(self.ctrl.search_incremental('sn').titles,
+                         [u'snow crash', u'snowblind'])
+        self.assertEqual(terms, ['s'])
+
+
+    def testResultCache(self):
+        self.assertEqual(self.ctrl.search('snow').titles,
+                         [u'snow crash', u'snowblind'])
+        self.assertTrue(self.ctrl.search('snow') is self.ctrl.search('snow'))
+        self.assertEqual(self.ctrl.get_book(1).title, u'snow crash')
+        self.assertEqual(self.ctrl.get_book(1).title, u'snow crash')
+        self.assertEqual(self.ctrl.cache_info(), (3, 2, 2, 32))
+
+        self.db.remove('/books/snowblind.pdf')
+        self.assertEqual(self.ctrl.search('snow').titles, [u'snow crash'])
+        self.assertEqual(self.ctrl.cache_info().size, 1)
+
+        other = BookDatabase(self.tmpfile)
+        other.add('/books/snow white.pdf', 'snow white', 'grimm')
+        other.close()
+        self.assertEqual(self.ctrl.search('snow').titles,
+                         [u'snow crash', u'snow white'])
+
+
+    def testLruCache(self):
+        cache = LruCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.get('a'), cache.get('c')), (1, 3))
+        self.assertEqual(cache.hit_rate(), 0.75)
+        self.assertEqual(len(cache), 2)
+
+
+class WorkerTest(unittest.TestCase):
+    """
+    test the background worker of the controller
+    """
+
+    def setUp(self):
+        self.libdir = mkdtemp()
+        for name in ('neuromancer.pdf', 'count_zero.pdf', 'idoru.chm'):
+            open(pjoin(self.libdir, name), 'w').close()
+        fd, dbfile = mkstemp('.db')
+        os.close(fd)
+        os.unlink(dbfile)
+        self.config = Config(dir=self.libdir, dbfile=dbfile)
+        self.ctrl = Controller(BookDatabase(dbfile), self.config)
+        self.ctrl.start_worker()
+
+
+    def tearDown(self):
+        self.ctrl.close()
+        os.unlink(self.config.dbfile)
+        os.unlink(cache_file(self.config.dbfile))
+        shutil.rmtree(self.libdir)
+
+
+    def wait(self, kinds):
+        events = []
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            events += self.ctrl.poll_events()
+            if events and events[-1].kind in kinds:
+                return events
+            time.sleep(0.01)
+        self.fail('worker timed out, got %r' % events)
+
+
+    def testReloadAndSearch(self):
+        self.ctrl.get_all_async()
+        self.assertEqual(len(self.wait(['books'])[-1].data), 0)
+
+        job = self.ctrl.reload_library_async()
+        events = self.wait(['done'])
+        self.assertEqual([e.job for e in events], [job] * len(events))
+        self.assertEqual(events[-1].data.added, 3)
+
+        self.ctrl.search_async('count')
+        stale = self.ctrl.search_async('neuro')
+        events = self.wait(['books'])
+        self.assertEqual([e.job for e in events if e.kind == 'books'],
+                         [stale])
+        self.assertEqual(events[-1].data.titles, [u'neuromancer'])
+        self.assertEqual(self.ctrl._books.titles, [u'neuromancer'])
+
+
+    def testCancelReload(self):
+        self.ctrl.reload_library_async(rebuild=True)
+        self.ctrl.cancel_async()
+        self.assertEqual(self.wait(['cancelled', 'done'])[-1].kind,
+                         'cancelled')
+
+
+class LibraryRootsTest(unittest.TestCase):
+    """
+    test a library with several roots
+    """
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        os.mkdir(pjoin(self.tmpdir, 'books'))
+        os.mkdir(pjoin(self.tmpdir, 'papers'))
+        for name in ('books/neuromancer.pdf', 'papers/idoru.pdf'):
+            open(pjoin(self.tmpdir, name), 'w').close()
+        self.config = ConfigurationStore(pjoin(self.tmpdir, 'nglibrc'))
+        self.config.dir = pjoin(self.tmpdir, 'books')
+        self.config.dbfile = pjoin(self.tmpdir, 'books.db')
+        self.config.roots['papers'] = pjoin(self.tmpdir, 'papers')
+        self.config.roots['usb'] = pjoin(self.tmpdir, 'unmounted')
+        usb = BookDatabase(library_roots(self.config)[2].dbfile)
+        usb.add(pjoin(self.tmpdir, 'unmounted', 'count_zero.pdf'),
+                'count zero', '')
+        usb.close()
+        self.ctrl = Controller(open_database(library_roots(self.config)),
+                               self.config)
+
+
+    def tearDown(self):
+        self.ctrl.close()
+        shutil.rmtree(self.tmpdir)
+
+
+    def testReload(self):
+        progress = list(self.ctrl.reload_library())
+        self.assertEqual(progress[-1].added, 2)
+        self.assertEqual(self.ctrl.get_all().titles,
+                         [u'count zero', u'idoru', u'neuromancer'])
+
+        os.unlink(pjoin(self.tmpdir, 'books', 'neuromancer.pdf'))
+        os.mkdir(pjoin(self.tmpdir, 'books', 'unsorted')) # not empty then
+        open(pjoin(self.tmpdir, 'papers', 'snow crash.pdf'), 'w').close()
+        progress = list(self.ctrl.reload_library(root='papers'))
+        self.assertEqual((progress[-1].added, progress[-1].removed), (1, 0))
+        self.assertEqual(self.ctrl.get_all().titles,
+                         [u'count zero', u'idoru', u'neuromancer',
+                          u'snow crash'])
+        self.assertEqual(self.ctrl.search('snow').titles, [u'snow crash'])
+        self.assertRaises(NgLibError, self.ctrl.reload_library, root='nas')
+
+        # a rebuild doesn't hide the books until it is finished
+        progress = self.ctrl.reload_library(rebuild=True)
+        progress.next()
+        self.assertEqual(len(self.ctrl.get_all()), 4)
+        list(progress)
+        self.assertEqual(self.ctrl.get_all().titles,
+                         [u'count zero', u'idoru', u'snow crash'])
+        self.assertFalse(os.path.exists(pjoin(self.tmpdir,
+                                              'books.db.rebuild')))
+
+
+    def testUnmountedRoot(self):
+        list(self.ctrl.reload_library())
+        os.unlink(pjoin(self.tmpdir, 'papers', 'idoru.pdf'))
+        progress = list(self.ctrl.reload_library())
+        self.assertEqual(progress[-1].removed, 0)
+        self.assertEqual(self.ctrl.get_all().titles,
+                         [u'count zero', u'idoru', u'neuromancer'])
+        self.assertEqual(list(self.ctrl.reload_library(rebuild=True,
+                                                       root='papers')), [])
+
+
+    def testSlowShard(self):
+        list(self.ctrl.reload_library())
+        db = self.ctrl._db
+        shard = db._dbs[1]
+        search = shard.search
+        def slow_search(*args, **kwargs):
+            time.sleep(0.5)
+            return search(*args, **kwargs)
+        shard.search = slow_search
+        db.timeout = 0.1
+        self.assertEqual(self.ctrl.search('idoru').titles, [])
+        self.assertEqual(self.ctrl.search_incremental('ido').titles, [])
+        self.assertEqual(db.missing, ['papers'])
+        shard.search = search
+        db.timeout = 5
+        # incomplete results are neither cached nor narrowed down
+        self.assertEqual(self.ctrl.search('idoru').titles, [u'idoru'])
+        self.assertEqual(self.ctrl.search_incremental('idoru').titles,
+                         [u'idoru'])
+
+
+class LibraryWatcherTest(unittest.TestCase):
+    """
+    test keeping the database in sync with inotify
+    """
+
+    def setUp(self):
+        self.libdir = mkdtemp()
+        open(pjoin(self.libdir, 'neuromancer.pdf'), 'w').close()
+        fd, self.tmpfile = mkstemp('.db')
+        os.close(fd)
+        os.unlink(self.tmpfile)
+        self.db = BookDatabase(self.tmpfile)
+        self.watcher = LibraryWatcher(self.libdir, self.db, delay=0.05,
+                                      workers=1)
+
+
+    def tearDown(self):
+        self.watcher.close()
+        self.db.close()
+        os.unlink(self.tmpfile)
+        shutil.rmtree(self.libdir)
+
+
+    def titles(self):
+        return sorted(b.title for b in self.db.get_all())
+
+
+    def testWatch(self):
+        self.assertEqual(self.watcher.start().added, 1)
+        if self.watcher.polling:
+            return # no inotify here
+        os.mkdir(pjoin(self.libdir, 'sprawl'))
+        os.rename(pjoin(self.libdir, 'neuromancer.pdf'),
+                  pjoin(self.libdir, 'sprawl', 'neuromancer.pdf'))
+        open(pjoin(self.libdir, 'sprawl', 'count_zero.pdf'), 'w').close()
+        open(pjoin(self.libdir, 'sprawl', 'notes.txt'), 'w').close()
+        progress = self.watcher.step(timeout=5)
+        self.assertEqual((progress.added, progress.removed), (2, 1))
+        self.assertEqual(self.titles(), [u'count_zero', u'neuromancer'])
+        self.assertEqual(self.db.get_all()[0].path,
+                         pjoin(self.libdir, 'sprawl'))
+
+        os.rename(pjoin(self.libdir, 'sprawl'), pjoin(self.libdir, 'gibson'))
+        os.mkdir(pjoin(self.libdir, 'gibson', 'bridge'))
+        open(pjoin(self.libdir, 'gibson', 'bridge', 'idoru.chm'), 'w').close()
+        self.watcher.step(timeout=5)
+        self.assertEqual(self.titles(),
+                         [u'count_zero', u'idoru', u'neuromancer'])
+        self.assertEqual(sorted(set(b.path for b in self.db.get_all())),
+                         [pjoin(self.libdir, 'gibson'),
+                          pjoin(self.libdir, 'gibson', 'bridge')])
+
+        shutil.rmtree(pjoin(self.libdir, 'gibson'))
+        self.watcher.step(timeout=5)
+        self.assertEqual(self.titles(), [])
+
+
+    def testDeleteRoot(self):
+        self.watcher.start()
+        if self.watcher.polling:
+            return # no inotify here
+        # a book the watcher hasn't seen a file event for
+        self.db.add(pjoin(self.libdir, 'sub', 'idoru.pdf'), 'idoru', '')
+        shutil.rmtree(self.libdir)
+        self.watcher.step(timeout=5)
+        self.assertEqual(self.titles(), [])
+        os.mkdir(self.libdir)
+
+
+    def testFallBack(self):
+        self.watcher.rescan_interval = 0.05
+        self.watcher._fall_back(WatchLimitError('no more watches'))
+        open(pjoin(self.libdir, 'count_zero.pdf'), 'w').close()
+        self.assertEqual(self.watcher.step(timeout=5).added, 2)
+
+if __name__ == "__main__":
+    unittest.main()
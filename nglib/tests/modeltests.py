@@ -33,14 +33,51 @@ SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 For more Information see http://netgarage.org
 """
 
+from __future__ import with_statement
 import os
+import shutil
 import sqlite3
+import threading
+import struct
+import time
 import unittest
+import zlib
+from tempfile import mkdtemp
 from tempfile import gettempdir
 from tempfile import mkstemp 
 from os.path import join as pjoin
 
 from nglib.model.bookdatabase import BookDatabase
+from nglib.model.bookdatabase import BookList
+from nglib.model.bookdatabase import SCHEMA_VERSION
+from nglib.model.bookdatabase import SearchCancelled
+from nglib.model.bookdatabase import find_duplicates
+from nglib.model.filescanner import FileScanner
+from nglib.model.chmreader import read_chm_metadata
+from nglib.model import metadata
+from nglib.model.contentindex import ContentIndexer
+from nglib.model.filehash import PARTIAL_SIZE
+from nglib.model.filehash import FileHasher
+from nglib.model.filehash import hash_file
+from nglib.model.metadata import MetadataExtractor
+from nglib.model.metadatacache import MetadataCache
+from nglib.model.pdfreader import PdfReader
+from nglib.model.configurationstore import ConfigurationStore
+from nglib.model.configurationstore import NgLibError
+from nglib.model.configurationstore import library_roots
+from nglib.model.query import QueryError
+from nglib.model.shards import ShardedDatabase
+from nglib.model.shards import composite_id
+from nglib.model.shards import open_database
+from nglib.model.shards import split_id
+from nglib.model.stats import NULL_STATS
+from nglib.model.stats import Stats
+from nglib.model.trigramindex import TrigramIndex
+from nglib.model.trigramindex import edit_distance
+from nglib.model.workers import default_workers
+from nglib.model.workers import pool_map
+from nglib.model.pdfreader import read_pdf_metadata
+from nglib.model.pdfreader import read_pdf_text
 
 class BookDatabaseTest(unittest.TestCase):
     """
@@ -90,7 +127,7 @@ class BookDatabaseTest(unittest.TestCase):
         self.db.close()
         db = sqlite3.connect(self.tmpfile)
         cursor = db.cursor()
-        cursor.execute('select * from books')
+        cursor.execute('select title, author, filename, path from books')
         result = cursor.fetchall()
         self.assertEqual(len(result), 1)
         self.assertEqual(len(result[0]), len(testbook)+1)
@@ -104,6 +141,1091 @@ class BookDatabaseTest(unittest.TestCase):
         db.close()
 
 
+    def testUpdate(self):
+        path, title, author = self.testbooks[2]
+        self.db.add(path, title, author)
+        stat = os.stat(self.tmpfile)
+        self.db.update(path, u'count zero', author, stat)
+        states = self.db.get_file_states()
+        key = (self.bookspath, os.path.basename(path))
+        self.assertEqual(states[key],
+                         (stat.st_size, stat.st_mtime, stat.st_ino))
+        self.assertEqual(self.db.search('count')[0].title, u'count zero')
+
+
+    def testAddMany(self):
+        books = [book + (None,) for book in self.testbooks]
+        self.assertEqual(self.db.add_many(books, batch_size=3), 4)
+        self.assertEqual(len(self.db.get_all()), 4)
+
+
+    def testBatchWriter(self):
+        path, title, author = self.testbooks[0]
+        with self.db.batch() as batch:
+            batch.add(path, title, author)
+            batch.remove(path)
+            batch.add(*self.testbooks[1])
+        self.assertEqual([b.author for b in self.db.get_all()],
+                         [u'douglas adams'])
+
+        try:
+            with self.db.batch() as batch:
+                batch.add(path, title, author)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(len(self.db.get_all()), 1)
+
+
+    def testAddTwice(self):
+        path, title, author = self.testbooks[0]
+        self.db.add(path, title, author)
+        bid = self.db.get_all()[0].bid
+        self.db.add(path, u'cooking for geeks, 2nd edition', author)
+        books = self.db.get_all()
+        self.assertEqual(len(books), 1)
+        self.assertEqual(books[0].bid, bid)
+        self.assertEqual(books[0].title, u'cooking for geeks, 2nd edition')
+
+
+    def testMigration(self):
+        self.db.close()
+        os.unlink(self.tmpfile)
+        db = sqlite3.connect(self.tmpfile)
+        db.execute(u"""create table books
+                       (title text, author text, filename text, path text)""")
+        for path, title, author in self.testbooks + self.testbooks[:1]:
+            db.execute(u"insert into books values (?, ?, ?, ?)",
+                       (title, author, os.path.basename(path),
+                        self.bookspath))
+        db.execute(u"delete from books where title = 'neuromancer'")
+        db.commit()
+        db.close()
+
+        self.db = BookDatabase(self.tmpfile)
+        self.assertEqual([(b.bid, b.title) for b in self.db.get_all()],
+                         [(1, u'cooking for geeks'),
+                          (4, u'snow crash'),
+                          (2, u'the hitchhikers guide to the galaxy')])
+        self.assertEqual(self.db.search('crash')[0].bid, 4)
+        self.assertEqual(self.db.get_by_id(2).author, u'douglas adams')
+
+        db = sqlite3.connect(self.tmpfile)
+        self.assertEqual(db.execute(u"select version from schema_version")
+                         .fetchall(), [(SCHEMA_VERSION,)])
+        db.close()
+
+
+    def testSearch(self):
+        self.addBooks(4)
+        self.db.add(pjoin(self.bookspath, 'les_miserables.pdf'),
+                    u'les mis\xe9rables'.encode('utf8'), 'victor hugo')
+        titles = lambda term: sorted(b.title for b in self.db.search(term))
+        self.assertEqual(titles('neuro'), [u'neuromancer'])
+        self.assertEqual(titles('NEUROMANCER gibson'), [u'neuromancer'])
+        self.assertEqual(titles('miserables'), [u'les mis\xe9rables'])
+        self.assertEqual(titles('"snow crash"'), [u'snow crash'])
+        self.assertEqual(titles('"crash snow"'), [])
+        self.assertEqual(titles('hitchhikers_guide'),
+                         [u'the hitchhikers guide to the galaxy'])
+        self.assertEqual(len(titles('')), 5)
+
+
+    def testPagination(self):
+        self.addBooks(4)
+        self.db.add(pjoin(self.bookspath, 'snowcrash.chm'), 'Snow Crash', '')
+        titles = lambda books: [b.title for b in books]
+        self.assertEqual(titles(self.db.iter_all()),
+                         [u'cooking for geeks', u'neuromancer', u'snow crash',
+                          u'Snow Crash',
+                          u'the hitchhikers guide to the galaxy'])
+        first = self.db.get_all(limit=3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(titles(self.db.get_all(after=first[-1])),
+                         [u'Snow Crash', u'the hitchhikers guide to the galaxy'])
+        page = self.db.search('snow', limit=1)
+        self.assertEqual(titles(page), [u'snow crash'])
+        self.assertEqual(titles(self.db.iter_search('snow', after=page[0])),
+                         [u'Snow Crash'])
+
+        self.db._fts = False
+        self.assertEqual(titles(self.db.search('o', after=first[1], limit=2)),
+                         [u'snow crash', u'Snow Crash'])
+
+
+    def testBookList(self):
+        self.addBooks(4)
+        self.db.add(pjoin(self.bookspath, 'snowcrash.chm'), 'Snow Crash', '')
+        books = self.db.book_list('snow')
+        self.assertEqual(len(books), 2)
+        self.assertEqual(books.titles, [u'snow crash', u'Snow Crash'])
+        self.assertTrue(books.path(0) is books.path(1))
+        self.assertEqual([(b.bid, b.filetype) for b in books],
+                         [(4, u'pdf'), (5, u'chm')])
+        self.assertEqual(str(books[1]), 'Snow Crash')
+        self.assertEqual(len(self.db.book_list(limit=3)), 3)
+        self.assertEqual(list(BookList(self.db.get_all()).ids),
+                         list(self.db.book_list().ids))
+
+
+    def testMatcher(self):
+        self.addBooks(4)
+        self.db.add(pjoin(self.bookspath, 'les_miserables.pdf'),
+                    u'les mis\xe9rables'.encode('utf8'), 'victor hugo')
+        books = self.db.book_list()
+        for fts in (True, False):
+            self.db._fts = fts
+            for term in ('neuro', 'NEUROMANCER gibson', 'miserables',
+                         'hitchhikers_guide', 'mis\xc3\xa9r', 'e', 'w g',
+                         'snow -', ''):
+                self.assertEqual(books.filter(self.db.matcher(term)).titles,
+                                 self.db.book_list(term).titles, term)
+            for term in ('"snow crash"', 'snow -crash', 'author:gibson',
+                         'snow OR', '(snow'):
+                self.assertEqual(self.db.matcher(term), None)
+
+
+    def testCancel(self):
+        self.addBooks(4)
+        self.db.set_cancel_check(lambda: True, 1)
+        self.assertRaises(SearchCancelled, self.db.book_list, 'snow')
+        self.db.set_cancel_check(None)
+        self.assertEqual(len(self.db.book_list('snow')), 1)
+
+
+    def testWriteError(self):
+        self.addBooks(2)
+        self.assertRaises(sqlite3.ProgrammingError, self.db._write,
+                          [(u"delete from books", [()]),
+                           (u"delete from books where id = ?", [(1, 2)])])
+        # rolled back, the write lock isn't held anymore
+        other = BookDatabase(self.tmpfile)
+        other._pool.busy_timeout = 0.01
+        try:
+            other.add('/books/idoru.pdf', 'idoru', 'william gibson')
+        finally:
+            other.close()
+        self.assertEqual(len(self.db.get_all()), 3)
+
+
+    def testInterruptSearch(self):
+        self.addBooks(4)
+        searching = threading.Event()
+        writing = threading.Event()
+        go = threading.Event()
+        results = {}
+        def wait(started):
+            started.set()
+            go.wait(5)
+        def search():
+            self.db.set_cancel_check(lambda: wait(searching), 1)
+            try:
+                self.db.get_all()
+            except SearchCancelled:
+                results['search'] = 'cancelled'
+            self.db.set_cancel_check(None)
+            self.db.release()
+        def write():
+            self.db._dbcon.create_function('slow', 0,
+                                           lambda: wait(writing) or 1)
+            self.db._write([(u"update books set pages = slow()", [()])])
+            results['write'] = 'done'
+            self.db.release()
+        threads = [threading.Thread(target=search),
+                   threading.Thread(target=write)]
+        for thread in threads:
+            thread.start()
+        searching.wait(5)
+        writing.wait(5)
+        # only the search is cancelled, the write of the other thread isn't
+        self.db.interrupt()
+        go.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {'search': 'cancelled', 'write': 'done'})
+        self.assertEqual([b.pages for b in self.db.get_all()], [1] * 4)
+
+
+    def testConcurrentAccess(self):
+        self.addBooks(4)
+        cursor = self.db._dbcon.cursor()
+        cursor.execute('pragma journal_mode')
+        self.assertEqual(cursor.fetchone()[0], 'wal')
+        cursor.close()
+
+        # a reader isn't blocked by a write transaction and doesn't see it
+        writer = sqlite3.connect(self.tmpfile, isolation_level=None,
+                                 check_same_thread=False)
+        writer.execute('begin immediate')
+        writer.execute('delete from books')
+        reader = BookDatabase(self.tmpfile, read_only=True)
+        try:
+            start = time.time()
+            self.assertEqual(len(reader.get_all()), 4)
+            self.assertTrue(time.time() - start < 1)
+            self.assertRaises(sqlite3.OperationalError, reader.add,
+                              '/books/idoru.pdf', 'idoru', 'william gibson')
+
+            # a writer retries when the lock isn't released in time
+            self.db._pool.release()
+            self.db._pool.busy_timeout = 0.01
+            timer = threading.Timer(0.2, writer.execute, ('rollback',))
+            timer.start()
+            self.db.add('/books/idoru.pdf', 'idoru', 'william gibson')
+            timer.join()
+            self.assertEqual(len(reader.get_all()), 5)
+
+            # threads search in parallel, each on its own connection
+            results = []
+            def search():
+                results.append(reader.book_list('gibson').titles)
+                reader.release()
+            threads = [threading.Thread(target=search) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(results, [[u'idoru', u'neuromancer']] * 6)
+            self.assertEqual(len(reader._pool), 1) # the main thread's
+        finally:
+            reader.close()
+            writer.close()
+        self.assertRaises(sqlite3.ProgrammingError, reader.get_all)
+
+
+    def testFuzzySearch(self):
+        self.addBooks(4)
+        self.db.add(pjoin(self.bookspath, 'count_zero.pdf'), 'count zero',
+                    'william gibson')
+        titles = lambda term, **kw: [b.title for b in
+                                     self.db.fuzzy_search(term, **kw)]
+        for fts in (True, False):
+            self.db._fts = fts
+            self.assertEqual(titles('neuromacer'), [u'neuromancer'])
+            self.assertEqual(titles('wiliam gibsen'),
+                             [u'count zero', u'neuromancer'])
+            self.assertEqual(titles('gibson neuromancer'), [u'neuromancer'])
+            self.assertEqual(titles('snwo crsh'), [])
+            self.assertEqual(titles('snwo crsh', max_distance=2),
+                             [u'snow crash'])
+            self.assertEqual(titles('gibson', limit=1), [u'count zero'])
+        self.db.add(pjoin(self.bookspath, 'idoru.pdf'), 'idoru', 'gibson')
+        self.assertEqual(titles('idoro'), [u'idoru'])
+        self.assertEqual(self.db.search('neurmancer', fuzzy=True)[0].title,
+                         u'neuromancer')
+
+
+    def testTrigramIndex(self):
+        index = TrigramIndex([u'neuromancer', u'necromancer', u'romance'])
+        self.assertEqual(index.similar(u'neuromacer', 2),
+                         [(1, u'neuromancer'), (2, u'necromancer')])
+        self.assertEqual(index.similar(u'neuromacer', 1, limit=1),
+                         [(1, u'neuromancer')])
+        self.assertEqual(edit_distance(u'kitten', u'sitting'), 3)
+        self.assertEqual(edit_distance(u'kitten', u'sitting', 1), 2)
+
+
+    def testQuery(self):
+        self.addBooks(4)
+        self.db.add(pjoin(self.bookspath, 'papers', 'snowcrash.chm'),
+                    'Snow Crash', '', None, 300)
+        self.db.add(pjoin(self.bookspath, 'papers', 'count_zero.pdf'),
+                    'count zero', 'william gibson', None, 256)
+        has_fts = self.db._fts
+        for fts in (has_fts, False):
+            self.db._fts = fts
+            titles = lambda term: sorted(b.title for b in self.db.search(term))
+            self.assertEqual(titles('author:gibson'),
+                             [u'count zero', u'neuromancer'])
+            self.assertEqual(titles('snow ext:chm'), [u'Snow Crash'])
+            self.assertEqual(titles('snow -ext:chm'), [u'snow crash'])
+            self.assertEqual(titles('gibson -count'), [u'neuromancer'])
+            self.assertEqual(titles('-gibson -hitchhikers -crash'),
+                             [u'cooking for geeks'])
+            self.assertEqual(titles('path:%s' % pjoin(self.bookspath,
+                                                      'papers')),
+                             [u'Snow Crash', u'count zero'])
+            self.assertEqual(titles('path:papers pages:>256'),
+                             [u'Snow Crash'])
+            self.assertEqual(titles('pages:200..256'), [u'count zero'])
+            self.assertEqual(titles('neuromancer OR cooking'),
+                             [u'cooking for geeks', u'neuromancer'])
+            self.assertEqual(titles('crash (ext:chm OR author:neal)'),
+                             [u'Snow Crash', u'snow crash'])
+            self.assertEqual(titles('-(snow OR gibson) geeks'),
+                             [u'cooking for geeks'])
+            self.assertEqual(titles('title:"snow crash"'),
+                             [u'Snow Crash', u'snow crash'])
+            self.assertEqual(titles('foo:bar'), [])
+        self.db._fts = has_fts
+        self.assertRaises(QueryError, self.db.search, 'pages:many')
+        self.assertRaises(QueryError, self.db.search, '(snow')
+        plan = u'\n'.join(self.db.explain('snow ext:chm'))
+        self.assertTrue(u'filetype = ?' in plan, plan)
+        if has_fts:
+            self.assertTrue(u'books_fts match ?' in plan, plan)
+
+
+    def testRankSearch(self):
+        self.addBooks(4)
+        add = lambda name, title, author: self.db.add(
+            pjoin(self.bookspath, name), title, author)
+        add(u'snow.pdf', u'a field guide to snow', u'snow snowman')
+        add(u'crash_course.pdf', u'snowboarding', u'crash test')
+        add(u'snow_crash_2.pdf', u'snow crash companion', u'a fan')
+        add(u'unrelated.pdf', u'a book', u'snowden')
+        has_fts = self.db._fts
+        for fts in (has_fts, False):
+            self.db._fts = fts
+            ranked = [b.title for b in self.db.rank_search('snow crash')]
+            self.assertEqual(ranked[:2], [u'snow crash',
+                                          u'snow crash companion'])
+            self.assertEqual(sorted(ranked), [b.title for b in
+                                              self.db.search('snow crash')])
+            ranked = [b.title for b in self.db.search('snow', sort='relevance')]
+            # whole words beat prefixes, titles beat authors
+            self.assertEqual(ranked[0], u'snow crash')
+            self.assertTrue(ranked.index(u'a field guide to snow') <
+                            ranked.index(u'snowboarding'), ranked)
+            self.assertTrue(ranked.index(u'snowboarding') <
+                            ranked.index(u'a book'), ranked)
+            self.assertEqual(
+                [b.title for b in self.db.rank_search('snow', limit=3)],
+                ranked[:3])
+            self.assertEqual(self.db.book_list('snow', limit=2,
+                                               sort='relevance').titles,
+                             ranked[:2])
+            self.assertEqual(
+                [b.title for b in self.db.rank_search('ext:pdf', limit=2)],
+                [u'a book', u'a field guide to snow'])
+            self.assertEqual(self.db.rank_search('nothing'), [])
+        self.db._fts = has_fts
+        self.assertRaises(NgLibError, self.db.search, 'snow', sort='size')
+
+
+    def testRebuild(self):
+        self.addBooks(2)
+        reader = BookDatabase(self.tmpfile, read_only=True)
+        try:
+            self.assertEqual(len(reader.get_all()), 2)
+            self.assertFalse(self.db.has_content())
+            self.db.add_content([(self.db.get_all()[0].bid, None,
+                                  {u'cyberspace': 1})])
+            self.assertTrue(self.db.has_content())
+            shadow = self.db.start_rebuild()
+            for book in self.testbooks[2:]:
+                shadow.add(*book)
+            # the old books are searched until the rebuild is finished
+            self.assertEqual(reader.book_list('neuromancer').titles, [])
+            self.assertEqual(len(reader.get_all()), 2)
+            generation = reader.generation()
+            self.db.finish_rebuild(shadow)
+            self.assertFalse(self.db.has_content())
+            self.assertFalse(os.path.exists(shadow._dbfile))
+            self.assertNotEqual(reader.generation(), generation)
+            self.assertEqual(reader.book_list('gibson').titles,
+                             [u'neuromancer'])
+            self.assertEqual(sorted(b.title for b in self.db.get_all()),
+                             [u'neuromancer', u'snow crash'])
+            cursor = self.db._dbcon.cursor()
+            cursor.execute("select name from sqlite_master where "
+                           "type = 'index' and name = 'books_size'")
+            self.assertEqual(len(cursor.fetchall()), 1)
+            cursor.close()
+            if self.db._fts:
+                self.assertEqual([b.title for b in
+                                  self.db.rank_search('stephenson')],
+                                 [u'snow crash'])
+            self.db.add(*self.testbooks[0])
+            self.assertEqual(len(reader.get_all()), 3)
+
+            shadow = self.db.start_rebuild()
+            shadow.add(*self.testbooks[1])
+            self.db.abort_rebuild(shadow)
+            self.assertFalse(os.path.exists(shadow._dbfile))
+            self.assertEqual(len(reader.get_all()), 3)
+        finally:
+            reader.close()
+
+
+    def testGeneration(self):
+        generation = self.db.generation()
+        writer = BookDatabase(self.tmpfile)
+        try:
+            writer.add(*self.testbooks[0])
+            self.assertNotEqual(self.db.generation(), generation)
+            generation = self.db.generation()
+            # every thread has a connection of its own, the value is the same
+            seen = []
+            thread = threading.Thread(target=lambda:
+                                      seen.append(self.db.generation()))
+            thread.start()
+            thread.join()
+            self.assertEqual(seen, [generation])
+            writer.add_content([(writer.get_all()[0].bid, None,
+                                 {u'cyberspace': 1})])
+            self.assertNotEqual(self.db.generation(), generation)
+        finally:
+            writer.close()
+
+
+    def testWriteAfterRebuild(self):
+        self.addBooks(1)
+        opened = threading.Event()
+        rebuilt = threading.Event()
+        written = threading.Event()
+        checked = threading.Event()
+        errors = []
+        def write():
+            try:
+                self.db.add(*self.testbooks[1]) # opens a connection
+                opened.set()
+                rebuilt.wait(5)
+                self.db.add(*self.testbooks[3])
+            except Exception, e:
+                errors.append(e)
+            opened.set()
+            written.set()
+            checked.wait(5)
+            self.db.release()
+        thread = threading.Thread(target=write)
+        thread.start()
+        opened.wait(5)
+        shadow = self.db.start_rebuild()
+        shadow.add(*self.testbooks[2])
+        self.db.finish_rebuild(shadow)
+        rebuilt.set()
+        written.wait(5)
+        # the connections to the old file were closed before the swap, so
+        # none of them takes the WAL of the new file along when it is closed
+        self.assertEqual([b.title for b in self.db.get_all()],
+                         [u'neuromancer', u'snow crash'])
+        checked.set()
+        thread.join()
+        self.assertEqual(errors, [])
+        self.db.close()
+        self.db = BookDatabase(self.tmpfile)
+        self.assertEqual([b.title for b in self.db.get_all()],
+                         [u'neuromancer', u'snow crash'])
+
+
+    def testFindDuplicates(self):
+        tmpdir = mkdtemp()
+        big = os.urandom(3 * PARTIAL_SIZE)
+        middle = big[:PARTIAL_SIZE] + 'x' * PARTIAL_SIZE + big[-PARTIAL_SIZE:]
+        end = big[:-1] + chr((ord(big[-1]) + 1) % 256)
+        files = [('a.pdf', big), ('sub/copy of a.pdf', big), ('b.pdf', end),
+                 ('c.pdf', middle), ('small.chm', 'tiny'),
+                 ('small2.chm', 'tiny'), ('small3.chm', 'tinz'),
+                 ('empty.pdf', '')]
+        try:
+            os.mkdir(pjoin(tmpdir, 'sub'))
+            for name, data in files:
+                path = pjoin(tmpdir, name)
+                open(path, 'wb').write(data)
+                self.db.add(path, name, '', os.stat(path))
+            names = lambda groups: [[b.filename for b in books]
+                                    for books in groups]
+            self.assertEqual(names(self.db.find_duplicates(workers=2)),
+                             [[u'a.pdf', u'copy of a.pdf'],
+                              [u'small.chm', u'small2.chm']])
+            self.assertEqual(self.db.find_duplicates(workers=1)[0][0].size,
+                             len(big))
+            self.assertEqual(hash_file((1, pjoin(tmpdir, 'a.pdf'),
+                                        len(big), False))[1],
+                             hash_file((2, pjoin(tmpdir, 'c.pdf'),
+                                        len(big), False))[1])
+            self.assertEqual(hash_file((1, pjoin(tmpdir, 'a.pdf'), 1, True)),
+                             (1, None))
+
+            # hashes are stored, only changed files are hashed again
+            hashed = []
+            def hash(hasher, jobs):
+                hashed.extend(job[1] for job in jobs)
+                return original(hasher, jobs)
+            original = FileHasher.hash
+            FileHasher.hash = hash
+            try:
+                self.db.find_duplicates(workers=1)
+                self.assertEqual(hashed, [])
+                path = pjoin(tmpdir, 'c.pdf')
+                open(path, 'wb').write(big)
+                os.utime(path, (1, 1))
+                self.db.update(path, 'c.pdf', '', os.stat(path))
+                groups = self.db.find_duplicates(workers=1, min_size=5)
+                self.assertEqual(hashed, [path, path]) # partial and full
+            finally:
+                FileHasher.hash = original
+            self.assertEqual(names(groups),
+                             [[u'a.pdf', u'c.pdf', u'copy of a.pdf']])
+            self.db.remove(pjoin(tmpdir, 'c.pdf'))
+            cursor = self.db._dbcon.cursor()
+            cursor.execute('select count(*) from file_hashes')
+            self.assertEqual(cursor.fetchone()[0], 6)
+            cursor.close()
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def testFindDuplicatesInSeveralDatabases(self):
+        tmpdir = mkdtemp()
+        other = BookDatabase(pjoin(tmpdir, 'other.db'))
+        try:
+            other._create_db()
+            for db, name, data in ((self.db, 'a.pdf', 'same'),
+                                   (self.db, 'b.pdf', 'diff'),
+                                   (other, 'c.pdf', 'same'),
+                                   (other, 'd.pdf', 'else')):
+                path = pjoin(tmpdir, name)
+                open(path, 'wb').write(data)
+                db.add(path, name, '', os.stat(path))
+            self.assertEqual(self.db.find_duplicates(workers=1), [])
+            groups = find_duplicates([self.db, other], workers=1)
+            self.assertEqual([[b.filename for b in books] for books in groups],
+                             [[u'a.pdf', u'c.pdf']])
+            cursor = other._dbcon.cursor()
+            cursor.execute('select count(*) from file_hashes')
+            self.assertEqual(cursor.fetchone()[0], 2)
+            cursor.close()
+        finally:
+            other.close()
+            shutil.rmtree(tmpdir)
+
+
+    def testSearchWithoutFts(self):
+        self.addBooks(4)
+        self.db._fts = False
+        self.assertEqual([b.title for b in self.db.search('romanc')],
+                         [u'neuromancer'])
+
+
+    def testSearchContent(self):
+        tmpdir = mkdtemp()
+        try:
+            texts = ['the sky above the port', 'sky sky sky sky',
+                     'color of television', 'dead channel']
+            for i, text in enumerate(texts):
+                path = pjoin(tmpdir, '%d.pdf' % i)
+                f = open(path, 'wb')
+                f.write(make_text_pdf('(%s) Tj' % text))
+                f.close()
+                self.db.add(path, '%d' % i, '', os.stat(path))
+            self.db.add(pjoin(tmpdir, 'x.chm'), 'x', '')
+
+            indexer = ContentIndexer(self.db, workers=2, batch_size=3)
+            self.assertEqual(list(indexer.index()), [(3, 4), (4, 4)])
+            self.assertEqual(list(ContentIndexer(self.db).index()), [(0, 0)])
+            search = lambda term: [b.title for b in self.db.search(term, True)]
+            self.assertEqual(search('SKY'), [u'1', u'0'])
+            self.assertEqual(search('sky port'), [u'0'])
+            self.assertEqual(search('sky color'), [])
+            self.assertEqual(search('cyberspace'), [])
+
+            os.utime(pjoin(tmpdir, '3.pdf'), (0, 0))
+            self.db.update(pjoin(tmpdir, '3.pdf'), '3', '',
+                           os.stat(pjoin(tmpdir, '3.pdf')))
+            self.assertEqual(list(ContentIndexer(self.db).index()), [(1, 1)])
+            self.db.remove(pjoin(tmpdir, '1.pdf'))
+            self.assertEqual(search('sky'), [u'0'])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class ShardedDatabaseTest(unittest.TestCase):
+    """
+    test searching several library roots
+    """
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        config = ConfigurationStore(pjoin(self.tmpdir, 'nglibrc'))
+        config._parse_config('dir = /books\ndbfile = %s\n'
+                             'root.papers = /mnt/papers\n'
+                             'root.comics = /mnt/comics\n'
+                             % pjoin(self.tmpdir, 'books.db'), False)
+        self.roots = library_roots(config)
+        books = {'main': [('snow crash', 'neal stephenson'),
+                          ('Anathem', 'neal stephenson')],
+                 'papers': [('snow and ice', 'glaciologist'),
+                            ('zodiac', 'neal stephenson')],
+                 'comics': [('Snowpiercer', 'jacques lob')]}
+        for root in self.roots:
+            db = BookDatabase(root.dbfile)
+            for title, author in books[root.name]:
+                db.add(pjoin(root.dir, title + '.pdf'), title, author)
+            db.close()
+        self.db = ShardedDatabase(self.roots)
+
+
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.tmpdir)
+
+
+    def testRoots(self):
+        self.assertEqual([(r.name, r.dir) for r in self.roots],
+                         [('main', '/books'), ('papers', '/mnt/papers'),
+                          ('comics', '/mnt/comics')])
+        self.assertEqual(self.roots[1].dbfile,
+                         pjoin(self.tmpdir, 'books-papers.db'))
+        config = ConfigurationStore()
+        self.assertRaises(NgLibError, config._parse_config,
+                          'root.main = /x', False)
+        self.assertRaises(NgLibError, config._parse_config,
+                          'root.a/b = /x', False)
+        for name in ('metadata', 'papers-Metadata'):
+            self.assertRaises(NgLibError, config._parse_config,
+                              'root.%s = /x' % name, False)
+        self.assertTrue(isinstance(open_database(self.roots[:1]),
+                                   BookDatabase))
+
+
+    def testSearch(self):
+        titles = lambda books: [b.title for b in books]
+        self.assertEqual(titles(self.db.get_all()),
+                         [u'Anathem', u'snow and ice', u'snow crash',
+                          u'Snowpiercer', u'zodiac'])
+        self.assertEqual(self.db.book_list('snow').titles,
+                         [u'snow and ice', u'snow crash', u'Snowpiercer'])
+        self.assertEqual(titles(self.db.search('snow', limit=2)),
+                         [u'snow and ice', u'snow crash'])
+        self.assertEqual(titles(self.db.search('snow', sort='relevance',
+                                               limit=1)), [u'snow crash'])
+        # every shard ranks with its own statistics
+        self.assertEqual(sorted(titles(self.db.search('neal',
+                                                      sort='relevance'))),
+                         [u'Anathem', u'snow crash', u'zodiac'])
+
+        # keyset pages across the shards
+        pages, after = [], None
+        while True:
+            page = self.db.get_all(after, 2)
+            if not page:
+                break
+            pages.append(titles(page))
+            after = page[-1]
+        self.assertEqual(pages, [[u'Anathem', u'snow and ice'],
+                                 [u'snow crash', u'Snowpiercer'],
+                                 [u'zodiac']])
+
+        book = self.db.search('zodiac')[0]
+        self.assertEqual(split_id(book.bid), (2, 1))
+        self.assertEqual(self.db.get_by_id(book.bid).title, u'zodiac')
+        self.assertEqual(self.db.get_by_id(composite_id(1, 9)), None)
+
+
+    def testSlowShard(self):
+        shard = self.db._dbs[2]
+        search = shard.search
+        def slow_search(*args):
+            time.sleep(0.5)
+            return search(*args)
+        shard.search = slow_search
+        self.db.timeout = 0.1
+        self.assertEqual(self.db.book_list('snow').titles,
+                         [u'snow and ice', u'snow crash'])
+        self.assertEqual(self.db.missing, ['comics'])
+        shard.search = search
+        self.db.timeout = 5
+        generation = self.db.generation()
+        self.assertEqual(len(self.db.book_list('snow')), 3)
+        self.assertEqual(self.db.missing, [])
+
+        db = BookDatabase(self.roots[2].dbfile)
+        db.add('/mnt/comics/snowman.pdf', 'snowman', 'raymond briggs')
+        db.close()
+        self.assertNotEqual(self.db.generation(), generation)
+        self.assertEqual(len(self.db.book_list('snow')), 4)
+
+
+class StatsTest(unittest.TestCase):
+    """
+    test the timers and counters of Stats
+    """
+
+    def testStats(self):
+        events = []
+        stats = Stats(lambda *event: events.append(event))
+        stats.count('files_seen')
+        stats.count('files_seen', 2)
+        with stats.timer('walk'):
+            time.sleep(0.01)
+        self.assertEqual(stats.counters, {'files_seen': 3})
+        self.assertEqual(stats.timers['walk'][1], 1)
+        self.assertTrue(stats.seconds('walk') >= 0.01)
+        self.assertEqual([e[:2] for e in events],
+                         [('count', 'files_seen')] * 2 + [('time', 'walk')])
+        self.assertEqual(stats.as_dict()['rates'].keys(),
+                         ['files_seen_per_second'])
+        self.assertEqual(len(stats.report()), 3)
+
+        def slow(items):
+            for item in items:
+                time.sleep(0.02)
+                yield item
+        inner = stats.timed(slow(range(3)), 'inner')
+        self.assertEqual(list(stats.timed(inner, 'outer', exclude='inner')),
+                         [0, 1, 2])
+        self.assertTrue(stats.seconds('inner') >= 0.06)
+        self.assertTrue(stats.seconds('outer') < 0.03)
+
+        stats.reset()
+        self.assertEqual((stats.timers, stats.counters), ({}, {}))
+
+        items = iter([1, 2])
+        self.assertTrue(NULL_STATS.timed(items, 'walk') is items)
+        with NULL_STATS.timer('walk'):
+            NULL_STATS.count('files_seen')
+        self.assertEqual(NULL_STATS.as_dict(),
+                         {'timers': {}, 'counters': {}, 'rates': {}})
+
+
+class WorkersTest(unittest.TestCase):
+    """
+    test running jobs in worker processes
+    """
+
+    def testPoolMap(self):
+        self.assertTrue(default_workers() >= 1)
+        self.assertEqual(default_workers(3), 3)
+        for workers in (1, 2):
+            self.assertEqual(sorted(pool_map(abs, [-1, -2, 3], workers)),
+                             [1, 2, 3])
+        results = pool_map(abs, range(-100, 0), 2, chunk_size=1)
+        self.assertTrue(results.next() > 0)
+        results.close() # terminates the pool
+
+
+class FileScannerTest(unittest.TestCase):
+    """
+    test the FileScanner class
+    """
+
+    def setUp(self):
+        self.root = mkdtemp()
+        self.expected = []
+        for dirs in ('a', pjoin('a', 'b'), pjoin('a', 'b', 'c'), 'd'):
+            os.mkdir(pjoin(self.root, dirs))
+            for name in ('x.pdf', 'y.CHM', 'z.txt', '.hidden.pdf'):
+                path = pjoin(self.root, dirs, name)
+                open(path, 'w').close()
+                if name in ('x.pdf', 'y.CHM'):
+                    self.expected.append(path)
+        os.symlink(pjoin(self.root, 'a'), pjoin(self.root, 'd', 'link'))
+
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+
+    def testScan(self):
+        scanner = FileScanner(self.root, workers=3)
+        found = sorted(path for path, stat in scanner.scan())
+        self.assertEqual(found, sorted(self.expected))
+        self.assertEqual(scanner.total, len(self.expected))
+
+
+    def testScanWithStat(self):
+        scanner = FileScanner(self.root, extensions=('pdf',), stat=True)
+        for path, stat in scanner.scan():
+            self.assertTrue(path.endswith('x.pdf'))
+            self.assertEqual(stat.st_ino, os.stat(path).st_ino)
+        self.assertEqual(scanner.total, 4)
+
+
+def make_pdf(objects, trailer, xref_stream=False):
+    """
+    return the contents of a pdf file with the given objects. objects is a
+    list of strings, object numbers start at 1. with xref_stream, objects
+    after the first two are put into a compressed object stream and a
+    png-predicted cross-reference stream is used.
+    """
+    out = '%PDF-1.5\n%\xe2\xe3\xcf\xd3\n'
+    offsets = {}
+    if not xref_stream:
+        for num, obj in enumerate(objects):
+            offsets[num + 1] = len(out)
+            out += '%d 0 obj\n%s\nendobj\n' % (num + 1, obj)
+        xref = len(out)
+        out += 'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+        for num in range(1, len(objects) + 1):
+            out += '%010d 00000 n \n' % offsets[num]
+        out += 'trailer\n<< /Size %d %s >>\n' % (len(objects) + 1, trailer)
+        return out + 'startxref\n%d\n%%%%EOF\n' % xref
+
+    for num, obj in enumerate(objects[:2]):
+        offsets[num + 1] = len(out)
+        out += '%d 0 obj\n%s\nendobj\n' % (num + 1, obj)
+    header, body = [], ''
+    for num, obj in enumerate(objects[2:]):
+        header.append('%d %d' % (num + 3, len(body)))
+        body += obj + ' '
+    header = ' '.join(header) + ' '
+    data = zlib.compress(header + body)
+    stm = len(objects) + 1
+    offsets[stm] = len(out)
+    out += ('%d 0 obj\n<< /Type /ObjStm /N %d /First %d /Filter /FlateDecode '
+            '/Length %d >>\nstream\n%s\nendstream\nendobj\n'
+            % (stm, len(objects) - 2, len(header), len(data), data))
+    rows, prev = '', '\0\0\0\0'
+    entries = [(0, 0, 0)] + [(1, offsets[n], 0) for n in (1, 2)]
+    entries += [(2, stm, i) for i in range(len(objects) - 2)]
+    entries += [(1, offsets[stm], 0), (1, len(out), 0)]
+    for kind, a, b in entries:
+        row = struct.pack('>BHB', kind, a, b)
+        rows += '\x02' + ''.join(chr((ord(c) - ord(p)) & 0xff)
+                                 for c, p in zip(row, prev))
+        prev = row
+    data = zlib.compress(rows)
+    xref = len(out)
+    out += ('%d 0 obj\n<< /Type /XRef /Size %d /W [1 2 1] /Filter /FlateDecode '
+            '/DecodeParms << /Predictor 12 /Columns 4 >> /Length %d %s >>\n'
+            'stream\n%s\nendstream\nendobj\n'
+            % (stm + 1, stm + 2, len(data), trailer, data))
+    return out + 'startxref\n%d\n%%%%EOF\n' % xref
+
+
+PDF_OBJECTS = ['<< /Type /Catalog /Pages 3 0 R >>',
+               '<< /Title (Neuromancer \\(1984\\)) /Author <FEFF00470069006200730'
+               '06F006E> /Producer (% not a comment) >>',
+               '<< /Type /Pages /Kids [4 0 R] /Count 5 0 R >>',
+               '<< /Type /Page /Parent 3 0 R >>',
+               '271']
+
+
+def make_text_pdf(*pages):
+    """
+    return the contents of a pdf file with one page per content stream
+    given, the text shown is written into a text object with font /F1. the
+    font /F2 has a ToUnicode map that shifts every character by one.
+    """
+    cmap = ('/CIDInit /ProcSet findresource begin 1 begincodespacerange '
+            '<00> <FF> endcodespacerange 1 beginbfrange <20> <7e> <0021> '
+            'endbfrange end')
+    objects = ['<< /Type /Catalog /Pages 2 0 R >>',
+               '<< /Type /Pages /Kids [%s] /Count %d /Resources << /Font '
+               '<< /F1 3 0 R /F2 4 0 R >> >> >>'
+               % (' '.join('%d 0 R' % (6 + i * 2) for i in range(len(pages))),
+                  len(pages)),
+               '<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+               '<< /Type /Font /Subtype /Type1 /ToUnicode 5 0 R >>',
+               '<< /Length %d >>\nstream\n%s\nendstream' % (len(cmap), cmap)]
+    for i, text in enumerate(pages):
+        content = zlib.compress('BT /F1 12 Tf 72 712 Td %s ET' % text)
+        objects.append('<< /Type /Page /Parent 2 0 R /Contents %d 0 R >>'
+                       % (7 + i * 2))
+        objects.append('<< /Length %d /Filter /FlateDecode >>\nstream\n%s\n'
+                       'endstream' % (len(content), content))
+    return make_pdf(objects, '/Root 1 0 R')
+
+
+class PdfReaderTest(unittest.TestCase):
+    """
+    test reading metadata from pdf files
+    """
+
+    def testXrefTable(self):
+        pdf = make_pdf(PDF_OBJECTS, '/Root 1 0 R /Info 2 0 R')
+        self.assertEqual(PdfReader(pdf).metadata(),
+                         {'title': u'Neuromancer (1984)',
+                          'author': u'Gibson', 'pages': 271})
+
+
+    def testXrefStream(self):
+        pdf = make_pdf(PDF_OBJECTS, '/Root 1 0 R /Info 2 0 R', True)
+        self.assertEqual(PdfReader(pdf).metadata(),
+                         {'title': u'Neuromancer (1984)',
+                          'author': u'Gibson', 'pages': 271})
+
+
+    def testEncrypted(self):
+        pdf = make_pdf(PDF_OBJECTS, '/Root 1 0 R /Info 2 0 R /Encrypt 4 0 R')
+        self.assertEqual(PdfReader(pdf).metadata(), {'pages': 271})
+
+
+    def testText(self):
+        pdf = make_text_pdf('(Case (nested) \\(escaped\\)) Tj',
+                            '[(W)80(ake)-333(up)] TJ /F2 1 Tf 0 -14 Td (Mdn) Tj')
+        f, path = mkstemp('.pdf')
+        os.write(f, pdf)
+        os.close(f)
+        try:
+            self.assertEqual(list(read_pdf_text(path)),
+                             [u' Case (nested) (escaped) ',
+                              u' Wake up Neo '])
+            self.assertEqual(len(list(read_pdf_text(path, max_pages=1))), 1)
+        finally:
+            os.unlink(path)
+
+
+    def testExtractor(self):
+        tmpdir = mkdtemp()
+        try:
+            entries = []
+            for i in range(5):
+                path = pjoin(tmpdir, '%d.pdf' % i)
+                f = open(path, 'wb')
+                if i % 2:
+                    f.write(make_pdf(PDF_OBJECTS, '/Root 1 0 R /Info 2 0 R'))
+                else:
+                    f.write('garbage')
+                f.close()
+                entries.append((path, i))
+            self.assertEqual(read_pdf_metadata(entries[1][0])['pages'], 271)
+
+            extractor = MetadataExtractor(workers=2, chunk_size=2)
+            result = list(extractor.extract(entries,
+                                            wanted=lambda e: e[1] != 3))
+            self.assertEqual([e[1] for e in result], range(5))
+            self.assertEqual([e[2] for e in result],
+                             [{}, read_pdf_metadata(entries[1][0]), {},
+                              None, {}])
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+def make_chm(title, version=3):
+    """
+    return the contents of a chm file whose #SYSTEM file has the given title
+    """
+    def encint(value):
+        out = chr(value & 0x7f)
+        value >>= 7
+        while value:
+            out = chr(0x80 | (value & 0x7f)) + out
+            value >>= 7
+        return out
+
+    system = struct.pack('<I', 3)
+    system += struct.pack('<HH', 2, 5) + 'a.htm'
+    system += struct.pack('<HH', 3, len(title) + 1) + title + '\0'
+    files = [('/', 0, 0, 0), ('/#ITBITS', 0, 0, 0),
+             ('/#SYSTEM', 0, 16, len(system)), ('/a.htm', 1, 0, 300)]
+    entries = ''.join(encint(len(n)) + n + encint(s) + encint(o) + encint(l)
+                      for n, s, o, l in files)
+    chunk_size = 0x1000
+    chunk = 'PMGL' + struct.pack('<IIii', chunk_size - 0x14 - len(entries),
+                                 0, -1, -1) + entries
+    chunk += '\0' * (chunk_size - len(chunk))
+    header_length = version >= 3 and 0x60 or 0x58
+    directory = 'ITSP' + struct.pack('<IIIIIIiIIiI', 1, 0x54, 10, chunk_size,
+                                     2, 1, -1, 0, 0, -1, 1)
+    directory += '\0' * (0x54 - len(directory))
+    dir_length = len(directory) + len(chunk)
+    content_offset = header_length + dir_length
+    header = 'ITSF' + struct.pack('<IIII', version, header_length, 1, 0)
+    header += '\0' * (0x38 - len(header))
+    header += struct.pack('<QQQQ', 0, 0, header_length, dir_length)
+    if version >= 3:
+        header += struct.pack('<Q', content_offset)
+    return header + directory + chunk + '\0' * 16 + system
+
+
+class ChmReaderTest(unittest.TestCase):
+    """
+    test reading titles from chm files
+    """
+
+    def setUp(self):
+        fd, self.tmpfile = mkstemp('.chm')
+        os.close(fd)
+
+
+    def tearDown(self):
+        os.unlink(self.tmpfile)
+
+
+    def readTitle(self, data):
+        f = open(self.tmpfile, 'wb')
+        f.write(data)
+        f.close()
+        return read_chm_metadata(self.tmpfile).get('title')
+
+
+    def testTitle(self):
+        self.assertEqual(self.readTitle(make_chm('Snow Crash')), u'Snow Crash')
+        self.assertEqual(self.readTitle(make_chm('Caf\xe9', version=2)),
+                         u'Caf\xe9')
+
+
+class MetadataCacheTest(unittest.TestCase):
+    """
+    test the MetadataCache class
+    """
+
+    def setUp(self):
+        self.tmpdir = mkdtemp()
+        self.cache = MetadataCache(pjoin(self.tmpdir, 'cache.db'),
+                                   max_entries=3, batch_size=2)
+        self.files = []
+        for i in range(5):
+            path = pjoin(self.tmpdir, '%d.pdf' % i)
+            open(path, 'w').close()
+            self.files.append(path)
+
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.tmpdir)
+
+
+    def testCache(self):
+        stat = os.stat(self.files[0])
+        self.assertEqual(self.cache.get(stat), None)
+        self.cache.put(stat, {'title': u'neuromancer', 'pages': 271})
+        self.assertEqual(self.cache.get(stat),
+                         {'title': u'neuromancer', 'pages': 271})
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+        self.assertEqual(self.cache.hit_rate(), 0.5)
+
+        os.utime(self.files[0], (0, 0))
+        self.assertEqual(self.cache.get(os.stat(self.files[0])), None)
+
+
+    def testEviction(self):
+        for i, path in enumerate(self.files):
+            self.cache._stamp = i
+            self.cache.put(os.stat(path), {})
+        self.cache.flush()
+        cached = [self.cache.get(os.stat(p)) for p in self.files]
+        self.assertEqual(cached, [None, None, {}, {}, {}])
+
+
+    def testExtractorUsesCache(self):
+        for path in self.files[:2]:
+            self.cache.put(os.stat(path), {'title': u'cached'})
+        extractor = MetadataExtractor(workers=0, cache=self.cache)
+        entries = [(p, os.stat(p)) for p in self.files]
+        titles = [e[2].get('title') for e in extractor.extract(entries)]
+        self.assertEqual(titles, [u'cached', u'cached', None, None, None])
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 3))
+        self.assertEqual(self.cache.get(entries[4][1]), {})
+
+
+    def testExtractorStartsPoolLazily(self):
+        started = []
+        def pool(workers):
+            started.append(workers)
+            return original(workers)
+        original = metadata.Pool
+        metadata.Pool = pool
+        try:
+            entries = [(p, os.stat(p)) for p in self.files]
+            for path, stat in entries:
+                self.cache.put(stat, {})
+            # nothing to parse, or fewer files than workers
+            extractor = MetadataExtractor(workers=2, cache=self.cache)
+            self.assertEqual(len(list(extractor.extract(entries))), 5)
+            extractor = MetadataExtractor(workers=8)
+            self.assertEqual(len(list(extractor.extract(entries))), 5)
+            self.assertEqual(started, [])
+            extractor = MetadataExtractor(workers=2)
+            self.assertEqual(len(list(extractor.extract(entries))), 5)
+            self.assertEqual(started, [2])
+        finally:
+            metadata.Pool = original
+
+
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
     unittest.main()
\ No newline at end of file
@@ -36,6 +36,25 @@ For more Information see http://netgarage.org
 from cStringIO import StringIO
 import stfl
 
+from nglib.model.bookdatabase import SORT_RELEVANCE
+from nglib.model.bookdatabase import SORT_TITLE
+
+
+# milliseconds to wait for a key before checking the search term and the
+# events of the worker thread
+POLL_TIMEOUT = 100
+
+# books rendered below the visible part of the list, so scrolling down a
+# few lines doesn't need a redraw
+LIST_MARGIN = 20
+
+# keys that move the selection in the book list, the list itself only gets
+# the books around the visible part so the movement is done here
+_LIST_KEYS = {'UP': 'up', 'k': 'up', 'DOWN': 'down', 'j': 'down',
+              'PPAGE': 'page_up', '^U': 'page_up',
+              'NPAGE': 'page_down', '^F': 'page_down',
+              'HOME': 'home', 'g': 'home', 'END': 'end', 'G': 'end'}
+
 
 class ProgressBar(object):
     """
@@ -112,49 +131,29 @@ class ProgressBar(object):
         return '%s%s' % (scaled * self.block, self.cur_block)
 
 
-class ReloadLibraryDialog(object):
+class ProgressCounter(object):
     """
-    display progress on reloading the library
+    Display running totals on the console. Used instead of a ProgressBar
+    when the total amount of progress isn't known in advance.
     """
-    stfl_layout = """
-vbox
-    modal:1
-    table
-        .tie:c
-        label
-            .colspan:2 .expand:0 .tie:c .border:lrtb
-            text:"Reloading Library..."
-        tablebr
-        label
-            .colspan:2 .expand:0 .tie:c .border:lrtb
-            text[bookcount]:"Books found:"
-        tablebr
-        label
-            .colspan:2 .expand:0 .tie:c .border:lrtb
-            text[progress]:"Books added:"
-"""
 
-    def __init__(self, controller):
+    def __init__(self, format):
         """
-        construct and display a reload library dialog
+        Create a progress counter.
 
-        controller - an object which provides methods for reloading the library
+        format - format string used for displaying the totals
         """
-        self._ctrl = controller
-        self._form = stfl.create(self.stfl_layout)
-        self._form.run(1)
+        self.format = format
 
 
-    def run(self):
+    def show(self, *values):
         """
-        perform the reload and display progress
+        Display the given totals, replacing the previous ones.
         """
-        bookcount = self._ctrl.count_books()
-        self._form.set('bookcount', 'Books found: %i' % bookcount)
+        print '\r' + self.format % values,
 
-        for num in self._ctrl.reload_library():
-            self._form.set('progress', 'Books added: %i' % num[1])
-            self._form.run(1)
+        import sys
+        sys.stdout.flush()
 
 
 class SettingsDialog(object):
@@ -215,7 +214,7 @@ table
     tablebr
     label
         .colspan:2 .tie:c .border:lr .expand:0
-        text:"Ctrl-U - Cancel    Ctrl-R: Reload Library"
+        text:"Ctrl-U - Cancel    Ctrl-R: Reload Library and close"
     tablebr
     label
         .colspan:2 .tie:c .border:lrb .expand:0
@@ -253,6 +252,7 @@ table
                 if self._ctrl.get_setting('dir') != self._form.get('dirtxt'):
                     self._form.set('dirtxt', self._ctrl.get_setting('dir'))
                 self._reload_library(self._ctrl)
+                return
             elif e == '^U':
                 return
             elif e == '^X':
@@ -293,12 +293,11 @@ table
 
     def _reload_library(self, ctrl):
         """
-        reload the library
+        start reloading the library, the main window shows the progress
 
         ctrl - an object which provides methods for reloading the library
         """
-        reloader = ReloadLibraryDialog(self._ctrl)
-        reloader.run()
+        ctrl.reload_library_async()
 
 
 class ConsoleInterface(object):
@@ -325,84 +324,234 @@ table
   !list[booklist]
     on_TAB:focussearch
     on_ENTER:openbook
-    bind_up:"** k"
-    bind_down:"** j"
-    bind_page_up:"** ^U"
-    bind_page_down:"** ^F"
-    bind_home:"** g"
-    bind_end:"** G"
+    bind_up:""
+    bind_down:""
+    bind_page_up:""
+    bind_page_down:""
+    bind_home:""
+    bind_end:""
     .colspan:2 .border:rltb
     style_focus:fg=blue
     pos_name[listposname]:
     pos[listpos]:0
+    offset[listoffset]:0
+  tablebr
+  label
+    .colspan:2 .expand:0 .tie:l
+    text[status]:"Loading..."
   tablebr
   label
     .colspan:2 .border:rlt .expand:0 .tie:c
-    text:"TAB: Search/List    Ctrl-D: Clear Search    Enter: Open File"
+    text:"TAB: Search/List  Ctrl-D: Clear Search  Ctrl-O: Sort  Enter: Open File"
   tablebr
   label
     .colspan:2 .border:rlb .expand:0 .tie:c
-    text:"Ctrl-R: Reveal File    Ctrl-P: Settings    Ctrl-X: Quit"
+    text:"Ctrl-R: Reveal File  Ctrl-P: Settings  Ctrl-C: Cancel  Ctrl-X: Quit"
 """
 
     def __init__(self, controller):
         """
-        create a ConsoleInterface object
+        create a ConsoleInterface object. the books are loaded by the
+        worker thread of the controller while the window is shown.
 
         controller -- module providing an interface to the book database
 
         """
         self._ctrl = controller
         self._form = stfl.create(self.stfl_layout)
-        self._fill_list(self._ctrl.get_all())
+        self._term = ''
+        self._titles = []
+        self._pos = 0 # position of the selected book in self._titles
+        self._top = 0 # position of the book in the first row of the list
+        self._start = 0 # position of the first book rendered into the list
+        self._end = 0 # position after the last book rendered
+        self._reload_job = None
+        self._sort = SORT_RELEVANCE
+        self._ctrl.start_worker()
+        self._ctrl.get_all_async()
 
 
     def run(self):
         self._form.set_focus('search')
         while True:
+            e = None
             try:
-                e = self._form.run(0)
+                e = self._form.run(POLL_TIMEOUT)
             except KeyboardInterrupt:
-                pass
+                self._ctrl.cancel_async()
+            self._handle_events()
+            term = self._form.get('searchterm')
+            if term != self._term:
+                self._perform_search(term)
+            elif min(self._top + self._list_height(),
+                     len(self._titles)) > self._end:
+                self._render_list() # the terminal got bigger
             if e == 'focussearch':
                 self._form.set_focus('search')
             elif e == 'focuslist':
                 self._form.set_focus('booklist')
             elif e == 'performsearch':
                 self._perform_search(self._form.get('searchterm'))
+            elif e in _LIST_KEYS:
+                self._scroll(_LIST_KEYS[e])
             elif e == 'openbook':
-                self._ctrl.open_book(self._form.get('listpos'))
+                self._ctrl.open_book(self._pos)
             elif e == '^X':
                 self._ctrl.shutdown()
             elif e == '^D':
                 self._clear_search_results()
+            elif e == '^O':
+                self._toggle_sort()
             elif e == '^P':
                 settings = SettingsDialog(self._ctrl)
                 settings.show()
-                self._fill_list(self._ctrl.get_all())
+                self._perform_search(self._term)
             elif e == '^R':
-                self._ctrl.show_book(self._form.get('listpos'))
+                self._ctrl.show_book(self._pos)
+
+
+    def _handle_events(self):
+        """
+        show the results and progress posted by the worker thread
+        """
+        for event in self._ctrl.poll_events():
+            if event.kind == 'books':
+                self._fill_list(event.data)
+                self._form.set('status', '%i books, by %s' %
+                               (len(event.data), self._sort_name()))
+            elif event.kind == 'progress':
+                self._reload_job = event.job
+                self._form.set('status', 'Reloading library... Books '
+                               'found: %i  %s' % (event.data.found,
+                                                  _changes(event.data)))
+            elif event.kind == 'done':
+                self._form.set('status', 'Library reloaded. %s'
+                               % _changes(event.data))
+                self._perform_search(self._term)
+            elif event.kind == 'cancelled' and event.job == self._reload_job:
+                self._form.set('status', 'Reload cancelled.')
+            elif event.kind == 'error':
+                self._form.set('status', 'Error: %s' % event.data)
 
 
     def _perform_search(self, term):
-        self._fill_list(self._ctrl.search(term))
+        """
+        search for the term in the worker thread. a search that is still
+        running is abandoned, the results are shown by _handle_events().
+        """
+        self._term = term
+        self._ctrl.search_async(term, self._sort)
+
+
+    def _toggle_sort(self):
+        """
+        switch between ordering the books by relevance and by title
+        """
+        if self._sort == SORT_RELEVANCE:
+            self._sort = SORT_TITLE
+        else:
+            self._sort = SORT_RELEVANCE
+        self._perform_search(self._term)
+
+
+    def _sort_name(self):
+        """
+        return how the list is ordered, for the status line. an empty
+        search term has nothing to rank by.
+        """
+        if self._sort == SORT_RELEVANCE and self._term.strip():
+            return 'relevance'
+        return 'title'
 
 
     def _clear_search_results(self):
         self._form.set('searchterm', '')
-        self._fill_list(self._ctrl.get_all())
+        self._perform_search('')
 
 
     def _fill_list(self, items):
-        items = [x.title for x in items]
+        """
+        show a BookList in the list widget, with the first book selected
+        """
+        self._titles = items.titles
+        self._pos = 0
+        self._top = 0
+        self._render_list()
+
+
+    def _scroll(self, movement):
+        """
+        move the selection in the book list
+
+        movement - one of up, down, page_up, page_down, home, end
+        """
+        height = self._list_height()
+        last = len(self._titles) - 1
+        if last < 0:
+            return
+        pos, top = self._pos, self._top
+        if movement == 'up':
+            pos -= 1
+        elif movement == 'down':
+            pos += 1
+        elif movement == 'page_up':
+            pos, top = pos - height, top - height
+        elif movement == 'page_down':
+            pos, top = pos + height, top + height
+        elif movement == 'home':
+            pos = 0
+        elif movement == 'end':
+            pos = last
+        self._pos = pos = max(0, min(pos, last))
+        top = max(0, min(top, pos, last - height + 1))
+        self._top = max(top, pos - height + 1)
+
+        if self._start <= self._top and \
+           min(self._top + height, last + 1) <= self._end:
+            self._form.set('listoffset', str(self._top - self._start))
+            self._form.set('listpos', str(self._pos - self._start))
+        else:
+            self._render_list()
+
+
+    def _render_list(self):
+        """
+        render the books from the first row of the list down to LIST_MARGIN
+        books below the last row into the list widget, so the cost doesn't
+        depend on the number of books
+        """
+        self._start = self._top
+        self._end = min(len(self._titles),
+                        self._top + self._list_height() + LIST_MARGIN)
         buf = StringIO()
         buf.write('{list')
-        count = 0
-        for item in items:
-            val = item.encode('utf8')
-            buf.write('{listitem[%d] text:"%s"}' % (count, val))
+        for i, title in enumerate(self._titles[self._start:self._end]):
+            buf.write('{listitem[%d] text:%s}' %
+                      (i, stfl.quote(title.encode('utf8'))))
         buf.write('}')
         self._form.modify('booklist', 'replace_inner', buf.getvalue())
         buf.close()
-        self._form.set('listpos', '0')
+        self._form.set('listoffset', '0')
+        self._form.set('listpos', str(self._pos - self._start))
+
 
+    def _list_height(self):
+        """
+        return the number of rows of the list widget
+        """
+        try:
+            height = int(self._form.get('booklist:h'))
+        except (TypeError, ValueError):
+            height = 0
+        return height > 0 and height or 24
+
+
+def _changes(progress):
+    """
+    describe the changes of a SyncProgress tuple
+    """
+    if progress is None:
+        return 'No changes.'
+    return 'Added: %i  Removed: %i  Changed: %i' % (progress.added,
+                                                    progress.removed,
+                                                    progress.changed)
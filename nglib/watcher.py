@@ -0,0 +1,354 @@
+# encoding: utf-8
+
+"""
+@summary: keeps the library database in sync with the library directory
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+from __future__ import with_statement
+import os
+import time
+from collections import OrderedDict
+
+from nglib.controller import SyncProgress
+from nglib.controller import add_file
+from nglib.controller import library_available
+from nglib.controller import sync_books
+from nglib.model.bookdatabase import DEFAULT_BATCH_SIZE
+from nglib.model.filescanner import FileScanner
+from nglib.model.inotify import IN_CLOSE_WRITE
+from nglib.model.inotify import IN_CREATE
+from nglib.model.inotify import IN_DELETE
+from nglib.model.inotify import IN_DELETE_SELF
+from nglib.model.inotify import IN_DONT_FOLLOW
+from nglib.model.inotify import IN_IGNORED
+from nglib.model.inotify import IN_ISDIR
+from nglib.model.inotify import IN_MOVED_FROM
+from nglib.model.inotify import IN_MOVED_TO
+from nglib.model.inotify import IN_ONLYDIR
+from nglib.model.inotify import IN_Q_OVERFLOW
+from nglib.model.inotify import Inotify
+from nglib.model.inotify import InotifyError
+from nglib.model.inotify import WatchLimitError
+from nglib.model.metadata import MetadataExtractor
+from nglib.model.stats import clock
+
+
+DEFAULT_DELAY = 2.0 # seconds without changes before a batch is written
+DEFAULT_RESCAN_INTERVAL = 600 # seconds between rescans without inotify
+
+_WATCH_MASK = (IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_DELETE_SELF |
+               IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+
+class LibraryWatcher(object):
+    """
+    keeps a BookDatabase in sync with a directory tree. every directory
+    of the tree is watched with inotify, changes are collected and written
+    in batches once the tree has been quiet for a moment, so copying a
+    directory full of books results in one transaction.
+    if inotify isn't available or the limit of watches is reached, the
+    watcher falls back to an incremental rescan (see sync_books()) every
+    rescan_interval seconds.
+    """
+    def __init__(self, path, database, cache=None, delay=DEFAULT_DELAY,
+                 rescan_interval=DEFAULT_RESCAN_INTERVAL,
+                 batch_size=DEFAULT_BATCH_SIZE, workers=None,
+                 extensions=('pdf', 'chm')):
+        """
+        create a LibraryWatcher, call start() to set up the watches
+
+        path - absolute path to the library directory
+        database - BookDatabase object
+        cache - optional, MetadataCache for metadata extracted before
+        delay - seconds without changes before they are written
+        rescan_interval - seconds between rescans if inotify can't be used
+        batch_size - how many changes should be written per transaction
+        workers - number of processes extracting metadata of large batches
+        extensions - file extensions of books
+        """
+        self.path = path
+        self.delay = delay
+        self.rescan_interval = rescan_interval
+        self.batch_size = batch_size
+        self.workers = workers
+        self.extensions = extensions
+        self.polling = False # True after falling back to rescans
+        self.error = None # the InotifyError that caused the fallback
+        self._db = database
+        self._cache = cache
+        self._inotify = None
+        self._watches = {} # watch descriptor -> directory
+        self._changes = OrderedDict() # path -> add, remove, dir or rmdir
+        self._first_change = None
+        self._last_change = None
+        self._overflow = False
+        self._next_rescan = None
+
+
+    def start(self):
+        """
+        watch the directory tree and bring the database in sync with it.
+        returns the SyncProgress of the initial sync.
+        """
+        try:
+            self._inotify = Inotify()
+            self._watch_tree(self.path)
+        except InotifyError, e:
+            self._fall_back(e)
+        # watches are set up first so nothing changed during the sync is lost
+        return self._sync()
+
+
+    def step(self, timeout=None):
+        """
+        wait for changes and write them when the tree has been quiet for
+        delay seconds. returns a SyncProgress for the changes written or
+        None if nothing was written within timeout.
+        added counts books added or updated, found and checked count the
+        changes (after coalescing several events for a file).
+
+        timeout - optional, seconds to wait, None waits until something
+                  was written
+        """
+        deadline = timeout is not None and clock() + timeout or None
+        while True:
+            wait = self._wait_time(deadline)
+            if self.polling:
+                time.sleep(wait)
+                if clock() >= self._next_rescan:
+                    self._next_rescan = clock() + self.rescan_interval
+                    return self._sync()
+            else:
+                events = self._inotify.read(wait)
+                try:
+                    self._handle(events)
+                except InotifyError, e:
+                    self._fall_back(e)
+                    self._changes.clear()
+                    return self._sync()
+                if self._changes and self._due():
+                    return self._apply()
+            if deadline is not None and clock() >= deadline:
+                return None
+
+
+    def run(self, report=None):
+        """
+        start watching and write changes forever
+
+        report - optional, callable that gets the SyncProgress of the
+                 initial sync and of every batch written
+        """
+        progress = self.start()
+        while True:
+            if report is not None:
+                report(progress)
+            progress = None
+            while progress is None:
+                progress = self.step()
+
+
+    def close(self):
+        """
+        write pending changes and stop watching
+        """
+        if self._changes:
+            self._apply()
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._watches = {}
+
+
+    def _wait_time(self, deadline):
+        """
+        return how long to wait for the next event, None is forever
+        """
+        if self.polling:
+            wait = max(self._next_rescan - clock(), 0)
+        elif self._changes:
+            wait = max(self._last_change + self.delay - clock(), 0)
+        else:
+            wait = None
+        if deadline is not None:
+            left = max(deadline - clock(), 0)
+            wait = wait is None and left or min(wait, left)
+        return wait
+
+
+    def _due(self):
+        """
+        return True if the collected changes should be written now: there
+        were no changes for delay seconds, the batch is full or changes
+        kept coming in for too long
+        """
+        now = clock()
+        return (now - self._last_change >= self.delay or self._overflow or
+                len(self._changes) >= self.batch_size or
+                now - self._first_change >= self.delay * 10)
+
+
+    def _handle(self, events):
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self._overflow = True
+                self._change(self.path, 'dir')
+                continue
+            if mask & IN_IGNORED:
+                self._watches.pop(wd, None)
+                continue
+            if mask & IN_DELETE_SELF:
+                # e.g. the library root, whose parent isn't watched
+                directory = self._watches.get(wd)
+                if directory is not None:
+                    self._unwatch_tree(directory)
+                    self._change(directory, 'rmdir')
+                continue
+            directory = self._watches.get(wd)
+            if directory is None or not name or name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(path)
+                    self._change(path, 'dir')
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._unwatch_tree(path)
+                    self._change(path, 'rmdir')
+            elif name.split('.')[-1].lower() in self.extensions:
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    self._change(path, 'add')
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._change(path, 'remove')
+
+
+    def _change(self, path, change):
+        self._last_change = clock()
+        if not self._changes:
+            self._first_change = self._last_change
+        if change == 'rmdir':
+            prefix = path + os.sep
+            for key in [k for k in self._changes if k.startswith(prefix)]:
+                del self._changes[key]
+        self._changes.pop(path, None) # keep changes in the order they happen
+        self._changes[path] = change
+
+
+    def _apply(self):
+        """
+        write the collected changes, return a SyncProgress
+        """
+        changes = self._changes
+        self._changes = OrderedDict()
+        if self._overflow:
+            # events were lost, only a rescan can tell what changed
+            self._overflow = False
+            return self._sync()
+
+        paths = []
+        removed = 0
+        with self._db.batch(self.batch_size) as batch:
+            for path, change in changes.items():
+                if change == 'add':
+                    paths.append(path)
+                elif change == 'dir':
+                    paths.extend(p for p, _ in FileScanner(path).scan())
+                elif change == 'remove':
+                    batch.remove(path)
+                    removed += 1
+                elif change == 'rmdir':
+                    batch.remove_directory(path)
+
+            entries = []
+            for path in paths:
+                try:
+                    entries.append((path, os.stat(path)))
+                except OSError:
+                    pass # gone again
+            workers = len(entries) > 64 and self.workers or 1
+            extractor = MetadataExtractor(workers, cache=self._cache)
+            for abspath, stat, metadata in extractor.extract(entries):
+                add_file(abspath, batch, stat, metadata=metadata)
+        return SyncProgress(len(changes), len(changes), len(entries),
+                            removed, 0)
+
+
+    def _sync(self):
+        """
+        bring the database in sync with a rescan of the whole tree. nothing
+        is done if the tree isn't available, see library_available()
+        """
+        progress = None
+        if not library_available(self.path, self._db):
+            return progress
+        for progress in sync_books(self.path, self._db, workers=self.workers,
+                                   cache=self._cache):
+            pass
+        return progress
+
+
+    def _watch_tree(self, root):
+        """
+        add watches for root and every directory below it. directories that
+        vanished or can't be read are skipped, WatchLimitError is passed on.
+        """
+        for dirpath, dirnames, _ in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.') and
+                           not os.path.islink(os.path.join(dirpath, d))]
+            try:
+                wd = self._inotify.add_watch(dirpath, _WATCH_MASK)
+            except WatchLimitError:
+                raise
+            except InotifyError:
+                continue
+            self._watches[wd] = dirpath
+
+
+    def _unwatch_tree(self, root):
+        prefix = root + os.sep
+        for wd, directory in self._watches.items():
+            if directory == root or directory.startswith(prefix):
+                self._inotify.rm_watch(wd)
+                del self._watches[wd]
+
+
+    def _fall_back(self, error):
+        """
+        stop using inotify and rescan the tree periodically
+        """
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._watches = {}
+        self.polling = True
+        self.error = error
+        self._next_rescan = clock() + self.rescan_interval
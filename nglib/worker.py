@@ -0,0 +1,224 @@
+# encoding: utf-8
+
+"""
+@summary: runs searches and library reloads in a background thread
+@author: Haiko Schol <alsihad (at) zeropatience (dot) net>
+
+Copyright (c) 2009, 2010 Haiko Schol alsihad (at) zeropatience (dot) net
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification,
+are permitted provided that the following conditions are met:
+
+    * Redistributions of source code must retain the above copyright notice,
+        this list of conditions and the following disclaimer.
+    * Redistributions in binary form must reproduce the above copyright notice,
+        this list of conditions and the following disclaimer in the documentation
+        and/or other materials provided with the distribution.
+    * Neither the name of the netgarage nor the names of its contributors
+        may be used to endorse or promote products derived from this software
+        without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE FOR
+ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+(INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON
+ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+(INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+For more Information see http://netgarage.org
+"""
+
+from __future__ import with_statement
+import threading
+from collections import namedtuple
+from Queue import Empty
+from Queue import Queue
+
+from nglib.model.bookdatabase import SORT_TITLE
+from nglib.model.bookdatabase import SearchCancelled
+
+
+# kind is one of
+#   books - data is the BookList found by a search or get_all job
+#   progress - data is a SyncProgress tuple of a running reload job
+#   done - the reload job is finished, data is the last SyncProgress
+#   cancelled - the job was cancelled
+#   error - the job failed, data is the exception
+WorkerEvent = namedtuple('WorkerEvent', 'job kind data')
+
+
+class Worker(threading.Thread):
+    """
+    a thread that does the database work for an interactive view, so the
+    view can keep handling keys. it has its own Controller (and with it
+    its own sqlite connection). jobs are queued with search(), get_all()
+    and reload(), results come back as WorkerEvents through poll().
+    a search is abandoned as soon as another job is queued, searches are
+    run between the steps of a reload.
+    """
+
+    def __init__(self, controller_factory):
+        """
+        create a Worker, call start() to run it
+
+        controller_factory - callable that returns a Controller, called in
+                             the worker thread
+        """
+        threading.Thread.__init__(self, name='nglib-worker')
+        self.daemon = True
+        self._controller_factory = controller_factory
+        self._jobs = Queue()
+        self._events = Queue()
+        self._lock = threading.Lock()
+        self._last_job = 0
+
+
+    def search(self, term, sort=SORT_TITLE):
+        """
+        queue a search, return the id of the job
+
+        sort - SORT_TITLE or SORT_RELEVANCE
+        """
+        return self._queue('search', (term, sort))
+
+
+    def get_all(self):
+        """
+        queue a listing of all books, return the id of the job
+        """
+        return self._queue('all')
+
+
+    def reload(self, rebuild=False):
+        """
+        queue a reload of the library, return the id of the job. a reload
+        that is already running is cancelled.
+
+        rebuild - build a new database and swap it in when complete
+        """
+        return self._queue('reload', rebuild)
+
+
+    def cancel(self):
+        """
+        cancel the running search and reload
+        """
+        self._queue('cancel')
+
+
+    def stop(self, timeout=None):
+        """
+        cancel everything and end the thread
+
+        timeout - optional, seconds to wait for the thread to end
+        """
+        self._queue('stop')
+        if self.is_alive():
+            self.join(timeout)
+
+
+    def poll(self):
+        """
+        return the list of events posted since the last call, without
+        waiting
+        """
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except Empty:
+                return events
+
+
+    def run(self):
+        controller = self._controller_factory()
+        reload = None # [job id, generator, last progress] of a running reload
+        try:
+            while True:
+                jobs = self._take_jobs(block=reload is None)
+                listing = None
+                for job, kind, arg in jobs:
+                    if kind == 'stop':
+                        return
+                    elif kind in ('cancel', 'reload') and reload is not None:
+                        reload[1].close()
+                        self._post(reload[0], 'cancelled')
+                        reload = None
+                    if kind == 'reload':
+                        reload = [job, controller.reload_library(arg), None]
+                    elif kind in ('search', 'all'):
+                        listing = (job, kind, arg)
+                    elif kind == 'cancel' and listing is not None:
+                        self._post(listing[0], 'cancelled')
+                        listing = None
+
+                if listing is not None:
+                    self._list(controller, *listing)
+                if reload is not None:
+                    reload = self._step(reload)
+        finally:
+            controller.close()
+
+
+    def _list(self, controller, job, kind, search):
+        try:
+            if kind == 'all':
+                books = controller.get_all()
+            else:
+                term, sort = search
+                books = controller.search_incremental(term, self._pending,
+                                                      sort)
+        except SearchCancelled:
+            self._post(job, 'cancelled')
+        except Exception, e:
+            self._post(job, 'error', e)
+        else:
+            self._post(job, 'books', books)
+
+
+    def _step(self, reload):
+        """
+        run a reload up to its next progress report. return reload, or None
+        when it's finished
+        """
+        job, progress, last = reload
+        try:
+            reload[2] = progress.next()
+            self._post(job, 'progress', reload[2])
+            return reload
+        except StopIteration:
+            self._post(job, 'done', last)
+        except Exception, e:
+            self._post(job, 'error', e)
+        return None
+
+
+    def _pending(self):
+        return not self._jobs.empty()
+
+
+    def _take_jobs(self, block):
+        jobs = []
+        try:
+            jobs.append(self._jobs.get(block))
+            while True:
+                jobs.append(self._jobs.get_nowait())
+        except Empty:
+            return jobs
+
+
+    def _queue(self, kind, arg=None):
+        with self._lock:
+            self._last_job += 1
+            job = self._last_job
+        self._jobs.put((job, kind, arg))
+        return job
+
+
+    def _post(self, job, kind, data=None):
+        self._events.put(WorkerEvent(job, kind, data))
@@ -1,7 +1,8 @@
 from platform import platform
 from distutils.core import setup
 
-scripts = ['bin/nglib', 'bin/nglib-update', 'bin/nglib-search']
+scripts = ['bin/nglib', 'bin/nglib-update', 'bin/nglib-search',
+           'bin/nglib-watch', 'bin/nglib-dupes']
 if 'darwin' in platform().lower():
     scripts.append('bin/reveal')
 